@@ -4,12 +4,27 @@ Anharmonic Lattice Dynamics
 """
 from opt_einsum import contract
 import numpy as np
+from scipy.linalg import cho_factor, cho_solve, eigh, lu_factor, lu_solve
+from scipy.sparse.linalg import LinearOperator
 from kaldo.controllers.dirac_kernel import lorentz_delta, gaussian_delta, triangular_delta
 from kaldo.helpers.storage import lazy_property
-from kaldo.observables.harmonic_with_q_temp import HarmonicWithQTemp
+from kaldo.observables.harmonic_with_q import HarmonicWithQ
+from kaldo.observables.harmonic_with_q_temp import calculate_generalized_heat_capacity, calculate_heat_capacity, \
+    calculate_pair_heat_capacity, calculate_population
 from kaldo.helpers.logger import get_logger, log_size
+from kaldo.helpers.parallel import parallel_map
+from functools import partial
+import ase.units as units
 logging = get_logger()
 
+# Largest block of mode pairs processed at once by the QHGK conductivity
+MAX_QHGK_BLOCK_ELEMENTS = 2 ** 22
+# Relative residual at which the iterative solution of the linearized BTE is converged
+DEFAULT_SOLVER_TOLERANCE = 1e-8
+# Largest block of modes whose conductivity is calculated at once by the cumulative and spectral conductivity
+MAX_ACCUMULATION_BLOCK_SIZE = 2 ** 16
+
+
 def calculate_conductivity_per_mode(heat_capacity, velocity, mfp, physical_mode, n_phonons):
     conductivity_per_mode = np.zeros((n_phonons, 3, 3))
     physical_mode = physical_mode.reshape(n_phonons)
@@ -20,31 +35,488 @@ def calculate_conductivity_per_mode(heat_capacity, velocity, mfp, physical_mode,
     return conductivity_per_mode * 1e22
 
 
-def calculate_diffusivity(omega, sij_left, sij_right, diffusivity_bandwidth, physical_mode, curve,
-                          is_diffusivity_including_antiresonant=False,
-                          diffusivity_threshold=None):
-    # TODO: cache this
-    sigma = 2 * (diffusivity_bandwidth[:, np.newaxis] + diffusivity_bandwidth[np.newaxis, :])
+def calculate_diffusivity_kernel(omega, diffusivity_bandwidth, physical_mode, curve,
+                                is_diffusivity_including_antiresonant=False, diffusivity_threshold=None,
+                                rows=slice(None)):
+    """Calculate the energy conservation kernel of the diffusivity, for the pairs of modes with the first mode in
+    rows.
+
+    Returns
+    -------
+    kernel : np.array
+        (n_rows, n_modes) float
+    """
+    sigma = 2 * (diffusivity_bandwidth[rows, np.newaxis] + diffusivity_bandwidth[np.newaxis, :])
     physical_mode = physical_mode.astype(np.bool)
-    delta_energy = omega[:, np.newaxis] - omega[np.newaxis, :]
+    delta_energy = omega[rows, np.newaxis] - omega[np.newaxis, :]
     kernel = curve(delta_energy, sigma)
     if diffusivity_threshold is not None:
         condition = (np.abs(delta_energy) < diffusivity_threshold * 2 * np.pi * diffusivity_bandwidth)
         kernel[np.invert(condition)] = 0
     if is_diffusivity_including_antiresonant:
-        sum_energy = omega[:, np.newaxis] + omega[np.newaxis, :]
+        sum_energy = omega[rows, np.newaxis] + omega[np.newaxis, :]
         kernel += curve(sum_energy, sigma)
     kernel = kernel * np.pi
     kernel[np.isnan(kernel)] = 0
-    mu_unphysical = np.argwhere(np.invert(physical_mode)).T
-    kernel[:, :] = kernel / omega[:, np.newaxis]
+    kernel[:, :] = kernel / omega[rows, np.newaxis]
     kernel[:, :] = kernel[:, :] / omega[np.newaxis, :] / 4
-    kernel[mu_unphysical, :] = 0
-    kernel[:, mu_unphysical] = 0
+    kernel[np.invert(physical_mode[rows]), :] = 0
+    kernel[:, np.invert(physical_mode)] = 0
+    return kernel
+
+
+def calculate_diffusivity(omega, sij_left, sij_right, diffusivity_bandwidth, physical_mode, curve,
+                          is_diffusivity_including_antiresonant=False,
+                          diffusivity_threshold=None):
+    kernel = calculate_diffusivity_kernel(omega, diffusivity_bandwidth, physical_mode, curve,
+                                          is_diffusivity_including_antiresonant, diffusivity_threshold)
     diffusivity = sij_left * kernel * sij_right
     return diffusivity
 
 
+def calculate_band_pairs(omega, diffusivity_bandwidth, physical_mode, diffusivity_threshold):
+    """Find the pairs of physical modes within the diffusivity threshold, |omega_i - omega_j| <
+    diffusivity_threshold * 2 pi diffusivity_bandwidth_j. The modes are sorted by frequency, so that the first modes
+    of the pairs of each second mode j are the contiguous window of the sorted modes within its own width, and the
+    n_modes x n_modes array is never built.
+
+    Returns
+    -------
+    first, second : np.array
+        (n_pairs) int indices of the modes of each pair
+    """
+    width = diffusivity_threshold * 2 * np.pi * diffusivity_bandwidth
+    physical_index = np.argwhere(physical_mode.astype(np.bool)).flatten()
+    order = physical_index[np.argsort(omega[physical_index])]
+    sorted_omega = omega[order]
+    sorted_width = width[order]
+    # The sides exclude the edges of the window, as the strict inequality
+    start = np.searchsorted(sorted_omega, sorted_omega - sorted_width, side='right')
+    end = np.searchsorted(sorted_omega, sorted_omega + sorted_width, side='left')
+    n_pairs = np.maximum(end - start, 0)
+    second = np.repeat(np.arange(order.shape[0]), n_pairs)
+    first = np.repeat(start - np.cumsum(n_pairs) + n_pairs, n_pairs) + np.arange(second.shape[0])
+    return order[first], order[second]
+
+
+def calculate_pair_diffusivity_kernel(omega, diffusivity_bandwidth, curve, first, second):
+    """Calculate the energy conservation kernel of the diffusivity only for the pairs of modes (first[p], second[p]).
+
+    Returns
+    -------
+    kernel : np.array
+        (n_pairs) float
+    """
+    sigma = 2 * (diffusivity_bandwidth[first] + diffusivity_bandwidth[second])
+    kernel = curve(omega[first] - omega[second], sigma) * np.pi
+    kernel[np.isnan(kernel)] = 0
+    return kernel / omega[first] / omega[second] / 4
+
+
+def calculate_conductivity_qhgk_with_q(k_index, q_points, omega, diffusivity_bandwidth, physical_mode, curve,
+                                       is_diffusivity_including_antiresonant, diffusivity_threshold, normalization,
+                                       harmonic_kwargs, frequency, population, heat_capacity, temperature,
+                                       eigenvectors=None, is_band_limited=False):
+    """Calculate the QHGK conductivity and diffusivity of the modes of a single k point. The generalized heat
+    capacity and the diffusivity kernel are evaluated in blocks of rows, so that no n_modes x n_modes array
+    other than the flux operators is held in memory.
+
+    The frequency, population and heat capacity are the ones already calculated by Phonons. When the Phonons
+    eigenvectors are given, only the flux operators are calculated here, otherwise the eigensystem of the k point
+    is calculated again.
+
+    When is_band_limited is set, only the pairs of modes within the diffusivity threshold are calculated, and the
+    flux operator elements of these pairs are obtained one direction at a time.
+
+    Returns
+    -------
+    conductivity_per_mode : np.array
+        (n_modes, 3, 3) conductivity, before the conversion to W/m/K
+    diffusivity_with_axis : np.array
+        (n_modes, 3, 3) diffusivity, before the conversion to mm^2/s
+    """
+    phonon = HarmonicWithQ(q_point=q_points[k_index], **harmonic_kwargs)
+    n_modes = omega.shape[1]
+    if n_modes > 100:
+        logging.info('calculating conductivity for q = ' + str(q_points[k_index]))
+    frequency = frequency[k_index]
+    population = population[k_index]
+    heat_capacity = heat_capacity[k_index]
+    if eigenvectors is not None:
+        eigenvectors = eigenvectors[k_index]
+    if is_band_limited:
+        return calculate_band_limited_conductivity_with_q(phonon, omega[k_index], diffusivity_bandwidth[k_index],
+                                                          physical_mode[k_index], curve, diffusivity_threshold,
+                                                          normalization, frequency, population, heat_capacity,
+                                                          temperature, eigenvectors)
+    sij = calculate_flux_operators(phonon, eigenvectors)
+    conductivity_per_mode = np.zeros((n_modes, 3, 3))
+    diffusivity_with_axis = np.zeros((n_modes, 3, 3))
+    n_rows = max(1, int(MAX_QHGK_BLOCK_ELEMENTS / n_modes))
+    for row_start in range(0, n_modes, n_rows):
+        rows = slice(row_start, min(row_start + n_rows, n_modes))
+        heat_capacity_2d = calculate_generalized_heat_capacity(frequency, population, heat_capacity,
+                                                               physical_mode[k_index], temperature, rows)
+        kernel = calculate_diffusivity_kernel(omega[k_index], diffusivity_bandwidth[k_index],
+                                              physical_mode[k_index], curve,
+                                              is_diffusivity_including_antiresonant, diffusivity_threshold, rows)
+        heat_capacity_kernel = heat_capacity_2d * kernel
+        # The tensors are symmetric in alpha, beta, and the fused contractions avoid the n_rows x n_modes products
+        for alpha in range(3):
+            for beta in range(alpha, 3):
+                conductivity_per_mode[rows, alpha, beta] = np.einsum('ij,ij,ij->i', sij[alpha][rows],
+                                                                     heat_capacity_kernel,
+                                                                     sij[beta][rows]).real / normalization
+                diffusivity_with_axis[rows, alpha, beta] = np.einsum('ij,ij,ij->i', sij[alpha][rows], kernel,
+                                                                     sij[beta][rows]).real
+                conductivity_per_mode[rows, beta, alpha] = conductivity_per_mode[rows, alpha, beta]
+                diffusivity_with_axis[rows, beta, alpha] = diffusivity_with_axis[rows, alpha, beta]
+    return conductivity_per_mode, diffusivity_with_axis
+
+
+def calculate_flux_operators(phonon, eigenvectors=None):
+    if eigenvectors is None:
+        return [np.asarray(phonon._sij_x), np.asarray(phonon._sij_y), np.asarray(phonon._sij_z)]
+    return [np.asarray(phonon.calculate_sij(alpha, eigenvectors)) for alpha in range(3)]
+
+
+def calculate_qhgk_sweep_with_q(k_index, q_points, omega, diffusivity_bandwidth, physical_mode, curve,
+                                is_diffusivity_including_antiresonant, diffusivity_threshold, normalization,
+                                harmonic_kwargs, frequency, population, heat_capacity, temperature,
+                                eigenvectors=None):
+    """Calculate the QHGK conductivity of a single k point for many temperatures and diffusivity bandwidths,
+    calculating the flux operators only once. The arguments are the ones of calculate_conductivity_qhgk_with_q,
+    with an additional leading axis on diffusivity_bandwidth (n_bandwidths), population, heat_capacity and
+    temperature (n_temperatures).
+
+    Returns
+    -------
+    conductivity : np.array
+        (n_temperatures, n_bandwidths, 3, 3) conductivity summed over the modes, before the conversion to W/m/K
+    """
+    phonon = HarmonicWithQ(q_point=q_points[k_index], **harmonic_kwargs)
+    n_modes = omega.shape[1]
+    n_temperatures = temperature.shape[0]
+    n_bandwidths = diffusivity_bandwidth.shape[0]
+    if n_modes > 100:
+        logging.info('calculating conductivity sweep for q = ' + str(q_points[k_index]))
+    if eigenvectors is not None:
+        eigenvectors = eigenvectors[k_index]
+    sij = calculate_flux_operators(phonon, eigenvectors)
+    conductivity = np.zeros((n_temperatures, n_bandwidths, 3, 3))
+    # The generalized heat capacity of all the temperatures is held for each block
+    n_rows = max(1, int(MAX_QHGK_BLOCK_ELEMENTS / n_modes / (n_temperatures + 1)))
+    for row_start in range(0, n_modes, n_rows):
+        rows = slice(row_start, min(row_start + n_rows, n_modes))
+        heat_capacity_2d = np.array([calculate_generalized_heat_capacity(frequency[k_index],
+                                                                         population[i, k_index],
+                                                                         heat_capacity[i, k_index],
+                                                                         physical_mode[k_index], temperature[i],
+                                                                         rows)
+                                     for i in range(n_temperatures)])
+        for j in range(n_bandwidths):
+            kernel = calculate_diffusivity_kernel(omega[k_index], diffusivity_bandwidth[j, k_index],
+                                                  physical_mode[k_index], curve,
+                                                  is_diffusivity_including_antiresonant, diffusivity_threshold, rows)
+            for alpha in range(3):
+                for beta in range(alpha, 3):
+                    flux_kernel = (sij[alpha][rows] * kernel * sij[beta][rows]).real
+                    conductivity[:, j, alpha, beta] += np.tensordot(heat_capacity_2d, flux_kernel,
+                                                                    axes=([1, 2], [0, 1]))
+    for alpha in range(3):
+        for beta in range(alpha + 1, 3):
+            conductivity[:, :, beta, alpha] = conductivity[:, :, alpha, beta]
+    return (conductivity / normalization, )
+
+
+def calculate_band_limited_conductivity_with_q(phonon, omega, diffusivity_bandwidth, physical_mode, curve,
+                                               diffusivity_threshold, normalization, frequency, population,
+                                               heat_capacity, temperature, eigenvectors=None):
+    """Calculate the QHGK conductivity and diffusivity of the modes of a single k point, storing only the pairs of
+    modes within the diffusivity threshold. Memory scales with the number of pairs, n_modes times the width of the
+    band, rather than with n_modes x n_modes.
+
+    Returns
+    -------
+    conductivity_per_mode : np.array
+        (n_modes, 3, 3) conductivity, before the conversion to W/m/K
+    diffusivity_with_axis : np.array
+        (n_modes, 3, 3) diffusivity, before the conversion to mm^2/s
+    """
+    n_modes = omega.shape[0]
+    first, second = calculate_band_pairs(omega, diffusivity_bandwidth, physical_mode, diffusivity_threshold)
+    if n_modes > 100:
+        logging.info('Number of mode pairs within the diffusivity threshold: ' + str(first.shape[0]))
+    kernel = calculate_pair_diffusivity_kernel(omega, diffusivity_bandwidth, curve, first, second)
+    heat_capacity_kernel = calculate_pair_heat_capacity(frequency, population, heat_capacity, temperature,
+                                                        first, second) * kernel
+    sij = [phonon.calculate_sij_pairs(alpha, first, second, eigenvectors) for alpha in range(3)]
+    conductivity_per_mode = np.zeros((n_modes, 3, 3))
+    diffusivity_with_axis = np.zeros((n_modes, 3, 3))
+    for alpha in range(3):
+        for beta in range(alpha, 3):
+            flux_product = (sij[alpha] * sij[beta]).real
+            conductivity_per_mode[:, alpha, beta] = np.bincount(first, flux_product * heat_capacity_kernel,
+                                                                minlength=n_modes) / normalization
+            diffusivity_with_axis[:, alpha, beta] = np.bincount(first, flux_product * kernel, minlength=n_modes)
+            conductivity_per_mode[:, beta, alpha] = conductivity_per_mode[:, alpha, beta]
+            diffusivity_with_axis[:, beta, alpha] = diffusivity_with_axis[:, alpha, beta]
+    return conductivity_per_mode, diffusivity_with_axis
+
+
+def solve_conjugate_gradient(matvec, rhs, preconditioner, tolerance=DEFAULT_SOLVER_TOLERANCE, n_iterations=None,
+                             callback=None):
+    """Solve the symmetric positive definite systems matvec(x) = rhs, one for each column of rhs, with the
+    preconditioned conjugate gradient. Only products of the operator with blocks of vectors are needed.
+
+    Parameters
+    ----------
+    matvec : callable
+        returns the product of the operator with a (n, n_rhs) array
+    rhs : np.array
+        (n, n_rhs) right hand sides
+    preconditioner : np.array
+        (n, n_rhs) inverse of the approximated diagonal of the operator of each system, which also gives the starting
+        point, preconditioner * rhs
+    tolerance : float, optional
+        convergence threshold on the residual, relative to the norm of rhs
+    n_iterations : int, optional
+        maximum number of iterations. Default is n
+    callback : callable, optional
+        called at each iteration as callback(iteration, x, relative_residual)
+
+    Returns
+    -------
+    x : np.array
+        (n, n_rhs) solutions
+    relative_residual : np.array
+        (n_rhs) relative residual at the last iteration
+    """
+    if n_iterations is None:
+        n_iterations = rhs.shape[0]
+    rhs_norm = np.linalg.norm(rhs, axis=0)
+    rhs_norm[rhs_norm == 0] = 1
+    x = preconditioner * rhs
+    residual = rhs - matvec(x)
+    preconditioned_residual = preconditioner * residual
+    direction = preconditioned_residual.copy()
+    residual_dot = np.sum(residual * preconditioned_residual, axis=0)
+    for iteration in range(n_iterations + 1):
+        relative_residual = np.linalg.norm(residual, axis=0) / rhs_norm
+        if callback is not None:
+            callback(iteration, x, relative_residual)
+        if (relative_residual < tolerance).all() or iteration == n_iterations:
+            break
+        operator_direction = matvec(direction)
+        curvature = np.sum(direction * operator_direction, axis=0)
+        # Converged systems are left untouched
+        is_active = (relative_residual >= tolerance) & (curvature != 0)
+        step = np.zeros_like(curvature)
+        step[is_active] = residual_dot[is_active] / curvature[is_active]
+        x += step * direction
+        residual -= step * operator_direction
+        preconditioned_residual = preconditioner * residual
+        new_residual_dot = np.sum(residual * preconditioned_residual, axis=0)
+        ratio = np.zeros_like(residual_dot)
+        ratio[is_active] = new_residual_dot[is_active] / residual_dot[is_active]
+        direction = preconditioned_residual + ratio * direction
+        residual_dot = new_residual_dot
+    return x, relative_residual
+
+
+class ScatteringOperator(LinearOperator):
+    """Scattering matrix of the physical modes, the one returned by Conductivity.calculate_scattering_matrix,
+    applied to vectors without building it. The matrix is diag(left) G diag(right) + diag(diagonal), where G is the
+    scattering tensor, stored as compressed rows, and the rescalings by population and frequency are vectors.
+
+    Parameters
+    ----------
+    scattering_rows : scipy.sparse.csr_matrix
+        (n_physical, n_physical) scattering tensor G
+    left, right : np.array
+        (n_physical) rescaling of rows and columns
+    diagonal : np.array, optional
+        (n_physical) added to the diagonal, i.e. the bandwidths
+    """
+    def __init__(self, scattering_rows, left, right, diagonal=None):
+        super().__init__(dtype=np.float64, shape=scattering_rows.shape)
+        self.scattering_rows = scattering_rows
+        self.left = left
+        self.right = right
+        self.diagonal = np.zeros(scattering_rows.shape[0]) if diagonal is None else diagonal
+
+    def _matvec(self, x):
+        return self._matmat(x.reshape((-1, 1))).reshape(x.shape)
+
+    def _rmatvec(self, x):
+        return self._rmatmat(x.reshape((-1, 1))).reshape(x.shape)
+
+    def _matmat(self, x):
+        return self.left[:, np.newaxis] * self.scattering_rows.dot(self.right[:, np.newaxis] * x) \
+               + self.diagonal[:, np.newaxis] * x
+
+    def _rmatmat(self, x):
+        return self.right[:, np.newaxis] * self.scattering_rows.T.dot(self.left[:, np.newaxis] * x) \
+               + self.diagonal[:, np.newaxis] * x
+
+    def symmetric_dot(self, x):
+        """Product of (A + A^T) / 2 with the (n_physical, n_columns) array x."""
+        return (self._matmat(x) + self._rmatmat(x)) / 2
+
+
+def symmetrize_matrix(matrix, n_rows=1024):
+    """Replace matrix with (matrix + matrix^T) / 2 in place, in blocks of n_rows rows to avoid an n x n temporary.
+
+    Returns
+    -------
+    matrix : np.array
+        (n, n) float, the same array
+    """
+    for start in range(0, matrix.shape[0], n_rows):
+        rows = slice(start, start + n_rows)
+        block = (matrix[rows, start:] + matrix[start:, rows].T) / 2
+        matrix[rows, start:] = block
+        matrix[start:, rows] = block.T
+    return matrix
+
+
+def calculate_asymmetry(matrix, n_rows=1024):
+    """Sum of |matrix - matrix^T|, evaluated in blocks of n_rows rows to avoid an n x n temporary."""
+    asymmetry = 0.
+    for start in range(0, matrix.shape[0], n_rows):
+        rows = slice(start, start + n_rows)
+        asymmetry += np.abs(matrix[rows] - matrix[:, rows].T).sum()
+    return asymmetry
+
+
+def factorize_scattering_matrix(scattering_matrix, is_cholesky=False):
+    """Factorize the scattering matrix, with Cholesky when it is symmetric positive definite and LU otherwise.
+
+    Returns
+    -------
+    factorization : tuple
+        ('cholesky' or 'lu', factors as returned by scipy.linalg)
+    """
+    log_size(scattering_matrix.shape, np.float, name='scattering_factorization')
+    if is_cholesky:
+        try:
+            return 'cholesky', cho_factor(scattering_matrix, overwrite_a=True)
+        except np.linalg.LinAlgError:
+            logging.warning('The scattering matrix is not positive definite, using the LU factorization')
+    return 'lu', lu_factor(scattering_matrix, overwrite_a=True)
+
+
+def solve_factorized(factorization, rhs):
+    kind, factors = factorization
+    if kind == 'cholesky':
+        return cho_solve(factors, rhs)
+    return lu_solve(factors, rhs)
+
+
+def calculate_anderson_mixing(fixed_point_history, residual_history):
+    """Calculate the next iterate of the Anderson acceleration of the fixed point iteration x = g(x), for each column
+    independently. The residuals are f = g(x) - x, and the last iterate is corrected with the combination of the
+    previous steps which minimizes the residual.
+
+    Parameters
+    ----------
+    fixed_point_history : list of np.array
+        (n, n_columns) g(x) of the previous iterations, the last one is the current
+    residual_history : list of np.array
+        (n, n_columns) g(x) - x of the previous iterations
+
+    Returns
+    -------
+    x : np.array
+        (n, n_columns) next iterate
+    """
+    fixed_point = fixed_point_history[-1]
+    if len(residual_history) < 2:
+        return fixed_point.copy()
+    delta_residual = np.diff(np.stack(residual_history, axis=-1), axis=-1)
+    delta_fixed_point = np.diff(np.stack(fixed_point_history, axis=-1), axis=-1)
+    x = fixed_point.copy()
+    for column in range(fixed_point.shape[1]):
+        coefficients = np.linalg.lstsq(delta_residual[:, column, :], residual_history[-1][:, column], rcond=None)[0]
+        x[:, column] -= delta_fixed_point[:, column, :].dot(coefficients)
+    return x
+
+
+def cumulate_conductivity(values, conductivity, n_block=MAX_ACCUMULATION_BLOCK_SIZE):
+    """Calculate the cumulative conductivity, the conductivity of all the modes with value strictly lower than the
+    one of each mode, with a single sort and cumulative sum, a block of modes at a time.
+
+    Parameters
+    ----------
+    values : np.array
+        (n_phonons) quantity used to accumulate, i.e. frequency or mean free path
+    conductivity : np.array or callable
+        (n_phonons, ...) conductivity per mode, or a function that returns the conductivity of an array of mode
+        indices, so that the conductivity of all the modes is never allocated
+    n_block : int, optional
+        number of modes accumulated at once
+
+    Returns
+    -------
+    cumulative_conductivity : np.array
+        (n_phonons, ...) float
+    """
+    if not callable(conductivity):
+        conductivity = conductivity.__getitem__
+    order = np.argsort(values, kind='stable')
+    sorted_values = values[order]
+    cumulative_conductivity = None
+    for start in range(0, order.shape[0], n_block):
+        block_conductivity = conductivity(order[start:start + n_block])
+        if cumulative_conductivity is None:
+            cumulative_conductivity = np.zeros((order.shape[0] + 1, ) + block_conductivity.shape[1:])
+        block_cumulative = cumulative_conductivity[start + 1:start + 1 + block_conductivity.shape[0]]
+        np.cumsum(block_conductivity, axis=0, out=block_cumulative)
+        block_cumulative += cumulative_conductivity[start]
+    return cumulative_conductivity[np.searchsorted(sorted_values, values, side='left')]
+
+
+def bin_conductivity(values, conductivity, bins, n_block=MAX_ACCUMULATION_BLOCK_SIZE):
+    """Calculate the spectral conductivity, the conductivity of the modes with value in each bin, a block of modes at
+    a time.
+
+    Parameters
+    ----------
+    values : np.array
+        (n_phonons) quantity used to accumulate, i.e. frequency or mean free path
+    conductivity : np.array or callable
+        (n_phonons, ...) conductivity per mode, or a function that returns the conductivity of an array of mode
+        indices, so that the conductivity of all the modes is never allocated
+    bins : np.array
+        (n_bins + 1) edges of the bins, modes outside the edges are discarded
+    n_block : int, optional
+        number of modes accumulated at once
+
+    Returns
+    -------
+    spectral_conductivity : np.array
+        (n_bins, ...) float
+    """
+    if not callable(conductivity):
+        conductivity = conductivity.__getitem__
+    n_bins = len(bins) - 1
+    bin_index = np.searchsorted(bins, values, side='right') - 1
+    # The last edge is included in the last bin, as in np.histogram
+    bin_index[values == bins[-1]] = n_bins - 1
+    spectral_conductivity = None
+    for start in range(0, values.shape[0], n_block):
+        modes = np.arange(start, min(start + n_block, values.shape[0]))
+        modes = modes[(bin_index[modes] >= 0) & (bin_index[modes] < n_bins)]
+        block_conductivity = conductivity(modes)
+        if spectral_conductivity is None:
+            spectral_conductivity = np.zeros((n_bins, ) + block_conductivity.shape[1:])
+        flat_conductivity = block_conductivity.reshape((modes.shape[0], -1))
+        binned_conductivity = np.array([np.bincount(bin_index[modes], component, minlength=n_bins)
+                                        for component in flat_conductivity.T]).T
+        spectral_conductivity += binned_conductivity.reshape(spectral_conductivity.shape)
+    return spectral_conductivity
+
+
 def gamma_with_matthiessen(gamma, velocity, length):
     gamma = gamma + 2 * np.abs(velocity) / length
     return gamma
@@ -53,10 +525,11 @@ def gamma_with_matthiessen(gamma, velocity, length):
 def mfp_matthiessen(gamma, velocity, length, physical_mode):
     lambd_0 = np.zeros_like(velocity)
     for alpha in range(3):
+        gamma_alpha = gamma
         if length is not None:
             if length[alpha] and length[alpha] != 0:
-                gamma = gamma + 2 * abs(velocity[:, alpha]) / length[alpha]
-        lambd_0[physical_mode, alpha] = 1 / gamma[physical_mode] * velocity[physical_mode, alpha]
+                gamma_alpha = gamma + 2 * abs(velocity[:, alpha]) / length[alpha]
+        lambd_0[physical_mode, alpha] = 1 / gamma_alpha[physical_mode] * velocity[physical_mode, alpha]
     return lambd_0
 
 
@@ -90,12 +563,27 @@ class Conductivity:
     is_diffusivity_including_antiresonant : bool, optional
         (QHGK) Defines if you want to include or not anti-resonant terms in diffusivity calculations.
         Default is `False`.
+    is_diffusivity_band_limited : bool, optional
+        (QHGK) Requires `diffusivity_threshold`. Only the pairs of modes within the threshold are stored, and the
+        flux operators are calculated one direction at a time on these pairs, so that memory scales with the number
+        of modes times the width of the band instead of the number of modes squared. Not available with the
+        anti-resonant terms.
+        Default is `False`.
     tolerance : int
         (Self-consistent) In the self consistent conductivity calculation, it specifies the difference in W/m/K between n
-        and n+1 step, to set as exit/convergence condition.
+        and n+1 step, to set as exit/convergence condition. Each diagonal component of the conductivity needs to be
+        converged.
     n_iterations : int
         (Self-consistent) Specifies the max number of iterations to set as exit condition in the self consistent conductivity
         calculation
+    anderson_depth : int, optional
+        (Self-consistent) Number of previous iterations used by the Anderson acceleration of the self consistent
+        calculation. 0 corresponds to the plain iteration.
+        Default is 0
+    initial_mean_free_path : np.array, optional
+        (Self-consistent) (n_k_points, n_modes, 3) mean free path used as starting point of the self consistent
+        calculation, i.e. the `mean_free_path` of a calculation at a nearby temperature or length. Default is `None`,
+        which starts from zero
     length: (3) tuple
         (Finite Size) Specifies the length to use in x, y, z to calculate the finite size conductivity. 0 or None values
         corresponds to the infinity length limit.
@@ -104,6 +592,26 @@ class Conductivity:
     storage : 'formatted', 'hdf5', 'numpy', 'memory', optional
         Defines the type of storage used for the simulation.
         Default is `formatted`
+    n_workers : int, optional
+        (QHGK) Number of processes used to loop over the k points. Default is the value of the phonons object
+    n_blas_threads : int, optional
+        (QHGK) Number of BLAS and tensorflow threads in each worker. Default is the value of the phonons object
+    parallel_backend : 'processes', 'threads', optional
+        (QHGK) How the k points are distributed on the n_workers. Each worker writes its k points directly in the
+        preallocated conductivity and diffusivity arrays. Default is the value of the phonons object
+    solver : 'direct', 'cholesky', 'cg', optional
+        (Inverse) Specifies how the linearized BTE is solved. 'direct' uses the LU factorization of the scattering
+        matrix, 'cholesky' the Cholesky factorization of the scattering matrix symmetrized through the population
+        rescaling. Both factorizations are calculated once, solving all the directions together, and cached.
+        'cg' uses the conjugate gradient on the symmetrized scattering matrix, preconditioned with the RTA
+        bandwidths, which only needs matrix-vector products with the scattering tensor stored as compressed rows.
+        Residuals and conductivity are logged at each iteration.
+        Default is `direct`
+    solver_tolerance : float, optional
+        (Inverse) Relative residual used as convergence condition of the 'cg' solver. Default is 1e-8
+    solver_max_iterations : int, optional
+        (Inverse) Maximum number of iterations of the 'cg' solver, independent of n_iterations. Default is `None`,
+        which corresponds to the number of physical modes
 
     Returns
     -------
@@ -133,6 +641,8 @@ class Conductivity:
         self.length = kwargs.pop('length', np.array([None, None, None]))
         self.finite_length_method = kwargs.pop('finite_length_method', 'ms')
         self.tolerance = kwargs.pop('tolerance', None)
+        self.anderson_depth = kwargs.pop('anderson_depth', 0)
+        self.initial_mean_free_path = kwargs.pop('initial_mean_free_path', None)
         self.folder = self.phonons.folder
         self.kpts = self.phonons.kpts
         self.n_k_points = self.phonons.n_k_points
@@ -141,14 +651,29 @@ class Conductivity:
         self.temperature = self.phonons.temperature
         self.is_classic = self.phonons.is_classic
         self.third_bandwidth = self.phonons.third_bandwidth
+        self.frequency_window = self.phonons.frequency_window
 
         self.diffusivity_bandwidth = kwargs.pop('diffusivity_bandwidth', None)
         self.diffusivity_threshold = kwargs.pop('diffusivity_threshold', None)
         self.is_diffusivity_including_antiresonant = kwargs.pop('is_diffusivity_including_antiresonant', False)
         self.diffusivity_shape = kwargs.pop('diffusivity_shape', 'lorentz')
-
-
-    @lazy_property(label='<diffusivity_bandwidth>/<diffusivity_threshold>/<temperature>/<statistics>/<third_bandwidth>/<method>/<length>/<finite_length_method>')
+        self.is_diffusivity_band_limited = kwargs.pop('is_diffusivity_band_limited', False)
+        if self.is_diffusivity_band_limited:
+            if self.diffusivity_threshold is None:
+                logging.error('The band limited diffusivity requires diffusivity_threshold')
+                raise ValueError('The band limited diffusivity requires diffusivity_threshold')
+            if self.is_diffusivity_including_antiresonant:
+                logging.error('The band limited diffusivity does not include the anti-resonant terms')
+                raise ValueError('The band limited diffusivity does not include the anti-resonant terms')
+        self.n_workers = kwargs.pop('n_workers', self.phonons.n_workers)
+        self.n_blas_threads = kwargs.pop('n_blas_threads', self.phonons.n_blas_threads)
+        self.parallel_backend = kwargs.pop('parallel_backend', self.phonons.parallel_backend)
+        self.solver = kwargs.pop('solver', 'direct')
+        self.solver_tolerance = kwargs.pop('solver_tolerance', DEFAULT_SOLVER_TOLERANCE)
+        self.solver_max_iterations = kwargs.pop('solver_max_iterations', None)
+
+
+    @lazy_property(label='<diffusivity_bandwidth>/<diffusivity_threshold>/<temperature>/<statistics>/<third_bandwidth>/<method>/<length>/<finite_length_method>/<solver>')
     def conductivity(self):
         """Calculate the thermal conductivity per mode in W/m/K
 
@@ -184,7 +709,7 @@ class Conductivity:
         return cond.real
 
 
-    @lazy_property(label='<diffusivity_bandwidth>/<diffusivity_threshold>/<temperature>/<statistics>/<third_bandwidth>/<method>/<length>/<finite_length_method>')
+    @lazy_property(label='<diffusivity_bandwidth>/<diffusivity_threshold>/<temperature>/<statistics>/<third_bandwidth>/<method>/<length>/<finite_length_method>/<solver>')
     def mean_free_path(self):
         """Calculate the mean_free_path per mode in A
 
@@ -230,30 +755,92 @@ class Conductivity:
             logging.info('You need to calculate the conductivity QHGK first.')
 
 
+    @property
+    def _scattering_factorizations(self):
+        """Factorizations of the scattering matrix, by solver and boundary scattering, shared by the lengths of this
+        Conductivity object, see _calculate_mfp_factorized and clear_scattering_cache."""
+        try:
+            return self._scattering_factorizations_dict
+        except AttributeError:
+            self._scattering_factorizations_dict = {}
+            return self._scattering_factorizations_dict
+
+
+    def clear_scattering_cache(self):
+        """Release the factorizations of the scattering matrix kept in memory by the inverse solvers. They are
+        calculated again when needed."""
+        if hasattr(self, '_scattering_factorizations_dict'):
+            del self._scattering_factorizations_dict
+
+
     def calculate_scattering_matrix(self,
                                     is_including_diagonal,
                                     is_rescaling_omega,
                                     is_rescaling_population):
-        physical_mode = self.phonons.physical_mode.reshape((self.n_phonons))
-        frequency = self.phonons.frequency.reshape((self.n_phonons))[physical_mode]
-        gamma_tensor = -1 * self.phonons._ps_gamma_and_gamma_tensor[:, 2:]
-        index = np.outer(physical_mode, physical_mode)
-        n_physical = physical_mode.sum()
+        """Calculate the scattering matrix of the physical modes. The physical block of the scattering tensor of
+        Phonons is copied once and rescaled in place, so the memory used is the (n_phonons, n_phonons + 2) tensor
+        plus a single (n_physical, n_physical) array, the returned one. It's a new array at each call, which can be
+        modified by the caller.
+
+        Returns
+        -------
+        scattering_matrix : np.array
+            (n_physical, n_physical) float
+        """
+        physical_index = self.phonons._physical_index
+        n_physical = physical_index.shape[0]
+        left, right = self._calculate_scattering_rescaling(is_rescaling_omega, is_rescaling_population)
         log_size((n_physical, n_physical), np.float, name='_scattering_matrix')
-        gamma_tensor = gamma_tensor[index].reshape((n_physical, n_physical))
+        gamma_tensor = self.phonons._ps_gamma_and_gamma_tensor[np.ix_(physical_index, physical_index + 2)]
+        gamma_tensor *= -left[:, np.newaxis]
+        gamma_tensor *= right[np.newaxis, :]
         if is_rescaling_population:
-            n = self.phonons.population.reshape((self.n_phonons))[physical_mode]
-            gamma_tensor = np.einsum('a,ab,b->ab', ((n * (n + 1))) ** (1/2), gamma_tensor,
-                                         1 / ((n * (n + 1)) ** (1/2)))
-            logging.info('Asymmetry of gamma_tensor: ' + str(np.abs(gamma_tensor - gamma_tensor.T).sum()))
+            logging.info('Asymmetry of gamma_tensor: ' + str(calculate_asymmetry(gamma_tensor)))
         if is_including_diagonal:
-            gamma = self.phonons.bandwidth.reshape((self.n_phonons))[physical_mode]
-            gamma_tensor = gamma_tensor + np.diag(gamma)
-        if is_rescaling_omega:
-            gamma_tensor = 1 / (frequency.reshape(-1, 1)) * gamma_tensor * (frequency.reshape(1, -1))
+            # The rescalings leave the diagonal unchanged
+            gamma = self.phonons.bandwidth.reshape((self.n_phonons))[self.phonons._physical_index]
+            gamma_tensor[np.diag_indices(n_physical)] += gamma
         return gamma_tensor
 
 
+    def calculate_scattering_operator(self,
+                                      is_including_diagonal,
+                                      is_rescaling_omega,
+                                      is_rescaling_population):
+        """Matrix-free version of calculate_scattering_matrix, with the same options. The scattering tensor of the
+        physical modes is stored by Phonons as compressed rows, and shared by all the operators, which only differ
+        in the rescaling vectors. No n_physical x n_physical array is built.
+
+        Returns
+        -------
+        scattering_operator : ScatteringOperator
+            (n_physical, n_physical) linear operator
+        """
+        scattering_rows = self.phonons._physical_scattering_rows
+        left, right = self._calculate_scattering_rescaling(is_rescaling_omega, is_rescaling_population)
+        diagonal = None
+        if is_including_diagonal:
+            # The rescalings leave the diagonal unchanged
+            diagonal = self.phonons.bandwidth.reshape((self.n_phonons))[self.phonons._physical_index]
+        return ScatteringOperator(scattering_rows, left, right, diagonal)
+
+
+    def _calculate_scattering_rescaling(self, is_rescaling_omega, is_rescaling_population):
+        # Rescaling of rows and columns of the scattering matrix of the physical modes
+        physical_index = self.phonons._physical_index
+        left = np.ones(physical_index.shape[0])
+        right = np.ones(physical_index.shape[0])
+        if is_rescaling_population:
+            n = self.phonons.population.reshape((self.n_phonons))[physical_index]
+            left = left * (n * (n + 1)) ** (1 / 2)
+            right = right / (n * (n + 1)) ** (1 / 2)
+        if is_rescaling_omega:
+            frequency = self.phonons.frequency.reshape((self.n_phonons))[physical_index]
+            left = left / frequency
+            right = right * frequency
+        return left, right
+
+
     def calculate_conductivity_qhgk(self):
         """Calculates the conductivity of each mode using the :ref:'Quasi-Harmonic-Green-Kubo Model'.
         The tensor is returned individual modes along the first axis and has units of W/m/K.
@@ -268,8 +855,163 @@ class Conductivity:
         volume = np.linalg.det(phonons.atoms.cell)
         q_points = phonons._reciprocal_grid.unitary_grid(is_wrapping=False)
         physical_mode = phonons.physical_mode
-        conductivity_per_mode = np.zeros((self.phonons.n_k_points, self.phonons.n_modes, 3, 3))
-        diffusivity_with_axis = np.zeros_like(conductivity_per_mode)
+        curve = self._diffusivity_curve()
+        is_diffusivity_including_antiresonant = self.is_diffusivity_including_antiresonant
+        diffusivity_bandwidth = self._calculate_diffusivity_bandwidth(self.diffusivity_bandwidth)
+
+        # if self.diffusivity_threshold is None:
+        logging.info('Start calculation diffusivity')
+        kelvintothz = units.kB / units.J / (2 * np.pi * phonons.hbar) * 1e-12
+        calculate = partial(calculate_conductivity_qhgk_with_q,
+                            q_points=q_points,
+                            omega=omega,
+                            diffusivity_bandwidth=diffusivity_bandwidth,
+                            physical_mode=physical_mode,
+                            curve=curve,
+                            is_diffusivity_including_antiresonant=is_diffusivity_including_antiresonant,
+                            diffusivity_threshold=self.diffusivity_threshold,
+                            normalization=volume * phonons.n_k_points,
+                            harmonic_kwargs=self._qhgk_harmonic_kwargs(),
+                            frequency=phonons.frequency,
+                            population=phonons.population,
+                            heat_capacity=phonons.heat_capacity,
+                            temperature=self.temperature * kelvintothz,
+                            eigenvectors=self._qhgk_eigenvectors(),
+                            is_band_limited=self.is_diffusivity_band_limited)
+        shape = (phonons.n_modes, 3, 3)
+        conductivity_per_mode, diffusivity_with_axis = parallel_map(calculate, np.arange(len(q_points)),
+                                                                    [shape, shape],
+                                                                    n_workers=self.n_workers,
+                                                                    n_blas_threads=self.n_blas_threads,
+                                                                    backend=self.parallel_backend)
+        self._diffusivity = 1 / 3 * 1 / 100 * contract('knaa->kn', diffusivity_with_axis)
+        return conductivity_per_mode * 1e22
+
+
+    def calculate_qhgk_sweep(self, temperatures=None, diffusivity_bandwidths=None):
+        """Calculate the QHGK conductivity for many temperatures and diffusivity bandwidths at once. The flux
+        operators of each k point are calculated once, the diffusivity kernel once for each bandwidth and the
+        generalized heat capacity once for each temperature.
+
+        Parameters
+        ----------
+        temperatures : np.array, optional
+            (n_temperatures) temperatures in K. Default is the temperature of the phonons object
+        diffusivity_bandwidths : list, optional
+            (n_bandwidths) diffusivity bandwidths in rad/ps. A `None` element uses half of the phonons bandwidth,
+            calculated at the temperature of the phonons object. Default is the diffusivity_bandwidth of this object
+
+        Returns
+        -------
+        conductivity : np.array
+            (n_temperatures, n_bandwidths, 3, 3) float, conductivity summed over the modes in W/m/K
+        """
+        if self.is_diffusivity_band_limited:
+            logging.error('The QHGK sweep is not available with the band limited diffusivity')
+            raise ValueError('The QHGK sweep is not available with the band limited diffusivity')
+        phonons = self.phonons
+        if temperatures is None:
+            temperatures = [self.temperature]
+        if diffusivity_bandwidths is None:
+            diffusivity_bandwidths = [self.diffusivity_bandwidth]
+        kelvintothz = units.kB / units.J / (2 * np.pi * phonons.hbar) * 1e-12
+        temperatures = np.array(temperatures, dtype=float) * kelvintothz
+        frequency = phonons.frequency
+        physical_mode = phonons.physical_mode
+        population = np.array([calculate_population(frequency, physical_mode, temperature)
+                               for temperature in temperatures])
+        heat_capacity = np.array([calculate_heat_capacity(frequency, population[i], physical_mode, temperature)
+                                  for i, temperature in enumerate(temperatures)])
+        diffusivity_bandwidth = np.array([self._calculate_diffusivity_bandwidth(bandwidth)
+                                          for bandwidth in diffusivity_bandwidths])
+        q_points = phonons._reciprocal_grid.unitary_grid(is_wrapping=False)
+        calculate = partial(calculate_qhgk_sweep_with_q,
+                            q_points=q_points,
+                            omega=phonons.omega.reshape((phonons.n_k_points, phonons.n_modes)),
+                            diffusivity_bandwidth=diffusivity_bandwidth,
+                            physical_mode=physical_mode,
+                            curve=self._diffusivity_curve(),
+                            is_diffusivity_including_antiresonant=self.is_diffusivity_including_antiresonant,
+                            diffusivity_threshold=self.diffusivity_threshold,
+                            normalization=np.linalg.det(phonons.atoms.cell) * phonons.n_k_points,
+                            harmonic_kwargs=self._qhgk_harmonic_kwargs(),
+                            frequency=frequency,
+                            population=population,
+                            heat_capacity=heat_capacity,
+                            temperature=temperatures,
+                            eigenvectors=self._qhgk_eigenvectors())
+        shape = (temperatures.shape[0], diffusivity_bandwidth.shape[0], 3, 3)
+        conductivity = parallel_map(calculate, np.arange(len(q_points)), [shape], n_workers=self.n_workers,
+                                    n_blas_threads=self.n_blas_threads, backend=self.parallel_backend)[0]
+        return conductivity.sum(axis=0) * 1e22
+
+
+    def calculate_cumulative_conductivity(self, quantity='frequency'):
+        """Calculate the cumulative conductivity of each mode, versus frequency or mean free path, in O(N log N).
+
+        Parameters
+        ----------
+        quantity : 'frequency', 'mean_free_path', optional
+            Default is 'frequency'
+
+        Returns
+        -------
+        cumulative_conductivity : np.array
+            (n_phonons, 3, 3) float, conductivity of the modes with lower frequency or mean free path, in W/m/K
+        """
+        return cumulate_conductivity(self._calculate_accumulation_values(quantity), self._conductivity_of_modes())
+
+
+    def calculate_spectral_conductivity(self, bins, quantity='frequency'):
+        """Calculate the conductivity of the modes in each bin of frequency or mean free path.
+
+        Parameters
+        ----------
+        bins : np.array
+            (n_bins + 1) edges of the bins, in THz or Angstrom
+        quantity : 'frequency', 'mean_free_path', optional
+            Default is 'frequency'
+
+        Returns
+        -------
+        spectral_conductivity : np.array
+            (n_bins, 3, 3) float, in W/m/K
+        """
+        return bin_conductivity(self._calculate_accumulation_values(quantity), self._conductivity_of_modes(), bins)
+
+
+    def _conductivity_of_modes(self):
+        """Function that returns the conductivity of an array of mode indices, in W/m/K. For rta, sc and inverse it's
+        calculated from the mean free path of those modes only, so that the accumulations never allocate the
+        (n_phonons, 3, 3) conductivity. For the other methods the conductivity property is used."""
+        if self.method not in ('rta', 'sc', 'inverse'):
+            return self.conductivity.reshape((self.n_phonons, 3, 3)).__getitem__
+        phonons = self.phonons
+        heat_capacity = phonons.heat_capacity.reshape(self.n_phonons)
+        velocity = phonons.velocity.reshape((self.n_phonons, 3))
+        mean_free_path = self.mean_free_path.reshape((self.n_phonons, 3))
+        physical_mode = phonons.physical_mode.reshape(self.n_phonons)
+        volume = np.linalg.det(phonons.atoms.cell)
+
+        def conductivity_of_modes(modes):
+            # Same as the conductivity property, restricted to modes
+            conductivity = calculate_conductivity_per_mode(heat_capacity[modes], velocity[modes],
+                                                           mean_free_path[modes], physical_mode[modes], len(modes))
+            return (conductivity / (volume * self.n_k_points)).real
+
+        return conductivity_of_modes
+
+
+    def _calculate_accumulation_values(self, quantity):
+        if quantity == 'frequency':
+            return self.phonons.frequency.reshape(self.n_phonons)
+        if quantity == 'mean_free_path':
+            return np.linalg.norm(self.mean_free_path.reshape((self.n_phonons, 3)), axis=-1)
+        logging.error('Accumulation not available for ' + str(quantity))
+        raise ValueError('Accumulation not available for ' + str(quantity))
+
+
+    def _diffusivity_curve(self):
         if self.diffusivity_shape == 'lorentz':
             logging.info('Using Lorentzian diffusivity_shape')
             curve = lorentz_delta
@@ -281,58 +1023,33 @@ class Conductivity:
             curve = triangular_delta
         else:
             logging.error('Diffusivity shape not implemented')
+        return curve
 
-        is_diffusivity_including_antiresonant = self.is_diffusivity_including_antiresonant
 
-        if self.diffusivity_bandwidth is not None:
+    def _calculate_diffusivity_bandwidth(self, diffusivity_bandwidth):
+        phonons = self.phonons
+        if diffusivity_bandwidth is not None:
             logging.info('Using diffusivity bandwidth from input')
-            diffusivity_bandwidth = self.diffusivity_bandwidth * np.ones((phonons.n_k_points, phonons.n_modes))
-        else:
-            diffusivity_bandwidth = self.phonons.bandwidth.reshape((phonons.n_k_points, phonons.n_modes)).copy() / 2.
+            return diffusivity_bandwidth * np.ones((phonons.n_k_points, phonons.n_modes))
+        return phonons.bandwidth.reshape((phonons.n_k_points, phonons.n_modes)).copy() / 2.
 
-        # if self.diffusivity_threshold is None:
-        logging.info('Start calculation diffusivity')
 
-        for k_index in range(len(q_points)):
-
-            phonon = HarmonicWithQTemp(q_point=q_points[k_index],
-                                       second=self.phonons.forceconstants.second,
-                                       distance_threshold=self.phonons.forceconstants.distance_threshold,
-                                       folder=self.folder,
-                                       storage=self.storage,
-                                       temperature=self.temperature,
-                                       is_classic=self.is_classic,
-                                       is_nw=self.phonons.is_nw,
-                                       is_unfolding=self.is_unfolding)
-            heat_capacity_2d = phonon.heat_capacity_2d
-            if phonons.n_modes > 100:
-                logging.info('calculating conductivity for q = ' + str(q_points[k_index]))
-            for alpha in range(3):
-                if alpha == 0:
-                    sij_left = phonon._sij_x
-                if alpha == 1:
-                    sij_left = phonon._sij_y
-                if alpha == 2:
-                    sij_left = phonon._sij_z
-                for beta in range(3):
-                    if beta == 0:
-                        sij_right = phonon._sij_x
-                    if beta == 1:
-                        sij_right = phonon._sij_y
-                    if beta == 2:
-                        sij_right = phonon._sij_z
-                    diffusivity = calculate_diffusivity(omega[k_index], sij_left, sij_right,
-                                                        diffusivity_bandwidth[k_index],
-                                                        physical_mode[k_index],
-                                                        curve,
-                                                        is_diffusivity_including_antiresonant,
-                                                        self.diffusivity_threshold)
-                    conductivity_per_mode[k_index, :, alpha, beta] = (np.sum(heat_capacity_2d *
-                                                                            diffusivity, axis=-1) \
-                                                                     / (volume * phonons.n_k_points)).real
-                    diffusivity_with_axis[k_index, :, alpha, beta] = np.sum(diffusivity, axis=-1).real
-        self._diffusivity = 1 / 3 * 1 / 100 * contract('knaa->kn', diffusivity_with_axis)
-        return conductivity_per_mode * 1e22
+    def _qhgk_harmonic_kwargs(self):
+        return dict(second=self.phonons.forceconstants.second,
+                    distance_threshold=self.phonons.forceconstants.distance_threshold,
+                    folder=self.folder,
+                    storage=self.storage,
+                    is_nw=self.phonons.is_nw,
+                    is_unfolding=self.is_unfolding,
+                    frequency_window=self.frequency_window,
+                    cache=self.phonons.harmonic_cache)
+
+
+    def _qhgk_eigenvectors(self):
+        # The Phonons eigenvectors are consistent with the flux operators only if the unfolding is the same
+        if self.is_unfolding == self.phonons.is_unfolding:
+            return self.phonons.eigenvectors
+        return None
 
 
     def calculate_mfp_inverse(self):
@@ -351,107 +1068,222 @@ class Conductivity:
         physical_mode = phonons.physical_mode.reshape(phonons.n_phonons)
         velocity = phonons.velocity.real.reshape((phonons.n_phonons, 3))
         lambd = np.zeros_like(velocity)
+        # The BTE is solved on the full mesh. Reducing it to the irreducible q points would need the eigenvectors at
+        # R q to be the rotated ones at q, which doesn't hold inside the degenerate subspaces
+        if self.solver == 'cg':
+            lambd[physical_mode] = self._calculate_mfp_conjugate_gradient(length)
+        elif self.solver in ('direct', 'cholesky'):
+            lambd[physical_mode] = self._calculate_mfp_factorized(length)
+        else:
+            logging.error('Solver not implemented: ' + str(self.solver))
+            raise ValueError('Solver not implemented: ' + str(self.solver))
         for alpha in range (3):
-            scattering_matrix = self.calculate_scattering_matrix(is_including_diagonal=False,
-                                                                 is_rescaling_omega=True,
-                                                                 is_rescaling_population=False)
-            gamma = phonons.bandwidth.reshape(phonons.n_phonons)
-            if finite_length_method == 'ms':
-                if length is not None:
-                    if length[alpha]:
-                        gamma = gamma + 2 * np.abs(velocity[:, alpha]) / length[alpha]
-
-
-            scattering_matrix += np.diag(gamma[physical_mode])
-            scattering_inverse = np.linalg.inv(scattering_matrix)
-            lambd[physical_mode, alpha] = scattering_inverse.dot(velocity[physical_mode, alpha])
             if finite_length_method == 'caltech':
                 if length is not None:
                     if length[alpha]:
                         lambd[:, alpha] = mfp_caltech(lambd[:, alpha], velocity[:, alpha], length[alpha], physical_mode)
             if finite_length_method == 'matthiessen':
                 if (self.length[alpha] is not None) and (self.length[alpha] != 0):
-
-                    for alpha in range(3):
-                        if (self.length[alpha] is not None) and (self.length[alpha] != 0):
-                            new_physical_modes = (lambd[physical_mode, alpha] != 0) & \
-                                                 (velocity[physical_mode, alpha]!=0)
-                            new_lambd = np.zeros(physical_mode.sum())
-                            new_lambd[new_physical_modes] = 1 / (
-                                        1 / lambd[physical_mode, alpha][new_physical_modes] +
-                                        np.sign(velocity[physical_mode, alpha][new_physical_modes]) /
-                                        np.array(self.length)[np.newaxis, alpha])
-                            lambd[physical_mode, alpha] = new_lambd
+                    new_physical_modes = (lambd[physical_mode, alpha] != 0) & \
+                                         (velocity[physical_mode, alpha]!=0)
+                    new_lambd = np.zeros(physical_mode.sum())
+                    new_lambd[new_physical_modes] = 1 / (
+                                1 / lambd[physical_mode, alpha][new_physical_modes] +
+                                np.sign(velocity[physical_mode, alpha][new_physical_modes]) /
+                                np.array(self.length)[np.newaxis, alpha])
+                    lambd[physical_mode, alpha] = new_lambd
 
             if finite_length_method == 'ballistic':
                 if (self.length[alpha] is not None) and (self.length[alpha] != 0):
-                    velocity = velocity[physical_mode, alpha]
-                    gamma_inv = np.zeros_like(velocity)
-                    gamma_inv[velocity != 0] = length[alpha] / (2 * np.abs(velocity[velocity != 0]))
-                    lambd[physical_mode, alpha] = np.diag(gamma_inv).dot(velocity)
+                    velocity_alpha = velocity[physical_mode, alpha]
+                    gamma_inv = np.zeros_like(velocity_alpha)
+                    gamma_inv[velocity_alpha != 0] = length[alpha] / (2 * np.abs(velocity_alpha[velocity_alpha != 0]))
+                    lambd[physical_mode, alpha] = gamma_inv * velocity_alpha
 
         return lambd
 
 
-    def calculate_lambda_tensor(self, alpha, scattering_inverse):
-        # TODO: replace with same caching strategy as rest of code
-        n_k_points = self.n_k_points
-        third_bandwidth = self.phonons.third_bandwidth
-        if self.phonons.is_classic:
-            stat_label = 'c'
+    def _calculate_gamma_with_length(self, alpha, length):
+        # Bandwidth along alpha, including the boundary scattering of the Mckelvey-Schockley method
+        phonons = self.phonons
+        gamma = phonons.bandwidth.reshape(phonons.n_phonons)
+        if self.finite_length_method == 'ms':
+            if length is not None:
+                if length[alpha]:
+                    velocity = phonons.velocity.real.reshape((phonons.n_phonons, 3))
+                    gamma = gamma + 2 * np.abs(velocity[:, alpha]) / length[alpha]
+        return gamma
+
+
+    def _calculate_mfp_factorized(self, length, is_caching=True):
+        """Solve the linearized BTE with a factorization of the scattering matrix, which is calculated once for all
+        the directions with the same boundary scattering and cached, see clear_scattering_cache. 'direct' uses the LU
+        factorization of the scattering matrix, 'cholesky' the Cholesky factorization of the symmetrized one, see
+        _calculate_mfp_conjugate_gradient.
+
+        Returns
+        -------
+        lambd : np.array
+            (n_physical, 3) mean free path of the physical modes
+        """
+        phonons = self.phonons
+        physical_mode = phonons.physical_mode.reshape(phonons.n_phonons)
+        velocity = phonons.velocity.real.reshape((phonons.n_phonons, 3))[physical_mode]
+        is_cholesky = (self.solver == 'cholesky')
+        if is_cholesky:
+            frequency = phonons.frequency.reshape(phonons.n_phonons)[physical_mode]
+            population = phonons.population.reshape(phonons.n_phonons)[physical_mode]
+            rescaling = (frequency * (population * (population + 1)) ** (1 / 2))[:, np.newaxis]
         else:
-            stat_label = 'q'
-        str_to_add = str(n_k_points) + '_' + str(alpha) + '_' + str(int(self.phonons.temperature)) + '_' + stat_label
-        lamdb_filename = 'lamdb_' + '_' + str_to_add
-        psi_filename = 'psi_' + str_to_add
-        psi_inv_filename = 'psi_inv_' + str_to_add
-        if third_bandwidth is not None:
-            lamdb_filename = lamdb_filename + '_' + str(third_bandwidth)
-            psi_filename = psi_filename + '_' + str(third_bandwidth)
-            psi_inv_filename = psi_inv_filename + '_' + str(third_bandwidth)
-
-        lamdb_filename = lamdb_filename + '.npy'
-        psi_filename = psi_filename + '.npy'
-        psi_inv_filename = psi_inv_filename + '.npy'
+            rescaling = np.ones((physical_mode.sum(), 1))
+        factorizations = self._scattering_factorizations
+        # Directions with the same bandwidth share the same matrix
+        directions = {}
+        for alpha in range(3):
+            boundary = None
+            if self.finite_length_method == 'ms' and length is not None and length[alpha]:
+                boundary = (alpha, length[alpha])
+            directions.setdefault((self.solver, boundary), []).append(alpha)
+        lambd = np.zeros_like(velocity)
+        for key, alphas in directions.items():
+            factorization = factorizations.get(key)
+            if factorization is None:
+                # A new rescaled matrix, which is overwritten by the factorization
+                matrix = self.calculate_scattering_matrix(is_including_diagonal=False,
+                                                          is_rescaling_omega=not is_cholesky,
+                                                          is_rescaling_population=is_cholesky)
+                if is_cholesky:
+                    symmetrize_matrix(matrix)
+                gamma = self._calculate_gamma_with_length(alphas[0], length)[physical_mode]
+                matrix[np.diag_indices_from(matrix)] += gamma
+                factorization = factorize_scattering_matrix(matrix, is_cholesky)
+                if is_caching:
+                    factorizations[key] = factorization
+            rescaled_lambd = solve_factorized(factorization, rescaling * velocity[:, alphas])
+            lambd[:, alphas] = rescaled_lambd / rescaling
+        return lambd
+
+
+    def _calculate_mfp_conjugate_gradient(self, length):
+        """Solve the linearized BTE for the three directions with the conjugate gradient. The scattering matrix
+        rescaled by the populations, S, is symmetric and, calling m = omega (n (n + 1))^(1/2),
+        (S + gamma) m lambda = m v is equivalent to the equation solved by the inverse method.
+
+        Returns
+        -------
+        lambd : np.array
+            (n_physical, 3) mean free path of the physical modes
+        """
+        phonons = self.phonons
+        physical_mode = phonons.physical_mode.reshape(phonons.n_phonons)
+        velocity = phonons.velocity.real.reshape((phonons.n_phonons, 3))[physical_mode]
+        heat_capacity = phonons.heat_capacity.reshape(phonons.n_phonons)[physical_mode]
+        frequency = phonons.frequency.reshape(phonons.n_phonons)[physical_mode]
+        population = phonons.population.reshape(phonons.n_phonons)[physical_mode]
+        scattering_operator = self.calculate_scattering_operator(is_including_diagonal=False,
+                                                                 is_rescaling_omega=False,
+                                                                 is_rescaling_population=True)
+        gamma = np.stack([self._calculate_gamma_with_length(alpha, length)[physical_mode] for alpha in range(3)],
+                         axis=1)
+        rescaling = (frequency * (population * (population + 1)) ** (1 / 2))[:, np.newaxis]
+        volume = np.linalg.det(phonons.atoms.cell)
+        residuals = []
+
+        def report(iteration, rescaled_lambd, relative_residual):
+            conductivity = np.sum(heat_capacity[:, np.newaxis] * velocity * rescaled_lambd / rescaling, axis=0) \
+                           / (volume * phonons.n_k_points) * 1e22
+            logging.info('Conjugate gradient iteration ' + str(iteration) + ', residual: ' + str(relative_residual)
+                         + ', conductivity: ' + str(conductivity))
+            residuals.append(relative_residual)
+
+        def matvec(x):
+            return scattering_operator.symmetric_dot(x) + gamma * x
+
+        rescaled_lambd, relative_residual = solve_conjugate_gradient(matvec,
+                                                                     rescaling * velocity,
+                                                                     1 / gamma,
+                                                                     tolerance=self.solver_tolerance,
+                                                                     n_iterations=self.solver_max_iterations,
+                                                                     callback=report)
+        if (relative_residual >= self.solver_tolerance).any():
+            logging.warning('Conjugate gradient not converged, residual: ' + str(relative_residual))
+        self.solver_residuals = np.array(residuals)
+        return rescaled_lambd / rescaling
+
+
+    @lazy_property(label='<temperature>/<statistics>/<third_bandwidth>')
+    def _lambda_eigensystem(self):
+        """Calculate the eigensystem of the space-dependent BTE, for each direction. It doesn't depend on the length,
+        so it's shared by the full calculations at different lengths.
+
+        Returns
+        -------
+        _lambda_eigensystem : np.array
+            (3, n_physical + 1, n_physical) float, eigenvalues in the first row and eigenvectors in the columns
+        """
+        return self.calculate_lambda_eigensystem()
+
+
+    def calculate_lambda_eigensystem(self):
+        """Solve the generalized symmetric eigenproblem v_alpha x = lambda S x, where v_alpha is the diagonal matrix
+        of the velocities and S is the scattering matrix symmetrized through the population rescaling. The
+        eigenvectors are normalized as x^T S x = 1, so that the eigenvectors of the non symmetric operator
+        C^(1/2) v_alpha S^(-1) C^(-1/2) are psi = C^(1/2) S x and their inverse is x^T C^(-1/2), without any
+        inversion. When S is not positive definite, the problem is projected on the positive eigenvectors of S.
 
+        Returns
+        -------
+        lambda_eigensystem : np.array
+            (3, n_physical + 1, n_physical) float, eigenvalues in the first row and eigenvectors in the columns
+        """
+        n_phonons = self.n_phonons
+        physical_mode = self.phonons.physical_mode.reshape(n_phonons)
+        velocity = self.phonons.velocity.real.reshape((n_phonons, 3))[physical_mode, :]
+        gamma_tensor = self.calculate_scattering_matrix(is_including_diagonal=True,
+                                                        is_rescaling_omega=False,
+                                                        is_rescaling_population=True)
+        symmetrize_matrix(gamma_tensor)
+        n_physical = gamma_tensor.shape[0]
+        log_size((3, n_physical + 1, n_physical), np.float, name='lambda_eigensystem')
+        lambda_eigensystem = np.zeros((3, n_physical + 1, n_physical))
         try:
-            self._lambd = np.load(lamdb_filename, allow_pickle=True)
-            self._psi = np.load(psi_filename, allow_pickle=True)
-            self._psi_inv = np.load(psi_inv_filename, allow_pickle=True)
-        except FileNotFoundError as err:
-            logging.info(err)
-            n_phonons = self.n_phonons
-            physical_mode = self.phonons.physical_mode.reshape(n_phonons)
-            velocity = self.phonons.velocity.real.reshape((n_phonons, 3))[physical_mode, :]
-            heat_capacity = self.phonons.heat_capacity.flatten()[physical_mode]
-            sqr_heat_capacity = heat_capacity ** 0.5
-
-            v_new = velocity[:, alpha]
-            lambd_tensor = contract('m,m,mn,n->mn', sqr_heat_capacity,
-                                                     v_new,
-                                                     scattering_inverse,
-                                                     1 / sqr_heat_capacity)
-
-            # evals and evect equations
-            # lambd_tensor = psi.dot(np.diag(lambd)).dot(psi_inv)
-            # lambd_tensor.dot(psi) = psi.dot(np.diag(lambd))
-
-            self._lambd, self._psi = np.linalg.eig(lambd_tensor)
-            self._psi_inv = np.linalg.inv(self._psi)
-            np.save(lamdb_filename, self._lambd)
-            np.save(psi_filename, self._psi)
-            np.save(psi_inv_filename, self._psi_inv)
-
-
-
-    def calculate_conductivity_full(self, is_using_gamma_tensor_evects=False):
+            cho_factor(gamma_tensor)
+            projection = None
+        except np.linalg.LinAlgError:
+            evals, evects = eigh(gamma_tensor)
+            logging.warning('negative eigenvals : ' + str((evals <= 0).sum()) + ', projecting them out')
+            is_positive = evals > 0
+            # S^(-1/2) restricted to the positive eigenvectors
+            projection = evects[:, is_positive] / np.sqrt(evals[is_positive])
+        for alpha in range(3):
+            if projection is None:
+                lambd, evects = eigh(np.diag(velocity[:, alpha]), gamma_tensor)
+            else:
+                reduced_lambd, reduced_evects = eigh(projection.T.dot(velocity[:, alpha, np.newaxis] * projection))
+                lambd = np.zeros(n_physical)
+                evects = np.zeros((n_physical, n_physical))
+                lambd[:reduced_lambd.shape[0]] = reduced_lambd
+                evects[:, :reduced_lambd.shape[0]] = projection.dot(reduced_evects)
+            lambda_eigensystem[alpha, 0] = lambd
+            lambda_eigensystem[alpha, 1:] = evects
+        return lambda_eigensystem
+
+
+    def calculate_conductivity_full(self, is_using_gamma_tensor_evects=None):
         """This calculates the conductivity using the full solution of the space-dependent Boltzmann Transport Equation.
 
+        Parameters
+        ----------
+        is_using_gamma_tensor_evects : bool, optional
+            Deprecated and ignored, the eigensystem of the symmetrized scattering matrix is always used
+
         Returns
 	    -------
         conductivity_per_mode : np array
             (n_k_points, n_modes, 3)
         """
+        if is_using_gamma_tensor_evects is not None:
+            logging.warning('is_using_gamma_tensor_evects is deprecated and ignored')
         length = self.length
         n_phonons = self.n_phonons
         n_k_points = self.n_k_points
@@ -459,59 +1291,131 @@ class Conductivity:
         physical_mode = self.phonons.physical_mode.reshape(n_phonons)
         velocity = self.phonons.velocity.real.reshape((n_phonons, 3))[physical_mode, :]
         heat_capacity = self.phonons.heat_capacity.flatten()[physical_mode]
-        gamma_tensor = self.calculate_scattering_matrix(is_including_diagonal=True,
-                                                        is_rescaling_omega=False,
-                                                        is_rescaling_population=True)
-
-        neg_diag = (gamma_tensor.diagonal() < 0).sum()
-        logging.info('negative on diagonal : ' + str(neg_diag))
-        log_size(gamma_tensor.shape, name='scattering_inverse')
-        if is_using_gamma_tensor_evects:
-            evals, evects = np.linalg.eigh(gamma_tensor)
-            logging.info('negative eigenvals : ' + str((evals < 0).sum()))
-            new_physical_states = np.argwhere(evals >= 0)[0, 0]
-            reduced_evects = evects[new_physical_states:, new_physical_states:]
-            reduced_evals = evals[new_physical_states:]
-            scattering_inverse = np.zeros_like(gamma_tensor)
-            scattering_inverse[new_physical_states:, new_physical_states:] = reduced_evects.dot(
-                np.diag(1 / reduced_evals)).dot((reduced_evects.T))
-        else:
-            scattering_inverse = np.linalg.inv(gamma_tensor)
+        sqr_heat_capacity = heat_capacity ** 0.5
+        lambda_eigensystem = self._lambda_eigensystem
         full_cond = np.zeros((n_phonons, 3, 3))
         for alpha in range(3):
-            self.calculate_lambda_tensor(alpha, scattering_inverse)
-            forward_states = self._lambd > 0
-            lambd_p = self._lambd[forward_states]
-            only_lambd_plus = self._lambd.copy()
-            only_lambd_plus[self._lambd < 0] = 0
-            lambd_tilde = only_lambd_plus
-            new_lambd = np.zeros_like(lambd_tilde)
-            # using average
-            # exp_tilde[self._lambd>0] = (length[alpha] + lambd_p * (-1 + np.exp(-length[alpha] / (lambd_p)))) * lambd_p/length[alpha]
+            lambd = lambda_eigensystem[alpha, 0]
+            evects = lambda_eigensystem[alpha, 1:]
+            forward_states = lambd > 0
+            lambd_p = lambd[forward_states]
+            # Only the forward states contribute, lambd_tilde / lambd is the suppression due to the length
+            suppression = np.ones_like(lambd_p)
             if length is not None:
                 if length[alpha]:
-                    leng = np.zeros_like(self._lambd)
-                    leng[:] = length[alpha]
-                    leng[self._lambd < 0] = 0
-                    new_lambd[self._lambd > 0] = (1 - np.exp(-length[alpha] / (lambd_p))) * lambd_p
-                    # exp_tilde[lambd<0] = (1 - np.exp(-length[0] / (-lambd_m))) * lambd_m
-                else:
-                    new_lambd[self._lambd > 0] = lambd_p
-            else:
-                new_lambd[self._lambd > 0] = lambd_p
-            lambd_tilde = new_lambd
+                    suppression = 1 - np.exp(-length[alpha] / lambd_p)
+            # psi = C^(1/2) S x, and S x = v_alpha x / lambda for the forward states
+            psi = sqr_heat_capacity[:, np.newaxis] * velocity[:, alpha, np.newaxis] * evects[:, forward_states]
             for beta in range(3):
-                cond = 2 * contract('nl,l,lk,k,k->n',
-                                self._psi,
-                                lambd_tilde,
-                                self._psi_inv,
-                                heat_capacity,
-                                velocity[:, beta],
-                                )
-                full_cond[physical_mode, alpha, beta] = cond
+                projection = evects[:, forward_states].T.dot(sqr_heat_capacity * velocity[:, beta])
+                full_cond[physical_mode, alpha, beta] = 2 * psi.dot(suppression * projection)
         return full_cond / (volume * n_k_points) * 1e22
 
 
+    def calculate_conductivity_vs_length(self, lengths):
+        """Calculate the thermal conductivity for many lengths at once, reusing the length independent part of the
+        calculation. For the 'full' method a single eigendecomposition is used for all the lengths. For the
+        'caltech' and 'matthiessen' finite size methods, and for 'ms' with 'rta', the suppression of the mean free
+        path is applied analytically to all the lengths. For 'ms' with 'sc' and 'inverse' the boundary scattering
+        enters the BTE, which is solved again for each length.
+
+        Parameters
+        ----------
+        lengths : np.array
+            (n_lengths) or (n_lengths, 3) lengths in Angstrom along x, y and z. A single length per row is used along
+            all the directions, and 0 corresponds to the infinite length limit
+
+        Returns
+        -------
+        conductivity : np.array
+            (n_lengths, 3, 3) float, conductivity summed over the modes in W/m/K
+        """
+        lengths = np.array(lengths, dtype=float)
+        if lengths.ndim == 1:
+            lengths = np.repeat(lengths[:, np.newaxis], 3, axis=1)
+        if self.method == 'full':
+            return self._calculate_full_conductivity_vs_length(lengths)
+        if self.method not in ('rta', 'sc', 'inverse'):
+            logging.error('Length sweep not available for ' + str(self.method))
+            raise ValueError('Length sweep not available for ' + str(self.method))
+        if self.finite_length_method not in ('ms', 'caltech', 'matthiessen'):
+            logging.error('Length sweep not available for ' + str(self.finite_length_method))
+            raise ValueError('Length sweep not available for ' + str(self.finite_length_method))
+        phonons = self.phonons
+        physical_mode = phonons.physical_mode.reshape(phonons.n_phonons)
+        velocity = phonons.velocity.real.reshape((phonons.n_phonons, 3))[physical_mode]
+        heat_capacity = phonons.heat_capacity.reshape(phonons.n_phonons)[physical_mode]
+        is_finite = lengths > 0
+        inverse_length = np.zeros_like(lengths)
+        inverse_length[is_finite] = 1 / lengths[is_finite]
+        if self.finite_length_method == 'ms' and self.method == 'rta':
+            gamma = phonons.bandwidth.reshape(phonons.n_phonons)[physical_mode]
+            lambd = velocity / (gamma[np.newaxis, :, np.newaxis]
+                                + 2 * np.abs(velocity)[np.newaxis, :, :] * inverse_length[:, np.newaxis, :])
+        elif self.finite_length_method == 'ms':
+            lambd = np.zeros((lengths.shape[0], ) + velocity.shape)
+            for index, length in enumerate(lengths):
+                logging.info('Solving the BTE for length ' + str(length))
+                length = [length_alpha if length_alpha > 0 else None for length_alpha in length]
+                if self.method == 'sc':
+                    lambd[index] = self._calculate_sc_mfp(matthiessen_length=length)[physical_mode]
+                elif self.solver == 'cg':
+                    lambd[index] = self._calculate_mfp_conjugate_gradient(length)
+                else:
+                    lambd[index] = self._calculate_mfp_factorized(length, is_caching=False)
+        else:
+            if self.method == 'inverse':
+                if self.solver == 'cg':
+                    bulk_lambd = self._calculate_mfp_conjugate_gradient(None)
+                else:
+                    bulk_lambd = self._calculate_mfp_factorized(None)
+            else:
+                bulk_lambd = self._calculate_sc_mfp()[physical_mode]
+            bulk_lambd = np.repeat(bulk_lambd[np.newaxis], lengths.shape[0], axis=0)
+            is_suppressed = is_finite[:, np.newaxis, :] & (velocity != 0)[np.newaxis, :, :] & (bulk_lambd != 0)
+            lambd = bulk_lambd.copy()
+            if self.finite_length_method == 'caltech':
+                half_length = np.broadcast_to(lengths[:, np.newaxis, :] / 2, lambd.shape)[is_suppressed]
+                abs_lambd = np.abs(bulk_lambd[is_suppressed])
+                lambd[is_suppressed] *= 1 - abs_lambd / half_length * (1 - np.exp(-half_length / abs_lambd))
+            else:
+                sign = np.broadcast_to(np.sign(velocity)[np.newaxis], lambd.shape)[is_suppressed]
+                suppressed_inverse_length = np.broadcast_to(inverse_length[:, np.newaxis, :],
+                                                            lambd.shape)[is_suppressed]
+                lambd[is_suppressed] = 1 / (1 / bulk_lambd[is_suppressed] + sign * suppressed_inverse_length)
+                # As in calculate_mfp_inverse and _calculate_mfp_sc, modes with zero velocity don't propagate
+                is_still = (velocity == 0)[np.newaxis, :, :]
+                if self.method == 'inverse':
+                    is_still = is_still & is_finite[:, np.newaxis, :]
+                lambd[np.broadcast_to(is_still, lambd.shape)] = 0
+        volume = np.linalg.det(phonons.atoms.cell)
+        conductivity = contract('n,na,lnb->lab', heat_capacity, velocity, lambd)
+        return conductivity / (volume * phonons.n_k_points) * 1e22
+
+
+    def _calculate_full_conductivity_vs_length(self, lengths):
+        # Same as calculate_conductivity_full, summed over the modes and vectorized over the lengths
+        phonons = self.phonons
+        physical_mode = phonons.physical_mode.reshape(phonons.n_phonons)
+        velocity = phonons.velocity.real.reshape((phonons.n_phonons, 3))[physical_mode, :]
+        sqr_heat_capacity = phonons.heat_capacity.flatten()[physical_mode] ** 0.5
+        lambda_eigensystem = self._lambda_eigensystem
+        conductivity = np.zeros((lengths.shape[0], 3, 3))
+        for alpha in range(3):
+            lambd = lambda_eigensystem[alpha, 0]
+            forward_states = lambd > 0
+            lambd_p = lambd[forward_states]
+            evects = lambda_eigensystem[alpha, 1:][:, forward_states]
+            suppression = np.ones((lengths.shape[0], lambd_p.shape[0]))
+            is_finite = lengths[:, alpha] > 0
+            suppression[is_finite] = 1 - np.exp(-lengths[is_finite, alpha, np.newaxis] / lambd_p[np.newaxis, :])
+            psi_sum = (sqr_heat_capacity * velocity[:, alpha]).dot(evects)
+            projection = evects.T.dot(sqr_heat_capacity[:, np.newaxis] * velocity)
+            conductivity[:, alpha, :] = 2 * (suppression * psi_sum).dot(projection)
+        volume = np.linalg.det(phonons.atoms.cell)
+        return conductivity / (volume * phonons.n_k_points) * 1e22
+
+
     def _calculate_mfp_sc(self):
         # TODO: rewrite this method as vector-vector multiplications instead of using the full inversion
         # in order to scale to higher k points meshes
@@ -527,7 +1431,9 @@ class Conductivity:
             lambd_n = self._calculate_sc_mfp()
         if finite_length_method == 'caltech':
             for alpha in range(3):
-                lambd_n[:, alpha] = mfp_caltech(lambd_n[:, alpha], velocity[:, alpha], self.length[alpha], physical_mode)
+                if (self.length[alpha] is not None) and (self.length[alpha] != 0):
+                    lambd_n[:, alpha] = mfp_caltech(lambd_n[:, alpha], velocity[:, alpha], self.length[alpha],
+                                                    physical_mode)
         if finite_length_method == 'matthiessen':
             mfp = lambd_n.copy()
             for alpha in range(3):
@@ -554,25 +1460,39 @@ class Conductivity:
             lambd_0 = mfp_matthiessen(gamma, velocity, matthiessen_length, physical_mode)
             return lambd_0
         else:
-            scattering_matrix = -1 * self.calculate_scattering_matrix(is_including_diagonal=False,
-                                                                      is_rescaling_omega=True,
-                                                                      is_rescaling_population=False)
+            scattering_operator = self.calculate_scattering_operator(is_including_diagonal=False,
+                                                                     is_rescaling_omega=True,
+                                                                     is_rescaling_population=False)
             gamma = phonons.bandwidth.reshape(phonons.n_phonons)
             lambd_0 = mfp_matthiessen(gamma, velocity, matthiessen_length, physical_mode)
             lambd_n = np.zeros_like(lambd_0)
-            avg_conductivity = None
+            if self.initial_mean_free_path is not None:
+                lambd_n[physical_mode, :] = np.array(self.initial_mean_free_path).reshape((phonons.n_phonons, 3))[
+                    physical_mode, :]
+            fixed_point_history = []
+            residual_history = []
+            diagonal_conductivity = None
             n_iteration = 0
             for n_iteration in range (n_iterations):
                 conductivity_per_mode = calculate_conductivity_per_mode(phonons.heat_capacity.reshape((phonons.n_phonons)),
                                                                         velocity, lambd_n, physical_mode, phonons.n_phonons)
-                new_avg_conductivity = np.diag (np.sum (conductivity_per_mode, 0)).mean ()
-                if avg_conductivity:
+                new_diagonal_conductivity = np.diag (np.sum (conductivity_per_mode, 0))
+                if diagonal_conductivity is not None:
                     if tolerance is not None:
-                        if np.abs (avg_conductivity - new_avg_conductivity) < tolerance:
+                        if (np.abs (diagonal_conductivity - new_diagonal_conductivity) < tolerance).all():
                             break
-                avg_conductivity = new_avg_conductivity
-                delta_lambd = 1 / phonons.bandwidth.reshape ((phonons.n_phonons))[physical_mode, np.newaxis] \
-                              * scattering_matrix.dot (lambd_n[physical_mode, :])
-                lambd_n[physical_mode, :] = lambd_0[physical_mode, :] + delta_lambd[:, :]
+                diagonal_conductivity = new_diagonal_conductivity
+                delta_lambd = -1 / phonons.bandwidth.reshape ((phonons.n_phonons))[physical_mode, np.newaxis] \
+                              * scattering_operator.dot (lambd_n[physical_mode, :])
+                fixed_point = lambd_0[physical_mode, :] + delta_lambd[:, :]
+                if self.anderson_depth > 0:
+                    fixed_point_history.append(fixed_point)
+                    residual_history.append(fixed_point - lambd_n[physical_mode, :])
+                    fixed_point_history = fixed_point_history[-(self.anderson_depth + 1):]
+                    residual_history = residual_history[-(self.anderson_depth + 1):]
+                    lambd_n[physical_mode, :] = calculate_anderson_mixing(fixed_point_history, residual_history)
+                else:
+                    lambd_n[physical_mode, :] = fixed_point
             logging.info('Number of self-consistent iterations: ' + str(n_iteration))
+            self.n_sc_iterations = n_iteration
             return lambd_n
@@ -78,7 +78,11 @@ def project_amorphous(phonons):
 
 
 @timeit
-def project_crystal(phonons):
+def project_crystal(phonons, scattering_rows=None):
+    """Calculate phase space and bandwidth of each mode and, if phonons.is_gamma_tensor_enabled, the scattering
+    tensor. When the scattering_rows list is given, the tensor is not allocated and the nonzero elements of each row
+    are appended to the list as (indices, values) instead.
+    """
     is_balanced = phonons.is_balanced
     is_gamma_tensor_enabled = phonons.is_gamma_tensor_enabled
     n_replicas = phonons.forceconstants.third.n_replicas
@@ -102,7 +106,7 @@ def project_crystal(phonons):
     evect_tf = tf.convert_to_tensor(phonons._rescaled_eigenvectors)
     evect_tf = tf.cast(evect_tf, dtype=tf.complex64)
     # The ps and gamma matrix stores ps, gamma and then the scattering matrix
-    if is_gamma_tensor_enabled:
+    if is_gamma_tensor_enabled and scattering_rows is None:
         shape = (phonons.n_phonons, 2 + phonons.n_phonons)
         log_size(shape, name='scattering_tensor')
         ps_and_gamma = np.zeros(shape)
@@ -123,6 +127,10 @@ def project_crystal(phonons):
             logging.info('Calculating third order projection ' + str(nu_single) +  ', ' + \
                          str(np.round(nu_single / phonons.n_phonons, 2) * 100) + '%')
         index_k, mu = np.unravel_index(nu_single, (n_k_points, phonons.n_modes))
+        if scattering_rows is not None:
+            gamma_tensor_row = np.zeros(phonons.n_phonons)
+        elif is_gamma_tensor_enabled:
+            gamma_tensor_row = ps_and_gamma[nu_single, 2:]
         if is_sparse:
             third_nu_tf = tf.sparse.sparse_dense_matmul(third_tf, evect_tf[index_k, :, mu, tf.newaxis])
         else:
@@ -194,18 +202,23 @@ def project_crystal(phonons):
                 nup_vec = index_kp_vec * phonons.n_modes + mup_vec
                 nupp_vec = index_kpp_vec * phonons.n_modes + mupp_vec
 
-                result = tf.math.bincount(nup_vec, pot_times_dirac, phonons.n_phonons)
+                result = tf.math.bincount(nup_vec, pot_times_dirac, phonons.n_phonons).numpy()
                 if is_plus:
-                    ps_and_gamma[nu_single, 2:] -= result
+                    gamma_tensor_row -= result
                 else:
-                    ps_and_gamma[nu_single, 2:] += result
+                    gamma_tensor_row += result
 
-                result = tf.math.bincount(nupp_vec, pot_times_dirac, phonons.n_phonons)
-                ps_and_gamma[nu_single, 2:] += result
+                result = tf.math.bincount(nupp_vec, pot_times_dirac, phonons.n_phonons).numpy()
+                gamma_tensor_row += result
             ps_and_gamma[nu_single, 0] += tf.reduce_sum(dirac_delta) / phonons.n_k_points
             ps_and_gamma[nu_single, 1] += tf.reduce_sum(pot_times_dirac)
         ps_and_gamma[nu_single, 1:] /= omega.flatten()[nu_single]
         ps_and_gamma[nu_single, 1:] *= np.pi * phonons.hbar / 4 / n_k_points * gamma_to_thz
+        if scattering_rows is not None:
+            nonzero = np.flatnonzero(gamma_tensor_row)
+            values = gamma_tensor_row[nonzero] / omega.flatten()[nu_single]
+            values *= np.pi * phonons.hbar / 4 / n_k_points * gamma_to_thz
+            scattering_rows.append((nonzero, values))
     return ps_and_gamma
 
 
@@ -0,0 +1,85 @@
+"""
+kaldo
+Anharmonic Lattice Dynamics
+"""
+import numpy as np
+from kaldo.phonons import Phonons
+from kaldo.conductivity import Conductivity
+from kaldo.helpers.cache import HarmonicCache
+from kaldo.helpers.logger import get_logger
+logging = get_logger()
+
+
+def extrapolate_conductivity(kpts, conductivity, order=1):
+    """Richardson extrapolation to the infinite mesh of the conductivity of the last two meshes, assuming an error
+    proportional to h ** order, where h = n_k_points ** (-1 / 3) is the mesh spacing.
+
+    Parameters
+    ----------
+    kpts : np.array
+        (n_meshes, 3) int, the meshes
+    conductivity : np.array
+        (n_meshes, ...) conductivity of each mesh
+    order : float, optional
+        order of the leading error. Default is 1
+
+    Returns
+    -------
+    extrapolated_conductivity : np.array
+        (...) conductivity in the infinite mesh limit
+    """
+    spacing = np.prod(np.array(kpts, dtype=float), axis=1) ** (-1 / 3)
+    weight = spacing[-2] ** order / (spacing[-2] ** order - spacing[-1] ** order)
+    return weight * conductivity[-1] + (1 - weight) * conductivity[-2]
+
+
+def calculate_conductivity_vs_mesh(forceconstants, meshes, tolerance=None, order=1, phonons_kwargs=None,
+                                   conductivity_kwargs=None):
+    """Calculate the conductivity on a sequence of meshes, from the cheapest to the most expensive, and extrapolate
+    it to the infinite mesh. All the meshes share the same harmonic cache, so that the harmonic properties of the q
+    points common to commensurate meshes, i.e. 8x8x8 within 16x16x16, are calculated only once.
+
+    Parameters
+    ----------
+    forceconstants : ForceConstants
+    meshes : list
+        (n_meshes, 3) the kpts of each Phonons object
+    tolerance : float, optional
+        difference in W/m/K between the conductivity of the last mesh and the extrapolated one, to set as exit
+        condition. Each diagonal component needs to be converged. Default is `None`, which calculates all the
+        meshes
+    order : float, optional
+        order of the mesh spacing of the leading error used in the extrapolation. Default is 1
+    phonons_kwargs : dict, optional
+        arguments of the Phonons objects, other than forceconstants and kpts
+    conductivity_kwargs : dict, optional
+        arguments of the Conductivity objects, other than phonons
+
+    Returns
+    -------
+    conductivity : np.array
+        (n_calculated_meshes, 3, 3) float, conductivity summed over the modes in W/m/K
+    extrapolated_conductivity : np.array
+        (3, 3) float, conductivity in the infinite mesh limit, `None` if less than two meshes were calculated
+    """
+    phonons_kwargs = dict(phonons_kwargs or {})
+    conductivity_kwargs = dict(conductivity_kwargs or {})
+    phonons_kwargs.setdefault('harmonic_cache', HarmonicCache())
+    kpts = []
+    conductivity = []
+    extrapolated_conductivity = None
+    for mesh in meshes:
+        phonons = Phonons(forceconstants=forceconstants, kpts=mesh, **phonons_kwargs)
+        conductivity.append(Conductivity(phonons=phonons, **conductivity_kwargs).conductivity.sum(axis=0))
+        kpts.append(mesh)
+        logging.info('Conductivity for kpts = ' + str(mesh) + ': ' + str(np.diag(conductivity[-1])))
+        if len(conductivity) < 2:
+            continue
+        extrapolated_conductivity = extrapolate_conductivity(kpts, np.array(conductivity), order)
+        logging.info('Extrapolated conductivity: ' + str(np.diag(extrapolated_conductivity)))
+        if tolerance is not None:
+            error = np.abs(np.diag(conductivity[-1] - extrapolated_conductivity))
+            if (error < tolerance).all():
+                logging.info('Convergence reached with kpts = ' + str(mesh))
+                break
+    return np.array(conductivity), extrapolated_conductivity
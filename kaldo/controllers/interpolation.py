@@ -0,0 +1,146 @@
+"""
+kaldo
+Anharmonic Lattice Dynamics
+
+Fourier interpolation of the harmonic properties. The dynamical matrix and its derivatives are evaluated on
+batches of arbitrary q-points directly from the real space force constants, and diagonalized in one call per batch.
+"""
+import numpy as np
+from opt_einsum import contract
+from scipy.optimize import linear_sum_assignment
+from kaldo.helpers.logger import get_logger
+logging = get_logger()
+
+DEGENERACY_THRESHOLD = 1e-4
+# Arbitrary direction used to lift the degeneracies when rotating the degenerate subspaces
+DEGENERACY_DIRECTION = np.array([1., np.sqrt(2.), np.sqrt(3.)])
+MAX_BATCH_ELEMENTS = 2 ** 22
+
+
+def calculate_dynmat(phonons, q_points, direction=None):
+    """Calculate the dynamical matrix, or its derivative along direction, for a batch of q-points, using the
+    same folding and unfolding options of the phonons object.
+
+    Returns
+    -------
+    dynmat : np.array
+        (n_q_points, n_modes, n_modes) complex
+    """
+    second = phonons.forceconstants.second
+    distance_threshold = phonons.forceconstants.distance_threshold
+    if phonons.is_unfolding:
+        return second.calculate_unfolded_dynmat(q_points, direction=direction)
+    elif distance_threshold is not None:
+        return second.calculate_folded_dynmat(q_points, distance_threshold, direction=direction)
+    else:
+        return second.calculate_fourier_dynmat(q_points, direction=direction)
+
+
+def calculate_velocity(frequency, sij, degeneracy_threshold=DEGENERACY_THRESHOLD):
+    """Calculate the group velocities of a single q-point from the flux operators. Inside each group of degenerate
+    modes the eigenvectors are rotated to diagonalize the flux operator, so that the velocities do not depend
+    on the arbitrary basis returned by the eigensolver.
+
+    Parameters
+    ----------
+    frequency : np.array
+        (n_modes) frequency in THz
+    sij : np.array
+        (3, n_modes, n_modes) flux operators projected on the eigenvectors
+
+    Returns
+    -------
+    velocity : np.array
+        (n_modes, 3) velocity in 100m/s or A/ps
+    """
+    # The flux operator is anti-hermitian, velocity_operator is the corresponding hermitian one
+    velocity_operator = -1j * sij
+    velocity_diagonal = np.einsum('amm->ma', velocity_operator).real
+    degenerate_start = np.argwhere(np.diff(frequency) > degeneracy_threshold).flatten() + 1
+    for group in np.split(np.arange(frequency.shape[0]), degenerate_start):
+        if group.shape[0] > 1:
+            block = velocity_operator[:, group[:, np.newaxis], group[np.newaxis, :]]
+            _, rotation = np.linalg.eigh(np.tensordot(DEGENERACY_DIRECTION, block, (0, 0)))
+            block = contract('im,aij,jn->amn', rotation.conj(), block, rotation)
+            velocity_diagonal[group] = np.einsum('amm->ma', block).real
+    with np.errstate(divide='ignore', invalid='ignore'):
+        velocity = velocity_diagonal / (4 * np.pi * frequency[:, np.newaxis])
+    velocity[np.invert(np.isfinite(velocity))] = 0
+    return velocity
+
+
+def connect_bands(frequency, velocity, eigenvectors, previous_eigenvectors):
+    """Reorder the modes of consecutive q-points to follow the bands through their crossings, by maximizing the
+    overlap between eigenvectors."""
+    for iq in range(frequency.shape[0]):
+        if previous_eigenvectors is not None:
+            overlap = np.abs(previous_eigenvectors.conj().T.dot(eigenvectors[iq])) ** 2
+            _, order = linear_sum_assignment(-overlap)
+            frequency[iq] = frequency[iq, order]
+            velocity[iq] = velocity[iq, order]
+            eigenvectors[iq] = eigenvectors[iq][:, order]
+        previous_eigenvectors = eigenvectors[iq]
+    return previous_eigenvectors
+
+
+def interpolate_harmonic(phonons, q_points, is_connecting_bands=False, degeneracy_threshold=DEGENERACY_THRESHOLD,
+                         batch_size=None):
+    """Calculate frequencies and velocities on an arbitrary set of q-points, like a dense mesh or a path.
+
+    Parameters
+    ----------
+    phonons : Phonons
+        provides the force constants and the folding, unfolding and physical modes options
+    q_points : np.array
+        (n_q_points, 3) q-points in fractional coordinates of the reciprocal cell
+    is_connecting_bands : bool, optional
+        if `True`, modes are reordered following the eigenvectors through the band crossings, which is
+        meaningful when consecutive q-points are close, like in a dispersion path. Otherwise modes are sorted by
+        frequency, like in the `Phonons` arrays.
+        Default is `False`
+    degeneracy_threshold : float, optional
+        modes closer than this value, in THz, are treated as degenerate when calculating the velocities
+    batch_size : int, optional
+        number of q-points diagonalized together. If `None` it's chosen from the number of modes.
+
+    Returns
+    -------
+    frequency : np.array
+        (n_q_points, n_modes) frequency in THz
+    velocity : np.array
+        (n_q_points, n_modes, 3) velocity in 100m/s or A/ps
+    physical_mode : np.array
+        (n_q_points, n_modes) bool
+    """
+    q_points = np.array(q_points).reshape((-1, 3))
+    n_q_points = q_points.shape[0]
+    n_modes = phonons.n_modes
+    if batch_size is None:
+        batch_size = max(1, int(MAX_BATCH_ELEMENTS / n_modes ** 2))
+    frequency = np.zeros((n_q_points, n_modes))
+    velocity = np.zeros((n_q_points, n_modes, 3))
+    previous_eigenvectors = None
+    logging.info('Interpolating harmonic properties on ' + str(n_q_points) + ' q-points')
+    for batch_start in range(0, n_q_points, batch_size):
+        batch = slice(batch_start, min(batch_start + batch_size, n_q_points))
+        eigenvalues, eigenvectors = np.linalg.eigh(calculate_dynmat(phonons, q_points[batch]))
+        frequency[batch] = np.abs(eigenvalues) ** .5 * np.sign(eigenvalues) / (np.pi * 2.)
+        sij = np.zeros((3, ) + eigenvectors.shape, dtype=complex)
+        for alpha in range(3):
+            sij[alpha] = contract('qim,qij,qjn->qmn', eigenvectors.conj(),
+                                  calculate_dynmat(phonons, q_points[batch], direction=alpha), eigenvectors)
+        for iq in range(eigenvectors.shape[0]):
+            velocity[batch_start + iq] = calculate_velocity(frequency[batch_start + iq], sij[:, iq],
+                                                            degeneracy_threshold)
+        if is_connecting_bands:
+            previous_eigenvectors = connect_bands(frequency[batch], velocity[batch], eigenvectors,
+                                                  previous_eigenvectors)
+    physical_mode = np.ones((n_q_points, n_modes), dtype=bool)
+    n_acoustic_modes = 4 if phonons.is_nw else 3
+    for iq in np.argwhere((q_points == 0).all(axis=1)).flatten():
+        physical_mode[iq, np.argsort(frequency[iq])[:n_acoustic_modes]] = False
+    if phonons.min_frequency is not None:
+        physical_mode[frequency < phonons.min_frequency] = False
+    if phonons.max_frequency is not None:
+        physical_mode[frequency > phonons.max_frequency] = False
+    return frequency, velocity, physical_mode
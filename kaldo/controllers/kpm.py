@@ -0,0 +1,256 @@
+"""
+kaldo
+Anharmonic Lattice Dynamics
+
+Kernel polynomial method for amorphous samples. The density of states and the Allen-Feldman diffusivity are
+expanded in Chebyshev polynomials of the sparse dynamical matrix, and the traces are estimated stochastically, so
+that only sparse matrix-vector products are needed and no diagonalization is performed.
+"""
+import numpy as np
+import ase.units as units
+from scipy.sparse.linalg import eigsh
+from kaldo.observables.harmonic_with_q_temp import calculate_population, calculate_heat_capacity
+from kaldo.helpers.logger import get_logger
+logging = get_logger()
+
+DEFAULT_N_MOMENTS = 256
+DEFAULT_N_VECTORS = 10
+DEFAULT_N_FREQUENCIES = 200
+# Relative margin added to the spectral bounds, to keep the rescaled spectrum strictly inside (-1, 1)
+BOUNDS_MARGIN = 0.01
+# Number of Chebyshev vectors accumulated together into the energy projections
+CHEBYSHEV_BLOCK_SIZE = 32
+
+
+def jackson_kernel(n_moments):
+    """Jackson damping factors, which remove the Gibbs oscillations of the truncated expansion.
+
+    Returns
+    -------
+    kernel : np.array
+        (n_moments) float
+    """
+    m = np.arange(n_moments)
+    phase = np.pi / (n_moments + 1)
+    kernel = ((n_moments - m + 1) * np.cos(phase * m) + np.sin(phase * m) / np.tan(phase)) / (n_moments + 1)
+    return kernel
+
+
+def calculate_spectral_bounds(matrix):
+    """Calculate scale and shift that map the spectrum of matrix inside (-1, 1)."""
+    eigenvalue_max = eigsh(matrix, k=1, which='LA', tol=1e-3, return_eigenvectors=False)[0]
+    eigenvalue_min = eigsh(matrix, k=1, which='SA', tol=1e-3, return_eigenvectors=False)[0]
+    width = eigenvalue_max - eigenvalue_min
+    scale = width * (1 + BOUNDS_MARGIN) / 2
+    shift = (eigenvalue_max + eigenvalue_min) / 2
+    return scale, shift
+
+
+def calculate_delta_coefficients(eigenvalues, n_moments, scale, shift):
+    """Expansion coefficients of delta(eigenvalue - D) on the Chebyshev polynomials of the rescaled matrix.
+
+    Returns
+    -------
+    coefficients : np.array
+        (n_moments, n_eigenvalues) float
+    """
+    x = (np.array(eigenvalues) - shift) / scale
+    x = np.clip(x, -1 + 1e-12, 1 - 1e-12)
+    m = np.arange(n_moments)
+    coefficients = np.cos(m[:, np.newaxis] * np.arccos(x)[np.newaxis, :])
+    coefficients *= jackson_kernel(n_moments)[:, np.newaxis] * np.where(m == 0, 1., 2.)[:, np.newaxis]
+    coefficients /= np.pi * np.sqrt(1 - x ** 2)[np.newaxis, :] * scale
+    return coefficients
+
+
+def chebyshev_moments(matrix, vectors, n_moments, scale, shift):
+    """Calculate vectors^T T_m(H) vectors for each moment m, where H is the rescaled matrix.
+
+    Returns
+    -------
+    moments : np.array
+        (n_moments) float
+    """
+    moments = np.zeros(n_moments)
+    t_previous = vectors
+    t_current = (matrix.dot(vectors) - shift * vectors) / scale
+    moments[0] = np.sum(vectors * t_previous)
+    if n_moments > 1:
+        moments[1] = np.sum(vectors * t_current)
+    for m in range(2, n_moments):
+        t_previous, t_current = t_current, 2 * (matrix.dot(t_current) - shift * t_current) / scale - t_previous
+        moments[m] = np.sum(vectors * t_current)
+    return moments
+
+
+def project_on_delta(matrix, vector, coefficients, scale, shift):
+    """Calculate delta(eigenvalue_k - D) vector for each eigenvalue, as sum_m coefficients[m, k] T_m(H) vector.
+
+    Returns
+    -------
+    projection : np.array
+        (n_modes, n_eigenvalues) float
+    """
+    n_moments = coefficients.shape[0]
+    projection = np.zeros((vector.shape[0], coefficients.shape[1]))
+    block = np.zeros((vector.shape[0], CHEBYSHEV_BLOCK_SIZE))
+    t_previous = None
+    t_current = vector
+    for m in range(n_moments):
+        if m == 1:
+            t_previous, t_current = t_current, (matrix.dot(t_current) - shift * t_current) / scale
+        elif m > 1:
+            t_previous, t_current = t_current, 2 * (matrix.dot(t_current) - shift * t_current) / scale - t_previous
+        block[:, m % CHEBYSHEV_BLOCK_SIZE] = t_current
+        if (m + 1) % CHEBYSHEV_BLOCK_SIZE == 0 or m == n_moments - 1:
+            block_start = m - m % CHEBYSHEV_BLOCK_SIZE
+            projection += block[:, :m - block_start + 1].dot(coefficients[block_start:m + 1])
+    return projection
+
+
+def random_vectors(n_modes, n_vectors, seed=None):
+    # Random phase vectors, for which the average of v^T M v is the trace of M
+    if n_vectors is None:
+        # The rescaled unit vectors give the exact trace
+        return np.sqrt(n_modes) * np.eye(n_modes)
+    generator = np.random.RandomState(seed)
+    return generator.choice([-1., 1.], size=(n_modes, n_vectors))
+
+
+def frequency_grid(scale, shift, frequency=None):
+    # The default grid covers the spectrum mapped inside (-1, 1) by scale and shift
+    if frequency is None:
+        max_frequency = np.sqrt(shift + scale) / (2 * np.pi)
+        frequency = np.linspace(0, max_frequency, DEFAULT_N_FREQUENCIES + 1)[1:]
+    return np.array(frequency, dtype=float)
+
+
+def calculate_dos(phonons, frequency=None, n_moments=DEFAULT_N_MOMENTS, n_vectors=DEFAULT_N_VECTORS, seed=None):
+    """Calculate the vibrational density of states of an amorphous sample with the kernel polynomial method.
+
+    Parameters
+    ----------
+    phonons : Phonons
+        provides the force constants
+    frequency : np.array, optional
+        (n_frequencies) positive frequencies in THz. If `None` an equally spaced grid covering the spectrum is used
+    n_moments : int, optional
+        number of Chebyshev moments, which sets the resolution
+    n_vectors : int, optional
+        number of random vectors used to estimate the trace. If `None` the trace is exact, which is only practical
+        for small samples
+    seed : int, optional
+        seed of the random vectors
+
+    Returns
+    -------
+    frequency : np.array
+        (n_frequencies) frequency in THz
+    dos : np.array
+        (n_frequencies) density of states in 1/THz, normalized to one
+    """
+    dynmat = phonons.forceconstants.second.sparse_dynmat
+    n_modes = dynmat.shape[0]
+    scale, shift = calculate_spectral_bounds(dynmat)
+    frequency = frequency_grid(scale, shift, frequency)
+    eigenvalues = (2 * np.pi * frequency) ** 2
+    logging.info('Kernel polynomial DOS with ' + str(n_moments) + ' moments and ' + str(n_vectors) + ' vectors')
+    vectors = random_vectors(n_modes, n_vectors, seed)
+    moments = chebyshev_moments(dynmat, vectors, n_moments, scale, shift)
+    moments /= n_modes * vectors.shape[1]
+    # d eigenvalue / d frequency = 8 pi^2 frequency
+    dos = moments.dot(calculate_delta_coefficients(eigenvalues, n_moments, scale, shift)) * 8 * np.pi ** 2 * frequency
+    return frequency, dos
+
+
+def calculate_diffusivity(phonons, frequency=None, n_moments=DEFAULT_N_MOMENTS, n_vectors=DEFAULT_N_VECTORS,
+                          seed=None):
+    """Calculate the frequency resolved Allen-Feldman diffusivity of an amorphous sample with the kernel polynomial
+    method,
+
+    .. math::
+
+        D_\\alpha(\\omega) = \\frac{\\pi \\mathrm{Tr}[\\delta(\\omega^2 - D) A_\\alpha
+        \\delta(\\omega^2 - D) A_\\alpha^T]}{2 \\omega \\mathrm{Tr}[\\delta(\\omega^2 - D)]}
+
+    where :math:`A_\\alpha` is the derivative of the dynamical matrix along :math:`\\alpha`. The energy conservation
+    is broadened by the finite number of moments, instead of the diffusivity bandwidth.
+
+    Parameters
+    ----------
+    phonons : Phonons
+        provides the force constants
+    frequency : np.array, optional
+        (n_frequencies) positive frequencies in THz. If `None` an equally spaced grid covering the spectrum is used
+    n_moments : int, optional
+        number of Chebyshev moments, which sets the resolution
+    n_vectors : int, optional
+        number of random vectors used to estimate the traces. If `None` the traces are exact, which is only
+        practical for small samples
+    seed : int, optional
+        seed of the random vectors
+
+    Returns
+    -------
+    frequency : np.array
+        (n_frequencies) frequency in THz
+    dos : np.array
+        (n_frequencies) density of states in 1/THz, normalized to one
+    diffusivity : np.array
+        (n_frequencies, 3) diffusivity along each direction in mm^2/s
+    """
+    second = phonons.forceconstants.second
+    dynmat = second.sparse_dynmat
+    n_modes = dynmat.shape[0]
+    scale, shift = calculate_spectral_bounds(dynmat)
+    frequency = frequency_grid(scale, shift, frequency)
+    omega = 2 * np.pi * frequency
+    coefficients = calculate_delta_coefficients(omega ** 2, n_moments, scale, shift)
+    vectors = random_vectors(n_modes, n_vectors, seed)
+    trace_delta = np.zeros_like(frequency)
+    trace_flux = np.zeros((frequency.shape[0], 3))
+    n_vectors = vectors.shape[1]
+    logging.info('Kernel polynomial diffusivity with ' + str(n_moments) + ' moments and ' + str(n_vectors)
+                 + ' vectors')
+    for i in range(n_vectors):
+        vector = vectors[:, i]
+        delta_vector = project_on_delta(dynmat, vector, coefficients, scale, shift)
+        trace_delta += vector.dot(delta_vector)
+        for alpha in range(3):
+            dynmat_derivatives = second.sparse_dynmat_derivatives(alpha)
+            delta_flux_vector = project_on_delta(dynmat, dynmat_derivatives.T.dot(vector), coefficients, scale,
+                                                 shift)
+            trace_flux[:, alpha] += np.sum(delta_vector * dynmat_derivatives.dot(delta_flux_vector), axis=0)
+    dos = trace_delta / (n_modes * n_vectors) * 4 * np.pi * omega
+    with np.errstate(divide='ignore', invalid='ignore'):
+        diffusivity = np.pi * trace_flux / (2 * omega * trace_delta)[:, np.newaxis]
+    diffusivity[np.invert(np.isfinite(diffusivity))] = 0
+    return frequency, dos, diffusivity / 100
+
+
+def calculate_conductivity(phonons, frequency=None, n_moments=DEFAULT_N_MOMENTS, n_vectors=DEFAULT_N_VECTORS,
+                           seed=None):
+    """Calculate the frequency resolved Allen-Feldman conductivity of an amorphous sample with the kernel polynomial
+    method. The conductivity is the integral over the frequency of the returned spectral conductivity, i.e.
+    `np.trapz(conductivity, frequency, axis=0)`.
+
+    Returns
+    -------
+    frequency : np.array
+        (n_frequencies) frequency in THz
+    conductivity : np.array
+        (n_frequencies, 3) spectral conductivity along each direction in W/m/K/THz
+    """
+    frequency, dos, diffusivity = calculate_diffusivity(phonons, frequency, n_moments, n_vectors, seed)
+    volume = np.linalg.det(phonons.atoms.cell)
+    # Heat capacity of a mode at each frequency, as in HarmonicWithQTemp
+    kelvintothz = units.kB / units.J / (2 * np.pi * phonons.hbar) * 1e-12
+    temperature = phonons.temperature * kelvintothz
+    physical_mode = frequency > 0
+    population = calculate_population(frequency, physical_mode, temperature)
+    heat_capacity = calculate_heat_capacity(frequency, population, physical_mode, temperature)
+    # Back to the units used by the diffusivity of each mode, see Conductivity.calculate_conductivity_qhgk
+    diffusivity = diffusivity * 100
+    conductivity = phonons.forceconstants.n_modes * dos[:, np.newaxis] * heat_capacity[:, np.newaxis] * diffusivity \
+                   / volume
+    return frequency, conductivity * 1e22
@@ -18,6 +18,9 @@ from sklearn.neighbors.kde import KernelDensity
 from scipy import ndimage
 from kaldo.helpers.storage import get_folder_from_label
 from kaldo.observables.harmonic_with_q import HarmonicWithQ
+from kaldo.controllers.interpolation import interpolate_harmonic
+from kaldo.conductivity import cumulate_conductivity
+from kaldo.grid import Grid
 import os
 
 BUFFER_PLOT = .2
@@ -130,14 +133,20 @@ def plot_vs_frequency(phonons, observable, observable_name, is_showing=True):
         plt.close()
 
 
-def plot_dos(phonons, bandwidth=.05,n_points=200, is_showing=True):
-    
+def plot_dos(phonons, bandwidth=.05,n_points=200, is_showing=True, kpts=None):
+    # When kpts is given, the frequencies are interpolated on that mesh instead of using the phonons mesh
     fig = plt.figure()
-    physical_mode = phonons.physical_mode.flatten(order='C')
-    frequency = phonons.frequency.flatten(order='C')
+    if kpts is not None:
+        q_points = Grid(kpts, order=phonons._grid_type).unitary_grid(is_wrapping=False)
+        frequency, _, physical_mode = interpolate_harmonic(phonons, q_points)
+        frequency = frequency.flatten(order='C')
+        physical_mode = physical_mode.flatten(order='C')
+    else:
+        physical_mode = phonons.physical_mode.flatten(order='C')
+        frequency = phonons.frequency.flatten(order='C')
     frequency = frequency[physical_mode]
     kde = KernelDensity(kernel='gaussian', bandwidth=bandwidth).fit(frequency.reshape(-1, 1))
-    x = np.linspace(frequency.min(), phonons.frequency.max(), n_points)
+    x = np.linspace(frequency.min(), frequency.max(), n_points)
     y = np.exp(kde.score_samples(x.reshape((-1, 1))))
     plt.plot(x, y)
     plt.fill_between(x, y, alpha=.2)
@@ -186,7 +195,8 @@ def plot_dispersion(phonons, n_k_points=300, is_showing=True, symprec=1e-3, is_n
                                distance_threshold=phonons.forceconstants.distance_threshold,
                                storage='memory',
                                is_nw=is_nw,
-                               is_unfolding=is_unfolding)
+                               is_unfolding=is_unfolding,
+                               cache=phonons.harmonic_cache)
         freqs_plot.append(phonon.frequency.flatten())
         if with_velocity:
             val_value = phonon.velocity[0]
@@ -248,12 +258,7 @@ def plot_dispersion(phonons, n_k_points=300, is_showing=True, symprec=1e-3, is_n
 def cumulative_cond_cal(freq, full_cond, n_phonons):
     conductivity = np.einsum('maa->m', 1/3 * full_cond)
     conductivity = conductivity.reshape(n_phonons)
-    cumulative_cond = np.zeros_like(conductivity)
-    freq_reshaped = freq.reshape(n_phonons)
-    for mu in range(cumulative_cond.size):
-        single_cumulative_cond = conductivity[(freq_reshaped < freq_reshaped[mu])].sum()
-        cumulative_cond[mu] = single_cumulative_cond
-    return cumulative_cond
+    return cumulate_conductivity(freq.reshape(n_phonons), conductivity)
 
 
 def plot_crystal(phonons):
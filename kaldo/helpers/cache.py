@@ -0,0 +1,127 @@
+"""
+kaldo
+Anharmonic Lattice Dynamics
+"""
+import os
+import hashlib
+import threading
+from collections import OrderedDict
+import numpy as np
+from sparse import COO
+from kaldo.helpers.logger import get_logger
+logging = get_logger()
+
+DEFAULT_MAX_BYTES = 2 ** 29
+# Decimals used to compare q points in fractional coordinates
+Q_POINT_DECIMALS = 8
+
+
+def calculate_fingerprint(second):
+    """Hash of the second order force constants and of the structure they refer to."""
+    digest = hashlib.sha1()
+    value = second.value
+    if isinstance(value, COO):
+        arrays = (value.coords, value.data)
+    else:
+        arrays = (np.asarray(value),)
+    arrays = arrays + (second.atoms.positions, second.atoms.get_masses(), second.atoms.cell[:],
+                       np.array(second.supercell))
+    for array in arrays:
+        array = np.ascontiguousarray(array)
+        digest.update(str(array.shape).encode())
+        digest.update(array.tobytes())
+    return digest.hexdigest()
+
+
+def q_point_key(q_point):
+    # Rounding makes the same q point calculated on different meshes compare equal, + 0. removes -0.
+    return tuple(np.round(np.array(q_point, dtype=float), Q_POINT_DECIMALS) + 0.)
+
+
+class HarmonicCache:
+    """Least recently used cache of harmonic properties, with a budget on the memory used by the stored arrays.
+    When a folder is given the arrays are also stored on disk, and loaded back on a miss, so that they survive the
+    eviction and the end of the calculation.
+
+    Parameters
+    ----------
+    max_bytes : int, optional
+        maximum size of the arrays kept in memory. Default is 512 MB
+    folder : str, optional
+        folder of the persistent storage. If `None` the cache is in memory only
+    """
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES, folder=None):
+        self.max_bytes = max_bytes
+        self.folder = folder
+        self.n_bytes = 0
+        self._entries = OrderedDict()
+        # The cache is shared by the threads of the parallel q points loops
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __getstate__(self):
+        # Only the configuration is sent to the worker processes, the entries are left behind
+        return {'max_bytes': self.max_bytes, 'folder': self.folder}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.n_bytes = 0
+
+    def get(self, key):
+        """Return the array stored with key, or `None` if it is not in memory nor on disk."""
+        with self._lock:
+            try:
+                self._entries.move_to_end(key)
+                return self._entries[key]
+            except KeyError:
+                pass
+        filename = self._filename(key)
+        if filename is None or not os.path.exists(filename):
+            return None
+        value = np.load(filename)
+        self._store_in_memory(key, value)
+        return value
+
+    def put(self, key, value):
+        value = np.array(value)
+        value.flags.writeable = False
+        self._store_in_memory(key, value)
+        filename = self._filename(key)
+        if filename is not None and not os.path.exists(filename):
+            if not os.path.exists(self.folder):
+                os.makedirs(self.folder)
+            np.save(filename, value)
+        return value
+
+    def get_or_calculate(self, key, calculate):
+        value = self.get(key)
+        if value is None:
+            value = self.put(key, calculate())
+        return value
+
+    def _store_in_memory(self, key, value):
+        if value.nbytes > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self.n_bytes -= self._entries.pop(key).nbytes
+            self._entries[key] = value
+            self.n_bytes += value.nbytes
+            while self.n_bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.n_bytes -= evicted.nbytes
+
+    def _filename(self, key):
+        if self.folder is None:
+            return None
+        return self.folder + '/' + hashlib.sha1(repr(key).encode()).hexdigest() + '.npy'
+
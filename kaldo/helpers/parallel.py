@@ -0,0 +1,170 @@
+"""
+kaldo
+Anharmonic Lattice Dynamics
+"""
+import os
+import multiprocessing
+from multiprocessing import shared_memory, resource_tracker
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import numpy as np
+from kaldo.helpers.logger import get_logger
+logging = get_logger()
+
+BLAS_THREADS_VARIABLES = ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS', 'VECLIB_MAXIMUM_THREADS',
+                          'NUMEXPR_NUM_THREADS', 'TF_NUM_INTRAOP_THREADS', 'TF_NUM_INTEROP_THREADS')
+
+# State of each worker process, set once by the pool initializer
+_worker = {}
+
+
+@contextmanager
+def blas_threads(n_blas_threads):
+    """Temporarily set the threads environment variables, which are inherited by the spawned workers."""
+    previous = {name: os.environ.get(name) for name in BLAS_THREADS_VARIABLES}
+    if n_blas_threads is not None:
+        for name in BLAS_THREADS_VARIABLES:
+            os.environ[name] = str(n_blas_threads)
+    try:
+        yield
+    finally:
+        for name, value in previous.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+
+
+def _initialize_worker(calculate, shared_specs, n_blas_threads):
+    if n_blas_threads is not None:
+        import tensorflow as tf
+        try:
+            tf.config.threading.set_intra_op_parallelism_threads(n_blas_threads)
+            tf.config.threading.set_inter_op_parallelism_threads(1)
+        except RuntimeError:
+            # Tensorflow was already initialized, the environment variables still apply
+            pass
+    _worker['calculate'] = calculate
+    _worker['memories'] = []
+    _worker['outputs'] = []
+    for name, shape, dtype in shared_specs:
+        memory = shared_memory.SharedMemory(name=name)
+        # The parent process owns the memory and is responsible of unlinking it
+        resource_tracker.unregister(memory._name, 'shared_memory')
+        _worker['memories'].append(memory)
+        _worker['outputs'].append(np.ndarray(shape, dtype=dtype, buffer=memory.buf))
+
+
+def _run_item(indexed_item):
+    index, item = indexed_item
+    results = _worker['calculate'](item)
+    for output, result in zip(_worker['outputs'], results):
+        output[index] = result
+
+
+@contextmanager
+def _limited_blas_threads(n_blas_threads):
+    """Limit the threads of the BLAS libraries already loaded in the current process, when threadpoolctl is
+    available."""
+    if n_blas_threads is None:
+        yield
+        return
+    try:
+        from threadpoolctl import threadpool_limits
+    except ImportError:
+        logging.warning('threadpoolctl is not installed, n_blas_threads is ignored by the threads backend')
+        yield
+        return
+    with threadpool_limits(limits=n_blas_threads):
+        yield
+
+
+def _thread_map(calculate, items, outputs, n_workers, n_blas_threads):
+    def run(index):
+        results = calculate(items[index])
+        for output, result in zip(outputs, results):
+            output[index] = result
+
+    with _limited_blas_threads(n_blas_threads):
+        with ThreadPoolExecutor(max_workers=n_workers) as executor:
+            # list re-raises the exceptions of the workers
+            list(executor.map(run, range(len(items))))
+    return outputs
+
+
+def parallel_map(calculate, items, shapes, dtypes=None, n_workers=1, n_blas_threads=None, backend='processes'):
+    """Evaluate calculate(item) for each item and collect the results in preallocated arrays. When n_workers is
+    larger than one, the items are distributed on a pool of processes which write directly in shared memory, or on a
+    pool of threads which write directly in the output arrays.
+
+    Worker processes are spawned, not forked, so the calculation must be launched from a script protected by
+    `if __name__ == '__main__':`, and calculate must be picklable, i.e. a module function or a partial. Threads have
+    none of these requirements and no startup cost, and scale when calculate spends its time in numpy, scipy and
+    tensorflow, which release the GIL.
+
+    Parameters
+    ----------
+    calculate : callable
+        returns a sequence of arrays, one for each output, given a single item
+    items : sequence
+        the items to calculate, i.e. q-points
+    shapes : list of tuples
+        shape of each output for a single item
+    dtypes : list, optional
+        dtype of each output. Default is float
+    n_workers : int
+        number of processes. Default is 1, which runs serially in the current process
+    n_blas_threads : int, optional
+        number of threads used by BLAS and tensorflow inside each worker. n_workers * n_blas_threads should not
+        exceed the number of cores.
+    backend : 'processes', 'threads', optional
+        Default is 'processes'
+
+    Returns
+    -------
+    outputs : list of np.array
+        (n_items, *shape) one array for each output
+    """
+    n_items = len(items)
+    if dtypes is None:
+        dtypes = [float] * len(shapes)
+    full_shapes = [(n_items, ) + tuple(shape) for shape in shapes]
+    if n_workers is None or n_workers <= 1 or n_items <= 1:
+        outputs = [np.zeros(shape, dtype=dtype) for shape, dtype in zip(full_shapes, dtypes)]
+        for index in range(n_items):
+            results = calculate(items[index])
+            for output, result in zip(outputs, results):
+                output[index] = result
+        return outputs
+
+    n_workers = min(n_workers, n_items)
+    logging.info('Distributing ' + str(n_items) + ' items on ' + str(n_workers) + ' ' + backend)
+    if backend == 'threads':
+        outputs = [np.zeros(shape, dtype=dtype) for shape, dtype in zip(full_shapes, dtypes)]
+        return _thread_map(calculate, items, outputs, n_workers, n_blas_threads)
+    if backend != 'processes':
+        logging.error('Parallel backend not implemented: ' + str(backend))
+        raise ValueError('Parallel backend not implemented: ' + str(backend))
+    memories = []
+    shared_specs = []
+    try:
+        for shape, dtype in zip(full_shapes, dtypes):
+            size = max(1, int(np.prod(shape)) * np.dtype(dtype).itemsize)
+            memory = shared_memory.SharedMemory(create=True, size=size)
+            memories.append(memory)
+            np.ndarray(shape, dtype=dtype, buffer=memory.buf)[...] = 0
+            shared_specs.append((memory.name, shape, dtype))
+        context = multiprocessing.get_context('spawn')
+        with blas_threads(n_blas_threads):
+            with context.Pool(n_workers, initializer=_initialize_worker,
+                              initargs=(calculate, shared_specs, n_blas_threads)) as pool:
+                # Items are handed out one at a time, so that workers which finish early take the next one
+                for _ in pool.imap_unordered(_run_item, enumerate(items)):
+                    pass
+        outputs = [np.ndarray(shape, dtype=dtype, buffer=memory.buf).copy()
+                   for (_, shape, dtype), memory in zip(shared_specs, memories)]
+    finally:
+        for memory in memories:
+            memory.close()
+            memory.unlink()
+    return outputs
@@ -24,9 +24,11 @@ DEFAULT_STORE_FORMATS = {'physical_mode': 'formatted',
                          'flux': 'numpy',
                          '_dynmat_derivatives': 'numpy',
                          '_eigensystem': 'numpy',
+                         'eigenvectors': 'numpy',
                          '_ps_and_gamma': 'numpy',
                          '_ps_gamma_and_gamma_tensor': 'numpy',
-                         '_generalized_diffusivity': 'numpy'}
+                         '_generalized_diffusivity': 'numpy',
+                         '_lambda_eigensystem': 'numpy'}
 
 
 def parse_pair(txt):
@@ -148,6 +150,8 @@ def get_folder_from_label(instance, label='', base_folder=None):
             base_folder += '/single_q/' + str(q_point[0]) + '_' + str(q_point[1]) + '_' + str(q_point[2])
         except AttributeError:
             pass
+    if getattr(instance, 'frequency_window', None) is not None:
+        base_folder += '/fw_' + str(instance.frequency_window[0]) + '_' + str(instance.frequency_window[1])
     if label != '':
         if '<diffusivity_bandwidth>' in label:
             if instance.diffusivity_bandwidth is not None:
@@ -169,8 +173,7 @@ def get_folder_from_label(instance, label='', base_folder=None):
 
         if '<method>' in label:
             base_folder += '/' + str(instance.method)
-            if (instance.method == 'rta' or instance.method == 'sc' or instance.method == 'inverse') \
-                    and (instance.length is not None):
+            if (instance.method in ('rta', 'sc', 'inverse', 'full')) and (instance.length is not None):
                 if not (np.array(instance.length) == np.array([None, None, None])).all()\
                     and not (np.array(instance.length) == np.array([0, 0, 0])).all():
                     if '<length>' in label:
@@ -183,6 +186,10 @@ def get_folder_from_label(instance, label='', base_folder=None):
                     if '<finite_length_method>' in label:
                         if instance.finite_length_method is not None:
                             base_folder += '/fs' + str(instance.finite_length_method)
+            if '<solver>' in label:
+                # The direct solver keeps the folders of the previous versions
+                if instance.method == 'inverse' and instance.solver != 'direct':
+                    base_folder += '/solver_' + str(instance.solver)
     return base_folder
 
 
@@ -10,6 +10,11 @@ def chi(qvec, list_of_replicas, cell_inv):
     return chi_k
 
 
+def frequency_to_eigenvalue(frequency):
+    frequency = np.array(frequency, dtype=float)
+    return np.sign(frequency) * (2 * np.pi * frequency) ** 2
+
+
 class ForceConstant(Observable):
 
     def __init__(self, *kargs, **kwargs):
@@ -1,16 +1,20 @@
 from kaldo.grid import wrap_coordinates
-from kaldo.observables.forceconstant import chi
+from kaldo.observables.forceconstant import chi, frequency_to_eigenvalue
 from kaldo.observables.observable import Observable
 import numpy as np
 from opt_einsum import contract
 from kaldo.helpers.storage import lazy_property
+from kaldo.helpers.cache import q_point_key
 import tensorflow as tf
 from scipy.linalg.lapack import zheev
+from scipy.sparse.linalg import eigsh
 from kaldo.helpers.logger import get_logger, log_size
 
 logging = get_logger()
 
 MIN_N_MODES_TO_STORE = 1000
+# Largest block of eigenvector elements gathered at once to calculate selected elements of the flux operators
+MAX_SIJ_PAIR_ELEMENTS = 2 ** 22
 
 class HarmonicWithQ(Observable):
 
@@ -19,6 +23,8 @@ class HarmonicWithQ(Observable):
                  storage='numpy',
                  is_nw=False,
                  is_unfolding=False,
+                 frequency_window=None,
+                 cache=None,
                  *kargs,
                  **kwargs):
         super().__init__(*kargs, **kwargs)
@@ -29,14 +35,22 @@ class HarmonicWithQ(Observable):
         self.is_amorphous = (np.array(self.supercell) == [1, 1, 1]).all()
         self.second = second
         self.distance_threshold = distance_threshold
+        self.frequency_window = frequency_window
+        self.cache = cache
+        if frequency_window is not None:
+            if not (self.is_amorphous and (np.array(q_point) == [0, 0, 0]).all()):
+                logging.error('The frequency window is only available at Gamma for amorphous samples')
+                raise ValueError('The frequency window is only available at Gamma for amorphous samples')
+            self.n_modes = self.second.n_modes_in_window(frequency_window)
         self.physical_mode= np.ones((1, self.n_modes), dtype=bool)
         self.is_nw = is_nw
         self.is_unfolding = is_unfolding
         if (q_point == [0, 0, 0]).all():
-            if self.is_nw:
-                self.physical_mode[0, :4] = False
-            else:
-                self.physical_mode[0, :3] = False
+            # Acoustic modes at Gamma are the lowest ones, the window keeps those above its lower edge
+            n_acoustic_modes = 4 if self.is_nw else 3
+            if frequency_window is not None:
+                n_acoustic_modes = max(0, n_acoustic_modes - self.second.n_modes_below(frequency_window[0]))
+            self.physical_mode[0, :n_acoustic_modes] = False
         if self.n_modes > MIN_N_MODES_TO_STORE:
             self.storage = storage
         else:
@@ -44,12 +58,12 @@ class HarmonicWithQ(Observable):
 
     @lazy_property(label='<q_point>')
     def frequency(self):
-        frequency = self.calculate_frequency()[np.newaxis, :]
+        frequency = self._get_from_cache('frequency', lambda: self.calculate_frequency()[np.newaxis, :])
         return frequency
 
     @lazy_property(label='<q_point>')
     def velocity(self):
-        velocity = self.calculate_velocity()
+        velocity = self._get_from_cache('velocity', self.calculate_velocity)
         return velocity
 
     @lazy_property(label='<q_point>')
@@ -84,27 +98,43 @@ class HarmonicWithQ(Observable):
     @lazy_property(label='<q_point>')
     def _eigensystem(self):
         if self.is_unfolding:
-            _eigensystem = self.calculate_eigensystem_unfolded(only_eigenvals=False)
+            _eigensystem = self._get_from_cache('eigensystem',
+                                                lambda: self.calculate_eigensystem_unfolded(only_eigenvals=False))
         else:
-            _eigensystem = self.calculate_eigensystem(only_eigenvals=False)
+            _eigensystem = self._get_from_cache('eigensystem',
+                                                lambda: self.calculate_eigensystem(only_eigenvals=False))
         return _eigensystem
 
+    @property
+    def _eigenvectors(self):
+        return self._eigensystem[1:, :]
+
     @lazy_property(label='<q_point>')
     def _sij_x(self):
-        _sij = self.calculate_sij(direction=0)
+        _sij = self._get_from_cache('sij_x', lambda: self.calculate_sij(direction=0))
         return _sij
 
     @lazy_property(label='<q_point>')
     def _sij_y(self):
-        _sij = self.calculate_sij(direction=1)
+        _sij = self._get_from_cache('sij_y', lambda: self.calculate_sij(direction=1))
         return _sij
 
     @lazy_property(label='<q_point>')
     def _sij_z(self):
-        _sij = self.calculate_sij(direction=2)
+        _sij = self._get_from_cache('sij_z', lambda: self.calculate_sij(direction=2))
         return _sij
 
 
+    def _get_from_cache(self, name, calculate):
+        # Harmonic properties are shared among all the q points with the same force constants and options,
+        # regardless of the mesh they belong to
+        if self.cache is None:
+            return calculate()
+        window = None if self.frequency_window is None else tuple(self.frequency_window)
+        key = (self.second.fingerprint, q_point_key(self.q_point), self.distance_threshold, self.is_unfolding,
+               window, name)
+        return self.cache.get_or_calculate(key, calculate)
+
     def calculate_frequency(self):
         #TODO: replace calculate_eigensystem() with eigensystem
         if self.is_unfolding:
@@ -143,28 +173,12 @@ class HarmonicWithQ(Observable):
                                           dynmat[0, :, :, 0, :, :],
                                           backend='tensorflow')
         else:
-            distance = positions[:, np.newaxis, np.newaxis, :] - (
-                    positions[np.newaxis, np.newaxis, :, :] + list_of_replicas[np.newaxis, :, np.newaxis, :])
-
             if distance_threshold is not None:
-
-                distance_to_wrap = positions[:, np.newaxis, np.newaxis, :] - (
-                    self.second.replicated_atoms.positions.reshape(n_replicas, n_unit_cell, 3)[
-                    np.newaxis, :, :, :])
-
-                shape = (n_unit_cell, 3, n_unit_cell, 3)
-                type = np.complex
-                dynmat_derivatives = np.zeros(shape, dtype=type)
-                for l in range(n_replicas):
-                    wrapped_distance = wrap_coordinates(distance_to_wrap[:, l, :, :], replicated_cell,
-                                                        replicated_cell_inv)
-                    mask = (np.linalg.norm(wrapped_distance, axis=-1) < distance_threshold)
-                    id_i, id_j = np.argwhere(mask).T
-                    dynmat_derivatives[id_i, :, id_j, :, :] += contract('f,fbc->fbc', distance[id_i, l, id_j, direction], \
-                                                                         dynmat.numpy()[0, id_i, :, 0, id_j, :] *
-                                                                         chi(q_point, list_of_replicas, cell_inv)[l])
+                dynmat_derivatives = self.second.calculate_folded_dynmat(q_point, distance_threshold,
+                                                                         direction=direction)[0]
             else:
-
+                distance = positions[:, np.newaxis, np.newaxis, :] - (
+                        positions[np.newaxis, np.newaxis, :, :] + list_of_replicas[np.newaxis, :, np.newaxis, :])
                 dynmat_derivatives = contract('ilj,ibljc,l->ibjc',
                                               tf.convert_to_tensor(distance.astype(np.complex)[..., direction]),
                                               tf.cast(dynmat[0], tf.complex128),
@@ -173,7 +187,8 @@ class HarmonicWithQ(Observable):
         dynmat_derivatives = tf.reshape(dynmat_derivatives, (n_modes, n_modes))
         return dynmat_derivatives
 
-    def calculate_sij(self, direction):
+    def calculate_sij(self, direction, eigenvectors=None):
+        # The eigenvectors can be given, when they were already calculated elsewhere, i.e. by Phonons
         q_point = self.q_point
         is_amorphous = self.is_amorphous
         shape = (3 * self.atoms.positions.shape[0], 3 * self.atoms.positions.shape[0])
@@ -181,19 +196,28 @@ class HarmonicWithQ(Observable):
             type = np.float
         else:
             type = np.complex
-        eigenvects = self._eigensystem[1:, :]
-        if direction == 0:
+        if eigenvectors is None:
+            eigenvects = self._eigensystem[1:, :]
+        else:
+            eigenvects = eigenvectors
+        if self.frequency_window is not None:
+            # Only the projection on the modes inside the window is needed
+            shape = (self.n_modes, self.n_modes)
+            dynmat_derivatives = self.second.sparse_dynmat_derivatives(direction)
+        elif direction == 0:
             dynmat_derivatives = self._dynmat_derivatives_x
-        if direction == 1:
+        elif direction == 1:
             dynmat_derivatives = self._dynmat_derivatives_y
-        if direction == 2:
+        elif direction == 2:
             dynmat_derivatives = self._dynmat_derivatives_z
         if self.atoms.positions.shape[0] > 500:
             # We want to print only for big systems
             logging.info('Flux operators for q = ' + str(q_point) + ', direction = ' + str(direction))
             dir = ['_x', '_y', '_z']
             log_size(shape, type, name='sij' + dir[direction])
-        if is_amorphous and (self.q_point == np.array([0, 0, 0])).all():
+        if self.frequency_window is not None:
+            sij = tf.convert_to_tensor(eigenvects.T.dot(dynmat_derivatives.dot(eigenvects)))
+        elif is_amorphous and (self.q_point == np.array([0, 0, 0])).all():
             sij = tf.tensordot(eigenvects, dynmat_derivatives, (0, 1))
             sij = tf.tensordot(eigenvects, sij, (0, 1))
         else:
@@ -203,6 +227,44 @@ class HarmonicWithQ(Observable):
             sij = tf.tensordot(tf.math.conj(eigenvects), sij, (0, 1))
         return sij
 
+    def calculate_sij_pairs(self, direction, first, second, eigenvectors=None):
+        """Calculate only the elements (first[p], second[p]) of the flux operator along direction, without building
+        the n_modes x n_modes matrix. The derivative of the dynamical matrix is applied only to the eigenvectors of
+        the second modes, in blocks of columns, so that the memory scales with the number of pairs.
+
+        Returns
+        -------
+        sij : np.array
+            (n_pairs) flux operator elements, float for amorphous systems at gamma and complex otherwise
+        """
+        if eigenvectors is None:
+            eigenvectors = self._eigensystem[1:, :]
+        eigenvectors = np.asarray(eigenvectors)
+        is_gamma = (self.q_point == np.array([0, 0, 0])).all()
+        if self.frequency_window is not None or (self.is_amorphous and is_gamma):
+            dynmat_derivatives = self.second.sparse_dynmat_derivatives(direction)
+        else:
+            dynmat_derivatives = np.asarray([self._dynmat_derivatives_x, self._dynmat_derivatives_y,
+                                             self._dynmat_derivatives_z][direction])
+        if self.is_amorphous and is_gamma:
+            sij = np.zeros(len(first))
+        else:
+            sij = np.zeros(len(first), dtype=np.complex)
+        # Pairs grouped by their second mode, so that each block of columns is projected once
+        order = np.argsort(second, kind='stable')
+        columns, column_start = np.unique(second[order], return_index=True)
+        column_start = np.append(column_start, len(order))
+        n_block = max(1, int(MAX_SIJ_PAIR_ELEMENTS / eigenvectors.shape[0]))
+        for block_start in range(0, len(columns), n_block):
+            block_columns = columns[block_start:block_start + n_block]
+            projected = dynmat_derivatives.dot(eigenvectors[:, block_columns])
+            block_pairs = order[column_start[block_start]:column_start[block_start + len(block_columns)]]
+            for start in range(0, len(block_pairs), n_block):
+                pairs = block_pairs[start:start + n_block]
+                column = np.searchsorted(block_columns, second[pairs])
+                sij[pairs] = np.einsum('kp,kp->p', eigenvectors[:, first[pairs]].conj(), projected[:, column])
+        return sij
+
     def calculate_velocity(self):
         frequency = self.frequency[0]
         velocity = np.zeros((self.n_modes, 3))
@@ -223,31 +285,15 @@ class HarmonicWithQ(Observable):
     def calculate_dynmat_fourier(self):
         q_point = self.q_point
         distance_threshold = self.distance_threshold
-        atoms = self.atoms
-        n_unit_cell = atoms.positions.shape[0]
         n_replicas = np.prod(self.supercell)
         dynmat = self.second.dynmat
         cell_inv = self.second.cell_inv
-        replicated_cell_inv = self.second._replicated_cell_inv
         is_at_gamma = (q_point == (0, 0, 0)).all()
         is_amorphous = (n_replicas == 1)
         list_of_replicas = self.second.list_of_replicas
         log_size((self.n_modes, self.n_modes), np.complex, name='dynmat_fourier')
         if distance_threshold is not None:
-            shape = (n_unit_cell, 3, n_unit_cell, 3)
-            type = np.complex
-            dyn_s = np.zeros(shape, dtype=type)
-            replicated_cell = self.second.replicated_atoms.cell
-
-            for l in range(n_replicas):
-                distance_to_wrap = atoms.positions[:, np.newaxis, :] - (
-                    self.second.replicated_atoms.positions.reshape(n_replicas, n_unit_cell ,3)[np.newaxis, l, :, :])
-
-                distance_to_wrap = wrap_coordinates(distance_to_wrap, replicated_cell, replicated_cell_inv)
-
-                mask = np.linalg.norm(distance_to_wrap, axis=-1) < distance_threshold
-                id_i, id_j = np.argwhere(mask).T
-                dyn_s[id_i, :, id_j, :] += dynmat.numpy()[0, id_i, :, 0, id_j, :] * chi(q_point, list_of_replicas, cell_inv)[l]
+            dyn_s = self.second.calculate_folded_dynmat(q_point, distance_threshold)[0]
         else:
             if is_at_gamma:
                 if is_amorphous:
@@ -263,6 +309,10 @@ class HarmonicWithQ(Observable):
         return dyn_s
 
     def calculate_eigensystem(self, only_eigenvals):
+        if self.frequency_window is not None:
+            if only_eigenvals:
+                return self._eigensystem[0]
+            return self.calculate_eigensystem_windowed()
         dyn_s = self._dynmat_fourier
         if only_eigenvals:
             esystem = tf.linalg.eigvalsh(dyn_s)
@@ -272,35 +322,38 @@ class HarmonicWithQ(Observable):
             esystem = tf.concat(axis=0, values=(esystem[0][tf.newaxis, :], esystem[1]))
         return esystem
 
+    def calculate_eigensystem_windowed(self):
+        """Calculate only the modes inside frequency_window, using shift-invert Lanczos on the sparse dynamical matrix.
+        The shift is at the center of the window, so the n_modes eigenvalues closest to it are the ones inside.
+
+        Returns
+        -------
+        esystem : np.array
+            (n_unit_cell * 3 + 1, n_modes) eigenvalues in the first row and eigenvectors in the columns
+        """
+        dynmat = self.second.sparse_dynmat
+        eigenvalue_window = frequency_to_eigenvalue(self.frequency_window)
+        n_modes = self.n_modes
+        log_size((dynmat.shape[0] + 1, n_modes), type=np.float, name='eigensystem')
+        if n_modes == 0:
+            logging.error('No modes in the frequency window ' + str(self.frequency_window))
+            raise ValueError('No modes in the frequency window ' + str(self.frequency_window))
+        if n_modes < dynmat.shape[0] - 1:
+            eigenvals, eigenvects = eigsh(dynmat, k=n_modes, sigma=eigenvalue_window.mean(), which='LM')
+            order = np.argsort(eigenvals)
+            eigenvals = eigenvals[order]
+            eigenvects = eigenvects[:, order]
+        else:
+            # The iterative solver needs n_modes smaller than the matrix size
+            eigenvals, eigenvects = np.linalg.eigh(dynmat.toarray())
+            is_in_window = (eigenvals >= eigenvalue_window[0]) & (eigenvals < eigenvalue_window[1])
+            eigenvals = eigenvals[is_in_window]
+            eigenvects = eigenvects[:, is_in_window]
+        esystem = np.vstack((eigenvals, eigenvects))
+        return esystem
+
     def calculate_eigensystem_unfolded(self, only_eigenvals=False):
-        q_point = self.q_point
-        scell = self.supercell
-        atoms = self.atoms
-        cell = atoms.cell
-        n_unit_cell = atoms.positions.shape[0]
-        positions = atoms.positions
-        fc_s = self.second.dynmat.numpy()
-        fc_s = fc_s.reshape((n_unit_cell, 3, scell[0], scell[1], scell[2], n_unit_cell, 3))
-        sc_r_pos = self.second.supercell_positions
-        sc_r_pos_norm = 1 / 2 * np.linalg.norm(sc_r_pos, axis=1) ** 2
-        dyn_s = np.zeros((n_unit_cell, 3, n_unit_cell, 3), dtype=np.complex)
-        tt = self.second.supercell_replicas
-        for ind in range(tt.shape[0]):
-            t = tt[ind]
-            replica_position = np.tensordot(t, cell, (-1, 0))
-            for iat in np.arange(n_unit_cell):
-                for jat in np.arange(n_unit_cell):
-                    distance = replica_position + (positions[iat, :] - positions[jat, :])
-                    projection = (np.dot(sc_r_pos, distance) - sc_r_pos_norm[:])
-                    if ((projection <= 1e-6).all()):
-                        neq = (np.abs(projection) <= 1e-6).sum()
-                        weight = 1.0 / (neq)
-                        qr = 2. * np.pi * np.dot(q_point[:], t[:])
-                        for ipol in np.arange(3):
-                            for jpol in np.arange(3):
-                                dyn_s[iat, ipol, jat, jpol] += fc_s[
-                                     jat, jpol, t[0], t[1], t[2], iat, ipol] * np.exp(-1j * qr) * weight
-        dyn = dyn_s[...].reshape((n_unit_cell * 3, n_unit_cell * 3))
+        dyn = self.second.calculate_unfolded_dynmat(self.q_point)[0]
         omega2,eigenvect,info = zheev(dyn)
         frequency = np.sign(omega2) * np.sqrt(np.abs(omega2))
         frequency = frequency[:] / np.pi / 2
@@ -311,33 +364,4 @@ class HarmonicWithQ(Observable):
         return esystem
 
     def calculate_dynmat_derivatives_unfolded(self, direction=None):
-        q_point = self.q_point
-        supercell = self.supercell
-        atoms = self.atoms
-        cell = atoms.cell
-        n_unit_cell = atoms.positions.shape[0]
-        ddyn_s = np.zeros((n_unit_cell, 3, n_unit_cell, 3), dtype=np.complex)
-        positions = atoms.positions
-        fc_s = self.second.dynmat.numpy()
-        fc_s = fc_s.reshape((n_unit_cell, 3, supercell[0], supercell[1], supercell[2], n_unit_cell, 3))
-        sc_r_pos = self.second.supercell_positions
-        sc_r_pos_norm = 1 / 2 * np.linalg.norm(sc_r_pos, axis=1) ** 2
-        tt = self.second.supercell_replicas
-        for ind in range(tt.shape[0]):
-            t = tt[ind]
-            replica_position = np.tensordot(t, cell, (-1, 0))
-            for iat in np.arange(n_unit_cell):
-                for jat in np.arange(n_unit_cell):
-                    distance = replica_position + (positions[iat] - positions[jat])
-                    projection = (np.dot(sc_r_pos, distance) - sc_r_pos_norm)
-                    if (projection <= 1e-6).all():
-                        neq = (np.abs(projection) <= 1e-6).sum()
-                        weight = 1.0 / (neq)
-                        qr = 2. * np.pi * np.dot(q_point[:], t[:])
-                        for ipol in np.arange(3):
-                            for jpol in np.arange(3):
-                                ddyn_s[iat, ipol, jat, jpol] -= replica_position[direction] * fc_s[
-                                    jat, jpol, t[0], t[1], t[2], iat, ipol] * np.exp(-1j * qr) * weight
-        return ddyn_s.reshape((n_unit_cell * 3, n_unit_cell * 3))
-
-
+        return self.second.calculate_unfolded_dynmat(self.q_point, direction=direction)[0]
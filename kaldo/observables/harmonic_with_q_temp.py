@@ -4,6 +4,79 @@ import ase.units as units
 from kaldo.helpers.storage import lazy_property
 
 
+def calculate_population(frequency, physical_mode, temperature):
+    """Bose-Einstein population of the physical modes, with the temperature in THz."""
+    population = np.zeros_like(frequency)
+    population[physical_mode] = 1. / (np.exp(frequency[physical_mode] / temperature) - 1.)
+    return population
+
+
+def calculate_heat_capacity(frequency, population, physical_mode, temperature):
+    """Heat capacity of the physical modes in J/K, with the temperature in THz."""
+    kelvintojoule = units.kB / units.J
+    c_v = np.zeros_like(frequency)
+    c_v[physical_mode] = kelvintojoule * population[physical_mode] * (population[physical_mode] + 1) * \
+                         frequency[physical_mode] ** 2 / (temperature ** 2)
+    return c_v
+
+
+def calculate_generalized_heat_capacity(frequency, population, heat_capacity, physical_mode, temperature,
+                                        rows=slice(None)):
+    """Calculate the generalized heat capacity of the pairs of modes with the first mode in rows, so that it can be
+    evaluated in blocks of rows without building the full n_modes x n_modes array.
+
+    Parameters
+    ----------
+    frequency, population, heat_capacity, physical_mode : np.array
+        (n_modes) properties of all the modes of a q point
+    temperature : float
+        temperature in THz
+    rows : slice, optional
+        the first modes of the pairs. Default is all the modes
+
+    Returns
+    -------
+    c_v : np.array
+        (n_rows, n_modes) float in J/K
+    """
+    kelvintojoule = units.kB / units.J
+    diff_omega = frequency[rows, np.newaxis] - frequency[np.newaxis, :]
+    mask_degeneracy = (diff_omega == 0)
+
+    # value to do the division
+    diff_omega[mask_degeneracy] = 1
+
+    # remember here f_n-f_m/ w_m-w_n index reversed
+    c_v = (population[rows, np.newaxis] - population[np.newaxis, :]) / diff_omega
+    c_v *= - frequency[rows, np.newaxis] * frequency[np.newaxis, :] * kelvintojoule / temperature
+
+    # Degeneracy part: let us substitute the wrong elements
+    c_v[mask_degeneracy] = ((heat_capacity[rows, np.newaxis] + heat_capacity[np.newaxis, :]) / 2)[mask_degeneracy]
+
+    # Physical modes
+    c_v *= physical_mode[rows, np.newaxis] * physical_mode[np.newaxis, :]
+    return c_v
+
+
+def calculate_pair_heat_capacity(frequency, population, heat_capacity, temperature, first, second):
+    """Calculate the generalized heat capacity only for the pairs of modes (first[p], second[p]), which are assumed
+    to be physical.
+
+    Returns
+    -------
+    c_v : np.array
+        (n_pairs) float in J/K
+    """
+    kelvintojoule = units.kB / units.J
+    diff_omega = frequency[first] - frequency[second]
+    mask_degeneracy = (diff_omega == 0)
+    diff_omega[mask_degeneracy] = 1
+    c_v = (population[first] - population[second]) / diff_omega
+    c_v *= - frequency[first] * frequency[second] * kelvintojoule / temperature
+    c_v[mask_degeneracy] = ((heat_capacity[first] + heat_capacity[second]) / 2)[mask_degeneracy]
+    return c_v
+
+
 class HarmonicWithQTemp(HarmonicWithQ):
 
     def __init__(self, temperature, is_classic, *kargs, **kwargs):
@@ -44,54 +117,24 @@ class HarmonicWithQTemp(HarmonicWithQ):
         c_v : np.array
             (phonons.n_k_points,phonons.modes, phonons.n_modes) float
         """
-        kelvintojoule = units.kB / units.J
         kelvintothz = units.kB / units.J / (2 * np.pi * self.hbar) * 1e-12
-        frequencies = self.frequency.flatten()
-        temperature = self.temperature * kelvintothz
-        heat_capacity = self.heat_capacity.flatten()
-        physical_mode = self.physical_mode.flatten()
-        f_be = self.population.flatten()
-        c_v_omega = (f_be[:, np.newaxis] - f_be[np.newaxis, :])
-        diff_omega = (frequencies[:, np.newaxis] - frequencies[np.newaxis, :])
-        mask_degeneracy = np.where(diff_omega == 0, True, False)
-
-        # value to do the division
-        diff_omega[mask_degeneracy] = 1
-        divide_omega = -1 / diff_omega
-        freq_sq = frequencies[:, np.newaxis] * frequencies[np.newaxis, :]
-
-        # remember here f_n-f_m/ w_m-w_n index reversed
-        c_v = freq_sq * c_v_omega * divide_omega
-        c_v = kelvintojoule * c_v / temperature
-
-        #Degeneracy part: let us substitute the wrong elements
-        heat_capacity_deg_2d = (heat_capacity[:, np.newaxis]
-                                + heat_capacity[np.newaxis, :]) / 2
-        c_v = np.where(mask_degeneracy, heat_capacity_deg_2d, c_v)
-
-        #Physical modes
-        c_v = c_v * physical_mode[:, np.newaxis] * physical_mode[np.newaxis, :]
+        c_v = calculate_generalized_heat_capacity(self.frequency.flatten(),
+                                                  self.population.flatten(),
+                                                  self.heat_capacity.flatten(),
+                                                  self.physical_mode.flatten(),
+                                                  self.temperature * kelvintothz)
         return c_v
 
 
     def _calculate_population(self):
         frequency = self.frequency
         kelvintothz = units.kB / units.J / (2 * np.pi * self.hbar) * 1e-12
-        temp = self.temperature * kelvintothz
-        population = np.zeros_like(frequency)
         physical_mode = self.physical_mode.reshape(frequency.shape)
-        population[physical_mode] = 1. / (np.exp(frequency[physical_mode] / temp) - 1.)
-        return population
+        return calculate_population(frequency, physical_mode, self.temperature * kelvintothz)
 
 
     def _calculate_heat_capacity(self):
         frequency = self.frequency
-        c_v = np.zeros_like(frequency)
         kelvintothz = units.kB / units.J / (2 * np.pi * self.hbar) * 1e-12
-        temperature = self.temperature * kelvintothz
         physical_mode = self.physical_mode.reshape(frequency.shape)
-        kelvintojoule = units.kB / units.J
-        f_be = self.population
-        c_v[physical_mode] = kelvintojoule * f_be[physical_mode] * (f_be[physical_mode] + 1) * self.frequency[
-            physical_mode] ** 2 / (temperature ** 2)
-        return c_v
+        return calculate_heat_capacity(frequency, self.population, physical_mode, self.temperature * kelvintothz)
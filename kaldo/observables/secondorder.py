@@ -4,11 +4,18 @@ import os
 import tensorflow as tf
 import ase.io
 import numpy as np
+import scipy.sparse
+from scipy.sparse.linalg import splu
+from sparse import COO
+from kaldo.grid import wrap_coordinates
+from kaldo.observables.forceconstant import chi, frequency_to_eigenvalue
 from kaldo.interface.eskm_io import import_from_files
 import kaldo.interface.shengbte_io as shengbte_io
 from kaldo.controllers.displacement import calculate_second
 import ase.units as units
 from kaldo.helpers.logger import get_logger, log_size
+from kaldo.helpers.cache import calculate_fingerprint
+from opt_einsum import contract
 logging = get_logger()
 
 SECOND_ORDER_FILE = 'second.npy'
@@ -25,6 +32,34 @@ def acoustic_sum_rule(dynmat):
     return dynmat
 
 
+def calculate_pair_scatter(pair_i, pair_j, n_unit_cell):
+    n_pairs = pair_i.shape[0]
+    scatter = scipy.sparse.csr_matrix((np.ones(n_pairs), (pair_i * n_unit_cell + pair_j, np.arange(n_pairs))),
+                                      shape=(n_unit_cell ** 2, n_pairs))
+    return scatter
+
+
+def scatter_pairs(scatter, phase, pair_dynmat):
+    # Sums the phase-weighted (n_pairs, 3, 3) blocks into (n_q_points, n_modes, n_modes) dynamical matrices
+    n_unit_cell = int(np.sqrt(scatter.shape[0]))
+    n_q_points = phase.shape[1]
+    dyn_s = scatter.dot(contract('pq,pab->pqab', phase, pair_dynmat).reshape((-1, n_q_points * 9)))
+    dyn_s = dyn_s.reshape((n_unit_cell, n_unit_cell, n_q_points, 3, 3)).transpose(2, 0, 3, 1, 4)
+    return dyn_s.reshape((n_q_points, n_unit_cell * 3, n_unit_cell * 3))
+
+
+def count_eigenvalues_below(matrix, shift):
+    # Sylvester's law of inertia: the number of eigenvalues below shift is the number of negative pivots of the
+    # symmetric LDL^T factorization of matrix - shift
+    n_modes = matrix.shape[0]
+    shifted = (matrix - shift * scipy.sparse.identity(n_modes, format='csr')).tocsc()
+    factorization = splu(shifted, permc_spec='MMD_AT_PLUS_A', diag_pivot_thresh=0., options=dict(SymmetricMode=True))
+    if not (factorization.perm_r == factorization.perm_c).all():
+        logging.error('The factorization of the dynamical matrix is not symmetric, the inertia is not available')
+        raise ValueError('The factorization of the dynamical matrix is not symmetric, the inertia is not available')
+    return int(np.sum(factorization.U.diagonal() < 0))
+
+
 class SecondOrder(ForceConstant):
     def __init__(self, *kargs, **kwargs):
         ForceConstant.__init__(self, *kargs, **kwargs)
@@ -208,6 +243,98 @@ class SecondOrder(ForceConstant):
             return self._dynmat
 
 
+    def folded_pairs(self, distance_threshold):
+        """Pairs of atoms closer than distance_threshold, calculated once and shared by all the q-points."""
+        try:
+            return self._folded_pairs[distance_threshold]
+        except AttributeError:
+            self._folded_pairs = {}
+        except KeyError:
+            pass
+        self._folded_pairs[distance_threshold] = self.calculate_folded_pairs(distance_threshold)
+        return self._folded_pairs[distance_threshold]
+
+
+    @property
+    def value(self):
+        return self._value
+
+
+    @value.setter
+    def value(self, value):
+        # Assigning the force constants, also through an augmented assignment as value *= 2, resets the fingerprint
+        self._value = value
+        if hasattr(self, '_fingerprint'):
+            del self._fingerprint
+
+
+    @property
+    def fingerprint(self):
+        """Hash of the force constants, which identifies them in the HarmonicCache, calculated once for each value.
+        Changes of value that don't assign it, e.g. value[0] = 0, are not detected."""
+        try:
+            return self._fingerprint
+        except AttributeError:
+            self._fingerprint = calculate_fingerprint(self)
+            return self._fingerprint
+
+
+    @property
+    def sparse_dynmat(self):
+        try:
+            return self._sparse_dynmat
+        except AttributeError:
+            self._sparse_dynmat = self.calculate_sparse_dynmat()
+            return self._sparse_dynmat
+
+
+    def sparse_dynmat_derivatives(self, direction):
+        try:
+            return self._sparse_dynmat_derivatives[direction]
+        except AttributeError:
+            self._sparse_dynmat_derivatives = {}
+        except KeyError:
+            pass
+        self._sparse_dynmat_derivatives[direction] = self.calculate_sparse_dynmat(direction=direction)
+        return self._sparse_dynmat_derivatives[direction]
+
+
+    def n_modes_in_window(self, frequency_window):
+        """Number of modes with frequency inside frequency_window, calculated once for each window."""
+        frequency_window = tuple(frequency_window)
+        try:
+            return self._n_modes_in_window[frequency_window]
+        except AttributeError:
+            self._n_modes_in_window = {}
+        except KeyError:
+            pass
+        self._n_modes_in_window[frequency_window] = self.calculate_n_modes_in_window(frequency_window)
+        return self._n_modes_in_window[frequency_window]
+
+
+    def n_modes_below(self, frequency):
+        """Number of modes with frequency below frequency, in THz, calculated once for each frequency."""
+        frequency = float(frequency)
+        try:
+            return self._n_modes_below[frequency]
+        except AttributeError:
+            self._n_modes_below = {}
+        except KeyError:
+            pass
+        eigenvalue = frequency_to_eigenvalue(frequency)
+        self._n_modes_below[frequency] = count_eigenvalues_below(self.sparse_dynmat, eigenvalue)
+        return self._n_modes_below[frequency]
+
+
+    @property
+    def unfolding_weights(self):
+        try:
+            return self._unfolding_weights
+        except AttributeError:
+            self._unfolding_weights = self.calculate_unfolding_weights()
+            return self._unfolding_weights
+
+
     def calculate(self, calculator, delta_shift=1e-3, is_storing=True, is_verbose=False):
         atoms = self.atoms
         replicated_atoms = self.replicated_atoms
@@ -244,6 +371,199 @@ class SecondOrder(ForceConstant):
         return tf.convert_to_tensor(dynmat * evtotenjovermol)
 
 
+    def calculate_fourier_dynmat(self, q_points, direction=None):
+        """Calculate the Fourier transform of the dynamical matrix, or of its derivative along direction, for a
+        batch of q-points.
+
+        Returns
+        -------
+        dynmat : np.array
+            (n_q_points, n_modes, n_modes) complex
+        """
+        positions = self.atoms.positions
+        list_of_replicas = self.list_of_replicas
+        dynmat = self.dynmat.numpy()[0]
+        q_points = np.array(q_points).reshape((-1, 3))
+        n_q_points = q_points.shape[0]
+        chi_k = chi(q_points, list_of_replicas, self.cell_inv).T
+        if direction is None:
+            dyn_s = contract('ialjb,ql->qiajb', dynmat, chi_k)
+        else:
+            distance = positions[:, np.newaxis, np.newaxis, :] - (
+                    positions[np.newaxis, np.newaxis, :, :] + list_of_replicas[np.newaxis, :, np.newaxis, :])
+            if np.prod(self.supercell) == 1:
+                distance = wrap_coordinates(distance, self.replicated_atoms.cell, self.replicated_cell_inv)
+            dyn_s = contract('ilj,ialjb,ql->qiajb', distance[..., direction], dynmat, chi_k)
+        return dyn_s.reshape((n_q_points, self.n_modes, self.n_modes))
+
+
+    def calculate_sparse_dynmat(self, direction=None):
+        """Calculate the Gamma point dynamical matrix of an amorphous sample, or its derivative along direction, as a
+        sparse matrix built from the non zero elements of the force constants.
+
+        Returns
+        -------
+        dynmat : scipy.sparse.csr_matrix
+            (n_modes, n_modes) float
+        """
+        if np.prod(self.supercell) != 1:
+            logging.error('The sparse dynamical matrix is only available for amorphous samples')
+            raise ValueError('The sparse dynamical matrix is only available for amorphous samples')
+        positions = self.atoms.positions
+        if isinstance(self.value, COO):
+            coords = self.value.coords
+            data = self.value.data
+        else:
+            coords = np.nonzero(self.value)
+            data = self.value[coords]
+        _, i, alpha, _, j, beta = coords
+        mass = self.atoms.get_masses()
+        evtotenjovermol = units.mol / (10 * units.J)
+        data = data / np.sqrt(mass[i] * mass[j]) * evtotenjovermol
+        if direction is not None:
+            distance = wrap_coordinates(positions[i] - positions[j], self.replicated_atoms.cell,
+                                        self.replicated_cell_inv)
+            data = data * distance[:, direction]
+        dynmat = scipy.sparse.csr_matrix((data, (i * 3 + alpha, j * 3 + beta)), shape=(self.n_modes, self.n_modes))
+        if direction is None:
+            # The iterative eigensolvers only see a symmetric matrix
+            dynmat = (dynmat + dynmat.T) / 2
+        log_size((dynmat.nnz, ), np.float, name='sparse_dynmat')
+        return dynmat
+
+
+    def calculate_n_modes_in_window(self, frequency_window):
+        """Count the modes with frequency inside frequency_window, in THz, from the inertia of the sparse dynamical
+        matrix shifted at the edges of the window. No eigenvalue is calculated."""
+        if frequency_window[0] >= frequency_window[1]:
+            logging.error('The frequency window must be (min_frequency, max_frequency)')
+            raise ValueError('The frequency window must be (min_frequency, max_frequency)')
+        n_modes = self.n_modes_below(frequency_window[1]) - self.n_modes_below(frequency_window[0])
+        logging.info(str(n_modes) + ' modes between ' + str(frequency_window[0]) + ' and '
+                     + str(frequency_window[1]) + ' THz')
+        return n_modes
+
+
+    def calculate_folded_pairs(self, distance_threshold):
+        """Calculate the sparse list of interacting pairs used by the folded dynamical matrix.
+
+        Parameters
+        ----------
+        distance_threshold : float
+            pairs of atoms whose wrapped distance exceeds the threshold are ignored. Units: A
+
+        Returns
+        -------
+        folded_pairs : tuple
+            replica index (n_pairs), distance vector (n_pairs, 3), masked dynamical matrix blocks (n_pairs, 3, 3)
+            and a scatter matrix (n_unit_cell ** 2, n_pairs) which sums each pair into its (i, j) block
+        """
+        atoms = self.atoms
+        positions = atoms.positions
+        n_unit_cell = positions.shape[0]
+        n_replicas = np.prod(self.supercell)
+        replicated_cell = self.replicated_atoms.cell
+        replicated_positions = self.replicated_atoms.positions.reshape((n_replicas, n_unit_cell, 3))
+        list_of_replicas = self.list_of_replicas
+        dynmat = self.dynmat.numpy()
+        pair_i = []
+        pair_l = []
+        pair_j = []
+        for l in range(n_replicas):
+            distance_to_wrap = positions[:, np.newaxis, :] - replicated_positions[np.newaxis, l, :, :]
+            distance_to_wrap = wrap_coordinates(distance_to_wrap, replicated_cell, self.replicated_cell_inv)
+            mask = np.linalg.norm(distance_to_wrap, axis=-1) < distance_threshold
+            id_i, id_j = np.argwhere(mask).T
+            pair_i.append(id_i)
+            pair_l.append(np.full(id_i.shape, l))
+            pair_j.append(id_j)
+        pair_i = np.concatenate(pair_i)
+        pair_l = np.concatenate(pair_l)
+        pair_j = np.concatenate(pair_j)
+        n_pairs = pair_i.shape[0]
+        logging.info('Folded dynamical matrix: ' + str(n_pairs) + ' pairs within ' + str(distance_threshold) + ' A')
+        distance = positions[pair_i] - (positions[pair_j] + list_of_replicas[pair_l])
+        pair_dynmat = dynmat[0, pair_i, :, pair_l, pair_j, :]
+        scatter = calculate_pair_scatter(pair_i, pair_j, n_unit_cell)
+        return pair_l, distance, pair_dynmat, scatter
+
+
+    def calculate_folded_dynmat(self, q_points, distance_threshold, direction=None):
+        """Calculate the folded dynamical matrix, or its derivative along direction, for a batch of q-points.
+
+        Returns
+        -------
+        dynmat : np.array
+            (n_q_points, n_modes, n_modes) complex
+        """
+        pair_l, distance, pair_dynmat, scatter = self.folded_pairs(distance_threshold)
+        q_points = np.array(q_points).reshape((-1, 3))
+        phase = chi(q_points, self.list_of_replicas, self.cell_inv)[pair_l]
+        if direction is not None:
+            phase = phase * distance[:, direction, np.newaxis]
+        return scatter_pairs(scatter, phase, pair_dynmat)
+
+
+    def calculate_unfolding_weights(self):
+        """Calculate the Wigner-Seitz weights used to unfold the force constants, looping only on the replicas.
+
+        Returns
+        -------
+        unfolding_weights : tuple
+            replica vectors t (n_pairs, 3), atom indices iat and jat (n_pairs), weights (n_pairs)
+            and a scatter matrix (n_unit_cell ** 2, n_pairs)
+        """
+        positions = self.atoms.positions
+        n_unit_cell = positions.shape[0]
+        cell = self.atoms.cell
+        sc_r_pos = self.supercell_positions
+        sc_r_pos_norm = 1 / 2 * np.linalg.norm(sc_r_pos, axis=1) ** 2
+        tt = self.supercell_replicas
+        atoms_distance = positions[:, np.newaxis, :] - positions[np.newaxis, :, :]
+        pair_t = []
+        pair_i = []
+        pair_j = []
+        pair_weight = []
+        for ind in range(tt.shape[0]):
+            replica_position = np.tensordot(tt[ind], cell, (-1, 0))
+            distance = replica_position + atoms_distance
+            projection = distance.dot(sc_r_pos.T) - sc_r_pos_norm
+            id_i, id_j = np.argwhere((projection <= 1e-6).all(axis=-1)).T
+            neq = (np.abs(projection[id_i, id_j]) <= 1e-6).sum(axis=-1)
+            pair_t.append(np.full(id_i.shape, ind))
+            pair_i.append(id_i)
+            pair_j.append(id_j)
+            pair_weight.append(1.0 / neq)
+        pair_t = tt[np.concatenate(pair_t)]
+        pair_i = np.concatenate(pair_i)
+        pair_j = np.concatenate(pair_j)
+        pair_weight = np.concatenate(pair_weight)
+        scatter = calculate_pair_scatter(pair_i, pair_j, n_unit_cell)
+        return pair_t, pair_i, pair_j, pair_weight, scatter
+
+
+    def calculate_unfolded_dynmat(self, q_points, direction=None):
+        """Calculate the unfolded dynamical matrix, or its derivative along direction, for a batch of q-points.
+
+        Returns
+        -------
+        dynmat : np.array
+            (n_q_points, n_modes, n_modes) complex
+        """
+        pair_t, pair_i, pair_j, pair_weight, scatter = self.unfolding_weights
+        supercell = self.supercell
+        n_unit_cell = self.atoms.positions.shape[0]
+        fc_s = self.dynmat.numpy().reshape((n_unit_cell, 3, supercell[0], supercell[1], supercell[2], n_unit_cell, 3))
+        replica_id = np.mod(pair_t, supercell)
+        pair_dynmat = fc_s[pair_j, :, replica_id[:, 0], replica_id[:, 1], replica_id[:, 2], pair_i, :]
+        pair_dynmat = pair_dynmat.transpose(0, 2, 1) * pair_weight[:, np.newaxis, np.newaxis]
+        q_points = np.array(q_points).reshape((-1, 3))
+        phase = np.exp(-1j * 2. * np.pi * pair_t.dot(q_points.T))
+        if direction is not None:
+            phase = - phase * np.tensordot(pair_t, self.atoms.cell, (-1, 0))[:, direction, np.newaxis]
+        return scatter_pairs(scatter, phase, pair_dynmat)
+
+
     def calculate_super_replicas(self):
         scell = self.supercell
         n_replicas = np.prod(scell)
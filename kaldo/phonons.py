@@ -7,15 +7,31 @@ from kaldo.helpers.storage import is_calculated
 from kaldo.helpers.storage import lazy_property
 from kaldo.helpers.logger import log_size
 from kaldo.helpers.storage import DEFAULT_STORE_FORMATS, FOLDER_NAME
+from kaldo.helpers.storage import get_folder_from_label, load, save
 from kaldo.grid import Grid
 from kaldo.observables.harmonic_with_q import HarmonicWithQ
 from kaldo.observables.harmonic_with_q_temp import HarmonicWithQTemp
+from kaldo.observables.forceconstant import frequency_to_eigenvalue
+from kaldo.helpers.parallel import parallel_map
 import kaldo.controllers.anharmonic as aha
+from functools import partial
 import numpy as np
+from scipy.sparse import csr_matrix
 import ase.units as units
 from kaldo.helpers.logger import get_logger
 logging = get_logger()
 
+# Arrays of the compressed rows of the scattering tensor, stored next to _ps_gamma_and_gamma_tensor
+SCATTERING_ROWS_NAMES = ('_rows_ps_and_gamma', '_scattering_rows_data', '_scattering_rows_indices',
+                         '_scattering_rows_indptr')
+
+
+def calculate_harmonic_with_q(q_point, properties, harmonic_class, harmonic_kwargs):
+    """Calculate the requested properties of a single q-point. It's defined at module level to be sent to the
+    worker processes."""
+    phonon = harmonic_class(q_point=q_point, **harmonic_kwargs)
+    return [getattr(phonon, name) for name in properties]
+
 
 class Phonons:
     """The Phonons object exposes all the phononic properties of a system.
@@ -63,6 +79,27 @@ class Phonons:
         Default 'C'
     is_balanced : Enforce detailed balance when calculating anharmonic properties,
         Default: False
+    n_workers : int, optional
+        number of processes used to calculate the harmonic properties on the k points mesh. When larger than 1,
+        the script must be protected by `if __name__ == '__main__':`.
+        Default is 1
+    n_blas_threads : int, optional
+        number of BLAS and tensorflow threads in each worker process. If `None` the libraries defaults are used.
+        Default is `None`
+    parallel_backend : 'processes', 'threads', optional
+        how the k points are distributed on the n_workers. 'threads' share the memory of the current process and do
+        not need the `if __name__ == '__main__':` protection.
+        Default is 'processes'
+    frequency_window : (2) tuple, optional
+        (Amorphous) calculates only the modes with frequency between frequency_window[0] and frequency_window[1]
+        THz, using a shift-invert sparse eigensolver instead of the dense diagonalization. All the harmonic
+        properties, and n_modes, refer only to the modes inside the window.
+        Default is `None`
+    harmonic_cache : HarmonicCache, optional
+        cache of the harmonic properties of each q point, keyed by force constants, q point and options, so that
+        they are reused across meshes, by the conductivity and by the plotter. The same HarmonicCache can be given
+        to many Phonons objects.
+        Default is `None`, which disables the cache
 
     Returns
     -------
@@ -91,11 +128,18 @@ class Phonons:
         self.is_symmetrizing_frequency = kwargs.pop('is_symmetrizing_frequency', False)
         self.is_antisymmetrizing_velocity = kwargs.pop('is_antisymmetrizing_velocity', False)
         self.is_balanced = kwargs.pop('is_balanced', False)
+        self.n_workers = kwargs.pop('n_workers', 1)
+        self.n_blas_threads = kwargs.pop('n_blas_threads', None)
+        self.parallel_backend = kwargs.pop('parallel_backend', 'processes')
+        self.frequency_window = kwargs.pop('frequency_window', None)
+        self.harmonic_cache = kwargs.pop('harmonic_cache', None)
         self.atoms = self.forceconstants.atoms
         self.supercell = np.array(self.forceconstants.supercell)
         self.n_k_points = int(np.prod(self.kpts))
         self.n_atoms = self.forceconstants.n_atoms
         self.n_modes = self.forceconstants.n_modes
+        if self.frequency_window is not None:
+            self.n_modes = self.forceconstants.second.n_modes_in_window(self.frequency_window)
         self.n_phonons = self.n_k_points * self.n_modes
         self.is_able_to_calculate = True
         self.hbar = units._hbar
@@ -113,20 +157,7 @@ class Phonons:
         physical_mode : np array
             (n_k_points, n_modes) bool
         """
-        q_points = self._reciprocal_grid.unitary_grid(is_wrapping=False)
-        physical_mode = np.zeros((self.n_k_points, self.n_modes), dtype=np.bool)
-
-        for ik in range(len(q_points)):
-            q_point = q_points[ik]
-            phonon = HarmonicWithQ(q_point=q_point,
-                                   second=self.forceconstants.second,
-                                   distance_threshold=self.forceconstants.distance_threshold,
-                                   folder=self.folder,
-                                   storage=self.storage,
-                                   is_nw=self.is_nw,
-                                   is_unfolding=self.is_unfolding)
-
-            physical_mode[ik] = phonon.physical_mode
+        physical_mode = self._calculate_harmonic_sweep(['physical_mode'], [(self.n_modes, )], [np.bool])[0]
         if self.min_frequency is not None:
             physical_mode[self.frequency < self.min_frequency] = False
         if self.max_frequency is not None:
@@ -142,20 +173,7 @@ class Phonons:
         frequency : np array
             (n_k_points, n_modes) frequency in THz
         """
-        q_points = self._reciprocal_grid.unitary_grid(is_wrapping=False)
-        frequency = np.zeros((self.n_k_points, self.n_modes))
-        for ik in range(len(q_points)):
-            q_point = q_points[ik]
-            phonon = HarmonicWithQ(q_point=q_point,
-                                   second=self.forceconstants.second,
-                                   distance_threshold=self.forceconstants.distance_threshold,
-                                   folder=self.folder,
-                                   storage=self.storage,
-                                   is_nw=self.is_nw,
-                                   is_unfolding=self.is_unfolding)
-
-            frequency[ik] = phonon.frequency
-
+        frequency = self._calculate_harmonic_sweep(['frequency'], [(self.n_modes, )])[0]
         return frequency
 
 
@@ -168,51 +186,25 @@ class Phonons:
         velocity : np array
             (n_k_points, n_unit_cell * 3, 3) velocity in 100m/s or A/ps
         """
-
-        q_points = self._reciprocal_grid.unitary_grid(is_wrapping=False)
-        velocity = np.zeros((self.n_k_points, self.n_modes, 3))
-        for ik in range(len(q_points)):
-            q_point = q_points[ik]
-            phonon = HarmonicWithQ(q_point=q_point,
-                                   second=self.forceconstants.second,
-                                   distance_threshold=self.forceconstants.distance_threshold,
-                                   folder=self.folder,
-                                   storage=self.storage,
-                                   is_nw=self.is_nw,
-                                   is_unfolding=self.is_unfolding)
-            velocity[ik] = phonon.velocity
+        velocity = self._calculate_harmonic_sweep(['velocity'], [(self.n_modes, 3)])[0]
         return velocity
 
 
     @lazy_property(label='')
-    def _eigensystem(self):
-        """Calculate the eigensystems, for each k point in k_points.
+    def eigenvectors(self):
+        """Calculate the eigenvectors of the dynamical matrix, for each k point in k_points. When all the
+        eigensystems are real, like in amorphous samples, the eigenvectors are stored as real numbers.
 
         Returns
         -------
-        _eigensystem : np.array(n_k_points, n_unit_cell * 3, n_unit_cell * 3 + 1)
-            eigensystem is calculated for each k point, the three dimensional array
-            records the eigenvalues in the last column of the last dimension.
-
-            If the system is not amorphous, these values are stored as complex numbers.
+        eigenvectors : np.array
+            (n_k_points, n_unit_cell * 3, n_modes) eigenvectors of the dynamical matrix in the columns
         """
-        q_points = self._reciprocal_grid.unitary_grid(is_wrapping=False)
-        shape = (self.n_k_points, self.n_modes + 1, self.n_modes)
-        log_size(shape, name='eigensystem', type=np.complex)
-        eigensystem = np.zeros(shape, dtype=np.complex)
-        for ik in range(len(q_points)):
-            q_point = q_points[ik]
-            phonon = HarmonicWithQ(q_point=q_point,
-                                   second=self.forceconstants.second,
-                                   distance_threshold=self.forceconstants.distance_threshold,
-                                   folder=self.folder,
-                                   storage=self.storage,
-                                   is_nw=self.is_nw,
-                                   is_unfolding=self.is_unfolding)
-
-            eigensystem[ik] = phonon._eigensystem
-
-        return eigensystem
+        shape = (self.n_atoms * 3, self.n_modes)
+        dtype = np.float if self._is_eigensystem_real else np.complex
+        log_size((self.n_k_points, ) + shape, name='eigenvectors', type=dtype)
+        eigenvectors = self._calculate_harmonic_sweep(['_eigenvectors'], [shape], [dtype])[0]
+        return eigenvectors
 
 
     @lazy_property(label='<temperature>/<statistics>')
@@ -231,20 +223,7 @@ class Phonons:
         c_v : np.array(n_k_points, n_modes)
             heat capacity in W/m/K for each k point and each mode
         """
-        q_points = self._reciprocal_grid.unitary_grid(is_wrapping=False)
-        c_v = np.zeros((self.n_k_points, self.n_modes))
-        for ik in range(len(q_points)):
-            q_point = q_points[ik]
-            phonon = HarmonicWithQTemp(q_point=q_point,
-                                       second=self.forceconstants.second,
-                                       distance_threshold=self.forceconstants.distance_threshold,
-                                       folder=self.folder,
-                                       storage=self.storage,
-                                       temperature=self.temperature,
-                                       is_classic=self.is_classic,
-                                       is_nw=self.is_nw,
-                                       is_unfolding=self.is_unfolding)
-            c_v[ik] = phonon.heat_capacity
+        c_v = self._calculate_harmonic_sweep(['heat_capacity'], [(self.n_modes, )], is_temperature_dependent=True)[0]
         return c_v
 
 
@@ -258,22 +237,10 @@ class Phonons:
         heat_capacity_2d : np.array(n_k_points, n_modes, n_modes)
             heat capacity in W/m/K for each k point and each modes couple.
         """
-        q_points = self._reciprocal_grid.unitary_grid(is_wrapping=False)
-        shape = (self.n_k_points, self.n_modes, self.n_modes)
-        log_size(shape, name='heat_capacity_2d', type=np.float)
-        heat_capacity_2d = np.zeros(shape)
-        for ik in range(len(q_points)):
-            q_point = q_points[ik]
-            phonon = HarmonicWithQTemp(q_point=q_point,
-                                       second=self.forceconstants.second,
-                                       distance_threshold=self.forceconstants.distance_threshold,
-                                       folder=self.folder,
-                                       storage=self.storage,
-                                       temperature=self.temperature,
-                                       is_classic=self.is_classic,
-                                       is_nw=self.is_nw,
-                                       is_unfolding=self.is_unfolding)
-            heat_capacity_2d[ik] = phonon.heat_capacity_2d
+        shape = (self.n_modes, self.n_modes)
+        log_size((self.n_k_points, ) + shape, name='heat_capacity_2d', type=np.float)
+        heat_capacity_2d = self._calculate_harmonic_sweep(['heat_capacity_2d'], [shape],
+                                                          is_temperature_dependent=True)[0]
         return heat_capacity_2d
 
 
@@ -288,20 +255,8 @@ class Phonons:
         population : np.array(n_k_points, n_modes)
             population for each k point and each mode
         """
-        q_points = self._reciprocal_grid.unitary_grid(is_wrapping=False)
-        population = np.zeros((self.n_k_points, self.n_modes))
-        for ik in range(len(q_points)):
-            q_point = q_points[ik]
-            phonon = HarmonicWithQTemp(q_point=q_point,
-                                       second=self.forceconstants.second,
-                                       distance_threshold=self.forceconstants.distance_threshold,
-                                       folder=self.folder,
-                                       storage=self.storage,
-                                       temperature=self.temperature,
-                                       is_classic=self.is_classic,
-                                       is_nw=self.is_nw,
-                                       is_unfolding=self.is_unfolding)
-            population[ik] = phonon.population
+        population = self._calculate_harmonic_sweep(['population'], [(self.n_modes, )],
+                                                    is_temperature_dependent=True)[0]
         return population
 
 
@@ -333,28 +288,30 @@ class Phonons:
 
     @lazy_property(label='')
     def eigenvalues(self):
-        """Calculates the eigenvalues of the dynamical matrix in Thz^2.
+        """Calculates the eigenvalues of the dynamical matrix in (rad/ps)^2. Negative eigenvalues correspond to
+        imaginary frequencies.
 
         Returns
         -------
         eigenvalues : np array
-            (n_phonons) Eigenvalues of the dynamical matrix
+            (n_k_points, n_modes) Eigenvalues of the dynamical matrix
         """
-        eigenvalues = self._eigensystem[:, 0, :]
+        eigenvalues = frequency_to_eigenvalue(self.frequency)
         return eigenvalues
 
 
     @property
-    def eigenvectors(self):
-        """Calculates the eigenvectors of the dynamical matrix.
+    def _eigensystem(self):
+        """Eigenvalues in the first row and eigenvectors, for each k point in k_points. It's assembled on each
+        access, use eigenvalues and eigenvectors instead.
 
         Returns
         -------
-        eigenvectors : np array
-            (n_phonons, n_phonons) Eigenvectors of the dynamical matrix
+        _eigensystem : np.array(n_k_points, n_unit_cell * 3 + 1, n_modes)
         """
-        eigenvectors = self._eigensystem[:, 1:, :]
-        return eigenvectors
+        eigenvectors = self.eigenvectors
+        eigenvalues = self.eigenvalues.astype(eigenvectors.dtype)
+        return np.concatenate((eigenvalues[:, np.newaxis, :], eigenvectors), axis=1)
 
 
     @lazy_property(label='<temperature>/<statistics>/<third_bandwidth>')
@@ -364,6 +321,8 @@ class Phonons:
         if is_calculated('_ps_gamma_and_gamma_tensor', self, '<temperature>/<statistics>/<third_bandwidth>', \
                          format=store_format):
             ps_and_gamma = self._ps_gamma_and_gamma_tensor[:, :2]
+        elif hasattr(self, '_rows_ps_and_gamma') or self._load_scattering_rows():
+            ps_and_gamma = self._rows_ps_and_gamma
         else:
             ps_and_gamma = self._select_algorithm_for_phase_space_and_gamma(is_gamma_tensor_enabled=False)
         return ps_and_gamma
@@ -371,9 +330,115 @@ class Phonons:
 
     @lazy_property(label='<temperature>/<statistics>/<third_bandwidth>')
     def _ps_gamma_and_gamma_tensor(self):
+        if hasattr(self, '_rows_ps_and_gamma') or self._load_scattering_rows():
+            # The projection was already done while storing the compressed rows
+            return np.hstack([self._rows_ps_and_gamma, self._scattering_rows_csr.toarray()])
         ps_gamma_and_gamma_tensor = self._select_algorithm_for_phase_space_and_gamma(is_gamma_tensor_enabled=True)
         return ps_gamma_and_gamma_tensor
 
+
+    @property
+    def _scattering_rows(self):
+        """Scattering tensor, the same of _ps_gamma_and_gamma_tensor[:, 2:], stored as compressed sparse rows. Unless
+        the dense tensor was already calculated, the rows are stored during the projection, and the dense
+        n_phonons x n_phonons array is never allocated. Data, indices and pointers of the rows are saved in the
+        folder of _ps_gamma_and_gamma_tensor, with the same format.
+
+        Returns
+        -------
+        _scattering_rows : scipy.sparse.csr_matrix
+            (n_phonons, n_phonons)
+        """
+        try:
+            return self._scattering_rows_csr
+        except AttributeError:
+            pass
+        store_format = DEFAULT_STORE_FORMATS['_ps_gamma_and_gamma_tensor'] \
+            if self.storage == 'formatted' else self.storage
+        if is_calculated('_ps_gamma_and_gamma_tensor', self, '<temperature>/<statistics>/<third_bandwidth>', \
+                         format=store_format):
+            self._scattering_rows_csr = csr_matrix(np.nan_to_num(self._ps_gamma_and_gamma_tensor[:, 2:]))
+            return self._scattering_rows_csr
+        if self._load_scattering_rows():
+            return self._scattering_rows_csr
+        self._rows_ps_and_gamma, self._scattering_rows_csr = self.calculate_scattering_rows()
+        if store_format != 'memory':
+            folder = get_folder_from_label(self, '<temperature>/<statistics>/<third_bandwidth>')
+            scattering_rows = self._scattering_rows_csr
+            arrays = (self._rows_ps_and_gamma, scattering_rows.data, scattering_rows.indices, scattering_rows.indptr)
+            for name, array in zip(SCATTERING_ROWS_NAMES, arrays):
+                save(name, folder, array, format=store_format)
+        return self._scattering_rows_csr
+
+
+    def _load_scattering_rows(self):
+        # Load the compressed rows saved by _scattering_rows, returns False when they are not stored
+        store_format = DEFAULT_STORE_FORMATS['_ps_gamma_and_gamma_tensor'] \
+            if self.storage == 'formatted' else self.storage
+        if store_format == 'memory':
+            return False
+        folder = get_folder_from_label(self, '<temperature>/<statistics>/<third_bandwidth>')
+        try:
+            ps_and_gamma, data, indices, indptr = [load(name, folder, self, format=store_format)
+                                                   for name in SCATTERING_ROWS_NAMES]
+        except (FileNotFoundError, OSError, KeyError):
+            return False
+        logging.info('Loading ' + folder + '/_scattering_rows')
+        self._rows_ps_and_gamma = ps_and_gamma
+        self._scattering_rows_csr = csr_matrix((data, indices, indptr), shape=(self.n_phonons, self.n_phonons))
+        return True
+
+
+    @property
+    def _physical_scattering_rows(self):
+        """Scattering matrix of the physical modes, -_scattering_rows restricted to them, without rescalings. It's
+        built once and shared by the ScatteringOperator of all the Conductivity objects of these phonons.
+
+        Returns
+        -------
+        _physical_scattering_rows : scipy.sparse.csr_matrix
+            (n_physical, n_physical)
+        """
+        try:
+            return self._physical_scattering_rows_csr
+        except AttributeError:
+            physical_index = self._physical_index
+            scattering_rows = -1 * self._scattering_rows[physical_index][:, physical_index]
+            self._physical_scattering_rows_csr = scattering_rows.tocsr()
+            return self._physical_scattering_rows_csr
+
+
+    def clear_scattering_cache(self):
+        """Release the compressed scattering rows of the physical modes kept in memory and shared by the
+        Conductivity objects. They are built again when needed."""
+        if hasattr(self, '_physical_scattering_rows_csr'):
+            del self._physical_scattering_rows_csr
+
+
+    def calculate_scattering_rows(self):
+        """Project the third order force constants and store the rows of the scattering tensor as compressed sparse
+        rows, without allocating the dense tensor.
+
+        Returns
+        -------
+        ps_and_gamma : np.array
+            (n_phonons, 2) phase space and bandwidth
+        scattering_rows : scipy.sparse.csr_matrix
+            (n_phonons, n_phonons)
+        """
+        if self._is_amorphous:
+            logging.error('The scattering tensor is only available for crystals')
+            raise ValueError('The scattering tensor is only available for crystals')
+        self.n_k_points = np.prod(self.kpts)
+        self.n_phonons = self.n_k_points * self.n_modes
+        self.is_gamma_tensor_enabled = True
+        rows = []
+        ps_and_gamma = aha.project_crystal(self, scattering_rows=rows)
+        indptr = np.concatenate([[0], np.cumsum([len(indices) for indices, _ in rows])])
+        indices = np.concatenate([indices for indices, _ in rows])
+        values = np.concatenate([values for _, values in rows])
+        return ps_and_gamma, csr_matrix((values, indices, indptr), shape=(self.n_phonons, self.n_phonons))
+
 # Helpers properties
 
     @property
@@ -390,14 +455,27 @@ class Phonons:
 
     @property
     def _rescaled_eigenvectors(self):
-        n_atoms = self.n_atoms
-        n_modes = self.n_modes
-        masses = self.atoms.get_masses()
-        rescaled_eigenvectors = self.eigenvectors[:, :, :].reshape(
-            (self.n_k_points, n_atoms, 3, n_modes)) / np.sqrt(
-            masses[np.newaxis, :, np.newaxis, np.newaxis])
-        rescaled_eigenvectors = rescaled_eigenvectors.reshape((self.n_k_points, n_modes, n_modes))
-        return rescaled_eigenvectors
+        try:
+            return self._mass_rescaled_eigenvectors
+        except AttributeError:
+            masses = self.atoms.get_masses()
+            sqrt_masses = np.repeat(np.sqrt(masses), 3)
+            self._mass_rescaled_eigenvectors = self.eigenvectors / sqrt_masses[np.newaxis, :, np.newaxis]
+            return self._mass_rescaled_eigenvectors
+
+
+    @property
+    def _physical_index(self):
+        """Indices of the physical modes among the n_phonons, the compact index space of the scattering matrices."""
+        return np.flatnonzero(self.physical_mode.reshape(self.n_phonons))
+
+
+    @property
+    def _is_eigensystem_real(self):
+        # The dynamical matrix is real only at Gamma, without the complex phases of folding and unfolding
+        is_real = self._is_amorphous and (not self.is_unfolding) and \
+                  (self.forceconstants.distance_threshold is None)
+        return is_real
 
 
     @property
@@ -417,6 +495,26 @@ class Phonons:
         return index_qpp_full
 
 
+    def _calculate_harmonic_sweep(self, properties, shapes, dtypes=None, is_temperature_dependent=False):
+        harmonic_kwargs = dict(second=self.forceconstants.second,
+                               distance_threshold=self.forceconstants.distance_threshold,
+                               folder=self.folder,
+                               storage=self.storage,
+                               is_nw=self.is_nw,
+                               is_unfolding=self.is_unfolding,
+                               frequency_window=self.frequency_window,
+                               cache=self.harmonic_cache)
+        harmonic_class = HarmonicWithQ
+        if is_temperature_dependent:
+            harmonic_class = HarmonicWithQTemp
+            harmonic_kwargs.update(temperature=self.temperature, is_classic=self.is_classic)
+        calculate = partial(calculate_harmonic_with_q, properties=properties, harmonic_class=harmonic_class,
+                            harmonic_kwargs=harmonic_kwargs)
+        q_points = self._reciprocal_grid.unitary_grid(is_wrapping=False)
+        return parallel_map(calculate, q_points, shapes, dtypes, n_workers=self.n_workers,
+                            n_blas_threads=self.n_blas_threads, backend=self.parallel_backend)
+
+
     def _select_algorithm_for_phase_space_and_gamma(self, is_gamma_tensor_enabled=True):
         self.n_k_points = np.prod(self.kpts)
         self.n_phonons = self.n_k_points * self.n_modes
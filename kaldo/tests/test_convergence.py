@@ -0,0 +1,43 @@
+"""
+Unit and regression test for the kaldo package.
+"""
+
+# Import package, test suite, and other packages as needed
+from kaldo.forceconstants import ForceConstants
+from kaldo.controllers.convergence import calculate_conductivity_vs_mesh, extrapolate_conductivity
+from kaldo.helpers.cache import HarmonicCache
+import numpy as np
+import pytest
+
+
+@pytest.yield_fixture(scope="session")
+def forceconstants():
+    print ("Preparing force constants object.")
+    forceconstants = ForceConstants.from_folder(folder='kaldo/tests/si-crystal',
+                                                supercell=[3, 3, 3],
+                                                format='eskm')
+    return forceconstants
+
+
+def test_extrapolation():
+    kpts = [[2, 2, 2], [4, 4, 4], [8, 8, 8]]
+    conductivity = np.array([10 + 3 / mesh[0] for mesh in kpts])
+    np.testing.assert_allclose(extrapolate_conductivity(kpts, conductivity), 10)
+    conductivity = np.array([10 + 3 / mesh[0] ** 2 for mesh in kpts])
+    np.testing.assert_allclose(extrapolate_conductivity(kpts, conductivity, order=2), 10)
+
+
+def test_conductivity_vs_mesh(forceconstants):
+    cache = HarmonicCache()
+    phonons_kwargs = dict(is_classic=False, temperature=300, storage='memory', harmonic_cache=cache)
+    conductivity_kwargs = dict(method='qhgk', diffusivity_bandwidth=0.1, storage='memory')
+    conductivity, extrapolated_conductivity = calculate_conductivity_vs_mesh(forceconstants,
+                                                                             [[2, 2, 2], [4, 4, 4], [8, 8, 8]],
+                                                                             tolerance=1e6,
+                                                                             phonons_kwargs=phonons_kwargs,
+                                                                             conductivity_kwargs=conductivity_kwargs)
+    # The loose tolerance stops the sweep as soon as the extrapolation is available
+    assert conductivity.shape == (2, 3, 3)
+    # Only the q points of the largest mesh were calculated, the ones of the smallest mesh are shared
+    assert len([key for key in cache._entries if key[-1] == 'frequency']) == 64
+    np.testing.assert_allclose(extrapolated_conductivity, 2 * conductivity[1] - conductivity[0])
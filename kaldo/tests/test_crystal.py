@@ -6,7 +6,8 @@ Unit and regression test for the kaldo package.
 from kaldo.forceconstants import ForceConstants
 import numpy as np
 from kaldo.phonons import Phonons
-from kaldo.conductivity import Conductivity
+from kaldo.conductivity import Conductivity, bin_conductivity, cumulate_conductivity
+from kaldo.helpers.storage import get_folder_from_label
 import pytest
 
 
@@ -43,4 +44,141 @@ def test_rta_conductivity(phonons):
 
 def test_inverse_conductivity(phonons):
     cond = np.abs(np.mean(Conductivity(phonons=phonons, method='inverse', storage='memory').conductivity.sum(axis=0).diagonal()))
-    np.testing.assert_approx_equal(cond, 256, significant=3)
\ No newline at end of file
+    np.testing.assert_approx_equal(cond, 256, significant=3)
+
+
+def test_inverse_conductivity_cg(phonons):
+    conductivity = Conductivity(phonons=phonons, method='inverse', solver='cg', storage='memory')
+    cond = np.abs(np.mean(conductivity.conductivity.sum(axis=0).diagonal()))
+    # The conjugate gradient solves the symmetrized scattering matrix
+    np.testing.assert_approx_equal(cond, 256, significant=2)
+    assert conductivity.solver_residuals[-1].max() < conductivity.solver_tolerance
+
+
+def test_inverse_conductivity_cg_max_iterations(phonons):
+    # The self consistent n_iterations doesn't limit the conjugate gradient
+    conductivity = Conductivity(phonons=phonons, method='inverse', solver='cg', n_iterations=1,
+                                solver_max_iterations=3, storage='memory')
+    conductivity.conductivity
+    assert conductivity.solver_residuals.shape[0] == 4
+
+
+def test_solver_storage_folder(phonons):
+    label = '<temperature>/<statistics>/<third_bandwidth>/<method>/<length>/<finite_length_method>/<solver>'
+    direct = Conductivity(phonons=phonons, method='inverse', storage='numpy')
+    cg = Conductivity(phonons=phonons, method='inverse', solver='cg', storage='numpy')
+    rta = Conductivity(phonons=phonons, method='rta', solver='cg', storage='numpy')
+    assert get_folder_from_label(direct, label) == get_folder_from_label(direct, label.replace('/<solver>', ''))
+    assert get_folder_from_label(cg, label) == get_folder_from_label(direct, label) + '/solver_cg'
+    # Only the inverse method depends on the solver
+    assert get_folder_from_label(rta, label) == get_folder_from_label(rta, label.replace('/<solver>', ''))
+
+
+def test_inverse_conductivity_cholesky(phonons):
+    cholesky = Conductivity(phonons=phonons, method='inverse', solver='cholesky', storage='memory')
+    cg = Conductivity(phonons=phonons, method='inverse', solver='cg', storage='memory')
+    np.testing.assert_allclose(cholesky.conductivity.sum(axis=0), cg.conductivity.sum(axis=0), rtol=1e-6)
+    # The three directions share the same factorization
+    assert list(cholesky._scattering_factorizations) == [('cholesky', None)]
+    cholesky.clear_scattering_cache()
+    assert len(cholesky._scattering_factorizations) == 0
+
+
+def test_sc_conductivity_anderson(phonons):
+    plain = Conductivity(phonons=phonons, method='sc', tolerance=1e-3, storage='memory')
+    accelerated = Conductivity(phonons=phonons, method='sc', tolerance=1e-3, anderson_depth=5, storage='memory')
+    np.testing.assert_allclose(accelerated.conductivity.sum(axis=0), plain.conductivity.sum(axis=0), rtol=1e-5)
+    assert accelerated.n_sc_iterations < plain.n_sc_iterations
+    warm_started = Conductivity(phonons=phonons, method='sc', tolerance=1e-3, anderson_depth=5, storage='memory',
+                                initial_mean_free_path=accelerated.mean_free_path)
+    np.testing.assert_allclose(warm_started.conductivity.sum(axis=0), plain.conductivity.sum(axis=0), rtol=1e-5)
+    assert warm_started.n_sc_iterations <= 2
+
+
+def test_full_conductivity(phonons):
+    full = Conductivity(phonons=phonons, method='full', storage='memory').conductivity.sum(axis=0)
+    inverse = Conductivity(phonons=phonons, method='inverse', solver='cholesky', storage='memory')
+    np.testing.assert_allclose(full, inverse.conductivity.sum(axis=0), rtol=1e-4, atol=1e-3)
+    finite_size = Conductivity(phonons=phonons, method='full', length=(1e4, 1e4, 1e4), storage='memory')
+    assert (finite_size.conductivity.sum(axis=0).diagonal() < full.diagonal()).all()
+    # The stored conductivity depends on the length
+    label = '<temperature>/<statistics>/<third_bandwidth>/<method>/<length>/<finite_length_method>/<solver>'
+    other_length = Conductivity(phonons=phonons, method='full', length=(1e3, 1e3, 1e3), storage='numpy')
+    assert get_folder_from_label(other_length, label) != get_folder_from_label(finite_size, label)
+
+
+def test_cumulative_conductivity(phonons):
+    rta = Conductivity(phonons=phonons, method='rta', storage='memory')
+    conductivity = rta.conductivity
+    frequency = phonons.frequency.reshape(phonons.n_phonons)
+    cumulative_conductivity = rta.calculate_cumulative_conductivity()
+    for mu in [0, 10, 100, 500]:
+        np.testing.assert_allclose(cumulative_conductivity[mu], conductivity[frequency < frequency[mu]].sum(axis=0),
+                                   atol=1e-8)
+    mean_free_path = np.linalg.norm(rta.mean_free_path.reshape((phonons.n_phonons, 3)), axis=-1)
+    cumulative_conductivity = rta.calculate_cumulative_conductivity('mean_free_path')
+    longest = np.argmax(mean_free_path)
+    np.testing.assert_allclose(cumulative_conductivity[longest], conductivity.sum(axis=0) - conductivity[longest],
+                               atol=1e-8)
+    bins = np.linspace(0, frequency.max(), 11)
+    spectral_conductivity = rta.calculate_spectral_conductivity(bins)
+    assert spectral_conductivity.shape == (10, 3, 3)
+    np.testing.assert_allclose(spectral_conductivity.sum(axis=0), conductivity[frequency >= 0].sum(axis=0),
+                               atol=1e-8)
+    # Accumulating a few modes at a time gives the same results
+    np.testing.assert_allclose(bin_conductivity(frequency, conductivity, bins, n_block=7), spectral_conductivity,
+                               atol=1e-8)
+    np.testing.assert_allclose(cumulate_conductivity(frequency, conductivity, n_block=7),
+                               rta.calculate_cumulative_conductivity(), atol=1e-8)
+
+
+def test_scattering_rows_storage(phonons, tmpdir, monkeypatch):
+    kwargs = dict(forceconstants=phonons.forceconstants, kpts=[3, 3, 3], is_classic=False, temperature=300,
+                  storage='numpy', folder=str(tmpdir))
+    scattering_rows = Phonons(**kwargs)._scattering_rows
+
+    def fail(*kargs, **kwargs):
+        raise AssertionError('The scattering tensor was projected again')
+
+    monkeypatch.setattr('kaldo.controllers.anharmonic.project_crystal', fail)
+    stored_phonons = Phonons(**kwargs)
+    np.testing.assert_array_equal(stored_phonons._scattering_rows.toarray(), scattering_rows.toarray())
+    assert stored_phonons.bandwidth.shape == (27, 6)
+
+
+def test_scattering_operator(phonons):
+    conductivity = Conductivity(phonons=phonons, method='inverse', storage='memory')
+    physical_mode = phonons.physical_mode.reshape(phonons.n_phonons)
+    # Dense projection of phonons that never calculated the compressed rows
+    dense_phonons = Phonons(forceconstants=phonons.forceconstants, kpts=[5, 5, 5], is_classic=False, temperature=300,
+                            storage='memory')
+    np.testing.assert_allclose(phonons._scattering_rows.toarray()[physical_mode],
+                               dense_phonons._ps_gamma_and_gamma_tensor[physical_mode, 2:], atol=1e-12)
+    x = np.random.RandomState(0).rand(physical_mode.sum(), 3)
+    for options in [(False, True, False), (False, False, True), (True, True, False)]:
+        scattering_matrix = conductivity.calculate_scattering_matrix(*options)
+        scattering_operator = conductivity.calculate_scattering_operator(*options)
+        np.testing.assert_allclose(scattering_operator.dot(x), scattering_matrix.dot(x), rtol=1e-10, atol=1e-10)
+        np.testing.assert_allclose(scattering_operator.rmatvec(x[:, 0]), scattering_matrix.T.dot(x[:, 0]),
+                                   rtol=1e-10, atol=1e-10)
+        # The rows are shared by the Conductivity objects of the same phonons, the rescaled matrices are not
+        other = Conductivity(phonons=phonons, method='full', storage='memory')
+        assert other.calculate_scattering_matrix(*options) is not scattering_matrix
+        assert other.calculate_scattering_operator(*options).scattering_rows is scattering_operator.scattering_rows
+
+
+def test_scattering_matrix_views(phonons):
+    conductivity = Conductivity(phonons=phonons, method='inverse', storage='memory')
+    physical_mode = phonons.physical_mode.reshape(phonons.n_phonons)
+    frequency = phonons.frequency.reshape(phonons.n_phonons)[physical_mode]
+    population = phonons.population.reshape(phonons.n_phonons)[physical_mode]
+    gamma = phonons.bandwidth.reshape(phonons.n_phonons)[physical_mode]
+    gamma_tensor = -1 * phonons._ps_gamma_and_gamma_tensor[physical_mode][:, 2:][:, physical_mode]
+    rescaling = (population * (population + 1)) ** (1 / 2) / frequency
+    expected = rescaling[:, np.newaxis] * gamma_tensor / rescaling[np.newaxis, :] + np.diag(gamma)
+    scattering_matrix = conductivity.calculate_scattering_matrix(True, True, True)
+    np.testing.assert_allclose(scattering_matrix, expected, rtol=1e-12, atol=1e-12)
+    # Each call returns a new matrix, which can be modified without changing the next ones
+    scattering_matrix[:] = 0
+    np.testing.assert_allclose(conductivity.calculate_scattering_matrix(False, False, False), gamma_tensor,
+                               rtol=1e-12, atol=1e-12)
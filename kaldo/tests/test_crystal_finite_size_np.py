@@ -70,3 +70,17 @@ def test_inverse_finite_size_conductivity_matthiessen(phonons):
 def test_inverse_finite_size_conductivity_ms(phonons):
     cond_ms = np.abs(Conductivity(phonons=phonons, method='inverse', storage='memory',length=(1e4,0,0), finite_length_method='ms').conductivity.sum(axis=0)[0, 0])
     np.testing.assert_approx_equal(cond_ms, 180.718, significant=3)
+
+
+@pytest.mark.parametrize('method, finite_length_method', [('rta', 'ms'), ('rta', 'caltech'), ('rta', 'matthiessen'),
+                                                           ('sc', 'ms'), ('sc', 'caltech'), ('sc', 'matthiessen'),
+                                                           ('inverse', 'ms'), ('inverse', 'caltech'),
+                                                           ('inverse', 'matthiessen'), ('full', 'ms')])
+def test_conductivity_vs_length(phonons, method, finite_length_method):
+    lengths = np.array([[1e3, 1e4, 0], [1e5, 1e2, 1e4]])
+    conductivity = Conductivity(phonons=phonons, method=method, storage='memory',
+                                finite_length_method=finite_length_method).calculate_conductivity_vs_length(lengths)
+    for length, cond in zip(lengths, conductivity):
+        expected_cond = Conductivity(phonons=phonons, method=method, storage='memory', length=tuple(length),
+                                     finite_length_method=finite_length_method).conductivity.sum(axis=0)
+        np.testing.assert_allclose(cond, expected_cond, rtol=1e-8, atol=1e-6)
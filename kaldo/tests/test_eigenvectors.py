@@ -0,0 +1,48 @@
+"""
+Unit and regression test for the kaldo package.
+"""
+
+# Import package, test suite, and other packages as needed
+from kaldo.forceconstants import ForceConstants
+from kaldo.observables.harmonic_with_q import HarmonicWithQ
+from kaldo.phonons import Phonons
+import numpy as np
+import pytest
+
+
+@pytest.yield_fixture(scope="session")
+def phonons():
+    print ("Preparing phonons object.")
+    forceconstants = ForceConstants.from_folder(folder='kaldo/tests/si-amorphous',
+                                                format='eskm',
+                                                only_second=True)
+    phonons = Phonons(forceconstants=forceconstants,
+                      is_classic=False,
+                      temperature=300,
+                      storage='memory')
+    return phonons
+
+
+def test_real_eigenvectors(phonons):
+    eigenvectors = phonons.eigenvectors
+    assert eigenvectors.dtype == np.float64
+    np.testing.assert_array_almost_equal(eigenvectors[0].T.dot(eigenvectors[0]), np.eye(phonons.n_modes))
+    dynmat = phonons.forceconstants.second.sparse_dynmat.toarray()
+    np.testing.assert_allclose(dynmat.dot(eigenvectors[0]), eigenvectors[0] * phonons.eigenvalues[0],
+                               atol=1e-2 * np.abs(phonons.eigenvalues).max())
+    assert phonons._rescaled_eigenvectors is phonons._rescaled_eigenvectors
+
+
+def test_complex_eigenvectors():
+    forceconstants = ForceConstants.from_folder(folder='kaldo/tests/si-crystal',
+                                                supercell=[3, 3, 3],
+                                                format='eskm')
+    phonons = Phonons(forceconstants=forceconstants,
+                      kpts=[2, 2, 2],
+                      is_classic=False,
+                      temperature=300,
+                      storage='memory')
+    assert phonons.eigenvectors.dtype == np.complex128
+    q_point = phonons._reciprocal_grid.unitary_grid(is_wrapping=False)[1]
+    phonon = HarmonicWithQ(q_point, forceconstants.second, storage='memory')
+    np.testing.assert_array_almost_equal(phonons._eigensystem[1], phonon._eigensystem)
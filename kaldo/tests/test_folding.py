@@ -0,0 +1,73 @@
+"""
+Unit and regression test for the kaldo package.
+"""
+
+# Import package, test suite, and other packages as needed
+from kaldo.forceconstants import ForceConstants
+from kaldo.observables.harmonic_with_q import HarmonicWithQ
+import numpy as np
+import pytest
+
+
+@pytest.yield_fixture(scope="session")
+def forceconstants():
+    print ("Preparing forceconstants object.")
+    forceconstants = ForceConstants.from_folder(folder='kaldo/tests/si-crystal',
+                                                supercell=[3, 3, 3],
+                                                format='eskm')
+    return forceconstants
+
+
+def test_folded_frequency_and_velocity(forceconstants):
+    q_point = np.array([0.1, 0.2, 0.3])
+    phonon = HarmonicWithQ(q_point, forceconstants.second, storage='memory')
+    # A threshold larger than the supercell keeps all the pairs, so folding must not change anything
+    folded_phonon = HarmonicWithQ(q_point, forceconstants.second, distance_threshold=100, storage='memory')
+    np.testing.assert_array_almost_equal(folded_phonon.frequency, phonon.frequency, decimal=6)
+    np.testing.assert_array_almost_equal(folded_phonon.velocity, phonon.velocity, decimal=6)
+
+
+def test_folded_dynmat_batch(forceconstants):
+    q_points = np.array([[0.1, 0.2, 0.3], [0.5, 0, 0]])
+    second = forceconstants.second
+    dynmat = second.calculate_folded_dynmat(q_points, distance_threshold=5)
+    for q_point, dynmat_single in zip(q_points, dynmat):
+        np.testing.assert_array_almost_equal(second.calculate_folded_dynmat(q_point, distance_threshold=5)[0],
+                                             dynmat_single)
+    np.testing.assert_array_almost_equal(dynmat, np.conj(dynmat.transpose(0, 2, 1)))
+
+
+def calculate_unfolded_dynmat_per_q(second, q_point, direction=None):
+    # Reference loop over the replicas and the pairs of atoms, as the original per q point implementation
+    atoms = second.atoms
+    supercell = second.supercell
+    n_unit_cell = atoms.positions.shape[0]
+    positions = atoms.positions
+    fc_s = second.dynmat.numpy().reshape((n_unit_cell, 3, supercell[0], supercell[1], supercell[2], n_unit_cell, 3))
+    sc_r_pos = second.supercell_positions
+    sc_r_pos_norm = 1 / 2 * np.linalg.norm(sc_r_pos, axis=1) ** 2
+    dyn_s = np.zeros((n_unit_cell, 3, n_unit_cell, 3), dtype=complex)
+    for t in second.supercell_replicas:
+        replica_position = np.tensordot(t, atoms.cell, (-1, 0))
+        for iat in range(n_unit_cell):
+            for jat in range(n_unit_cell):
+                distance = replica_position + (positions[iat] - positions[jat])
+                projection = np.dot(sc_r_pos, distance) - sc_r_pos_norm
+                if (projection <= 1e-6).all():
+                    weight = 1.0 / (np.abs(projection) <= 1e-6).sum()
+                    phase = np.exp(-2j * np.pi * np.dot(q_point, t)) * weight
+                    if direction is not None:
+                        phase = - replica_position[direction] * phase
+                    dyn_s[iat, :, jat, :] += fc_s[jat, :, t[0], t[1], t[2], iat, :].T * phase
+    return dyn_s.reshape((n_unit_cell * 3, n_unit_cell * 3))
+
+
+def test_unfolded_dynmat_batch(forceconstants):
+    q_points = np.array([[0.1, 0.2, 0.3], [0.5, 0, 0]])
+    second = forceconstants.second
+    dynmat = second.calculate_unfolded_dynmat(q_points)
+    dynmat_derivatives = second.calculate_unfolded_dynmat(q_points, direction=1)
+    for q_point, dynmat_single, derivative_single in zip(q_points, dynmat, dynmat_derivatives):
+        np.testing.assert_array_almost_equal(dynmat_single, calculate_unfolded_dynmat_per_q(second, q_point))
+        np.testing.assert_array_almost_equal(derivative_single,
+                                             calculate_unfolded_dynmat_per_q(second, q_point, direction=1))
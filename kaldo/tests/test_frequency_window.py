@@ -0,0 +1,61 @@
+"""
+Unit and regression test for the kaldo package.
+"""
+
+# Import package, test suite, and other packages as needed
+from kaldo.forceconstants import ForceConstants
+from kaldo.observables.harmonic_with_q import HarmonicWithQ
+from kaldo.phonons import Phonons
+import numpy as np
+import pytest
+
+
+@pytest.yield_fixture(scope="session")
+def forceconstants():
+    print ("Preparing forceconstants object.")
+    forceconstants = ForceConstants.from_folder(folder='kaldo/tests/si-amorphous',
+                                                format='eskm',
+                                                only_second=True)
+    return forceconstants
+
+
+def test_window_frequency(forceconstants):
+    phonons = Phonons(forceconstants=forceconstants, is_classic=False, temperature=300, storage='memory')
+    window_phonons = Phonons(forceconstants=forceconstants, is_classic=False, temperature=300, storage='memory',
+                             frequency_window=(2, 6))
+    frequency = phonons.frequency[0]
+    is_in_window = (frequency >= 2) & (frequency < 6)
+    assert window_phonons.n_modes == is_in_window.sum()
+    np.testing.assert_array_almost_equal(window_phonons.frequency[0], frequency[is_in_window], decimal=5)
+    assert window_phonons.physical_mode.all()
+
+
+def test_window_flux(forceconstants):
+    q_point = np.array([0, 0, 0])
+    phonon = HarmonicWithQ(q_point, forceconstants.second, storage='memory')
+    window_phonon = HarmonicWithQ(q_point, forceconstants.second, storage='memory', frequency_window=(2, 6))
+    frequency = phonon.frequency[0]
+    is_in_window = (frequency >= 2) & (frequency < 6)
+    # Eigenvectors are defined up to a sign
+    sij = np.abs(np.array(phonon._sij_z)[np.ix_(is_in_window, is_in_window)])
+    np.testing.assert_allclose(np.abs(window_phonon._sij_z), sij, atol=1e-2)
+
+
+def test_window_including_acoustic_modes(forceconstants):
+    phonons = Phonons(forceconstants=forceconstants, is_classic=False, temperature=300, storage='memory')
+    window_phonons = Phonons(forceconstants=forceconstants, is_classic=False, temperature=300, storage='memory',
+                             frequency_window=(-1, 30))
+    np.testing.assert_array_almost_equal(window_phonons.frequency, phonons.frequency, decimal=3)
+    np.testing.assert_equal(window_phonons.physical_mode, phonons.physical_mode)
+
+
+def test_window_excluding_negative_acoustic_mode(forceconstants):
+    phonons = Phonons(forceconstants=forceconstants, is_classic=False, temperature=300, storage='memory')
+    window_phonons = Phonons(forceconstants=forceconstants, is_classic=False, temperature=300, storage='memory',
+                             frequency_window=(0, 5))
+    frequency = phonons.frequency[0]
+    is_in_window = (frequency >= 0) & (frequency < 5)
+    # The lowest acoustic mode has a small negative frequency and is left out of the window
+    assert frequency.min() < 0
+    assert window_phonons.n_modes == is_in_window.sum()
+    np.testing.assert_equal(window_phonons.physical_mode[0], phonons.physical_mode[0, is_in_window])
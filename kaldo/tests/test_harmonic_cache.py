@@ -0,0 +1,76 @@
+"""
+Unit and regression test for the kaldo package.
+"""
+
+# Import package, test suite, and other packages as needed
+from kaldo.forceconstants import ForceConstants
+from kaldo.helpers.cache import HarmonicCache
+from kaldo.observables.harmonic_with_q import HarmonicWithQ
+from kaldo.phonons import Phonons
+import numpy as np
+import pytest
+
+
+@pytest.yield_fixture(scope="session")
+def forceconstants():
+    print ("Preparing force constants object.")
+    forceconstants = ForceConstants.from_folder(folder='kaldo/tests/si-crystal',
+                                                supercell=[3, 3, 3],
+                                                format='eskm')
+    return forceconstants
+
+
+def test_cache_across_meshes(forceconstants, tmpdir):
+    cache = HarmonicCache(folder=str(tmpdir))
+    small_mesh = Phonons(forceconstants=forceconstants, kpts=[2, 2, 2], is_classic=False, temperature=300,
+                         storage='memory', harmonic_cache=cache)
+    small_frequency = small_mesh.frequency
+    n_entries = len(cache)
+    assert n_entries == 8
+    big_mesh = Phonons(forceconstants=forceconstants, kpts=[4, 4, 4], is_classic=False, temperature=300,
+                       storage='memory', harmonic_cache=cache)
+    big_frequency = big_mesh.frequency
+    # Only the q points that are not in the small mesh are added
+    assert len(cache) == 64
+    q_points = big_mesh._reciprocal_grid.unitary_grid(is_wrapping=False)
+    is_shared = np.all(np.mod(q_points * 2, 1) == 0, axis=1)
+    np.testing.assert_array_equal(np.sort(big_frequency[is_shared], axis=0), np.sort(small_frequency, axis=0))
+
+    reference = Phonons(forceconstants=forceconstants, kpts=[2, 2, 2], is_classic=False, temperature=300,
+                        storage='memory', harmonic_cache=None)
+    np.testing.assert_allclose(small_mesh.velocity, reference.velocity, atol=1e-8)
+
+    # The persistent storage survives the memory
+    q_point = q_points[1]
+    expected_velocity = HarmonicWithQ(q_point, forceconstants.second, storage='memory', cache=cache).velocity
+    loaded_cache = HarmonicCache(max_bytes=0, folder=str(tmpdir))
+    phonon = HarmonicWithQ(q_point, forceconstants.second, storage='memory', cache=loaded_cache)
+    np.testing.assert_array_equal(phonon.velocity, expected_velocity)
+
+
+def test_cache_key_follows_force_constants():
+    forceconstants = ForceConstants.from_folder(folder='kaldo/tests/si-crystal', supercell=[3, 3, 3], format='eskm')
+    second = forceconstants.second
+    cache = HarmonicCache()
+    q_point = np.array([0.1, 0.2, 0.3])
+    frequency = HarmonicWithQ(q_point, second, storage='memory', cache=cache).frequency
+    # Assigning the scaled force constants resets the fingerprint, so the cached frequencies are not returned
+    fingerprint = second.fingerprint
+    second.value *= 4
+    assert second.fingerprint != fingerprint
+    del second._dynmat
+    scaled_frequency = HarmonicWithQ(q_point, second, storage='memory', cache=cache).frequency
+    np.testing.assert_allclose(scaled_frequency, 2 * frequency, rtol=1e-6)
+    assert len(cache) == 2
+
+
+def test_cache_budget():
+    cache = HarmonicCache(max_bytes=3 * 8 * 10)
+    for i in range(4):
+        cache.put(i, np.ones(10) * i)
+    assert len(cache) == 3
+    assert cache.get(0) is None
+    cache.get(1)
+    cache.put(4, np.ones(10))
+    assert 1 in cache and 2 not in cache
+    assert cache.n_bytes == 3 * 8 * 10
@@ -0,0 +1,49 @@
+"""
+Unit and regression test for the kaldo package.
+"""
+
+# Import package, test suite, and other packages as needed
+from kaldo.forceconstants import ForceConstants
+from kaldo.phonons import Phonons
+from kaldo.observables.harmonic_with_q import HarmonicWithQ
+from kaldo.controllers.interpolation import interpolate_harmonic
+import numpy as np
+import pytest
+
+
+@pytest.yield_fixture(scope="session")
+def phonons():
+    print ("Preparing phonons object.")
+    forceconstants = ForceConstants.from_folder(folder='kaldo/tests/si-crystal',
+                                                supercell=[3, 3, 3],
+                                                format='eskm')
+    phonons = Phonons(forceconstants=forceconstants,
+                      kpts=[3, 3, 3],
+                      is_classic=False,
+                      temperature=300,
+                      storage='memory')
+    return phonons
+
+
+def test_interpolation_on_mesh(phonons):
+    q_points = phonons._reciprocal_grid.unitary_grid(is_wrapping=False)
+    frequency, velocity, physical_mode = interpolate_harmonic(phonons, q_points, batch_size=10)
+    np.testing.assert_array_almost_equal(frequency, phonons.frequency, decimal=6)
+    np.testing.assert_array_equal(physical_mode, phonons.physical_mode)
+
+
+def test_interpolation_off_mesh(phonons):
+    q_points = np.array([[0.1, 0.2, 0.3], [0.13, 0.41, 0.27]])
+    frequency, velocity, _ = interpolate_harmonic(phonons, q_points)
+    for iq in range(q_points.shape[0]):
+        phonon = HarmonicWithQ(q_points[iq], phonons.forceconstants.second, storage='memory')
+        np.testing.assert_array_almost_equal(frequency[iq], phonon.frequency[0], decimal=6)
+        np.testing.assert_array_almost_equal(velocity[iq], phonon.velocity[0], decimal=4)
+
+
+def test_connected_bands(phonons):
+    q_points = np.zeros((20, 3))
+    q_points[:, 0] = np.linspace(0.01, 0.5, 20)
+    frequency, _, _ = interpolate_harmonic(phonons, q_points)
+    connected_frequency, _, _ = interpolate_harmonic(phonons, q_points, is_connecting_bands=True)
+    np.testing.assert_array_almost_equal(np.sort(connected_frequency, axis=1), frequency)
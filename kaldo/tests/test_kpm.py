@@ -0,0 +1,92 @@
+"""
+Unit and regression test for the kaldo package.
+"""
+
+# Import package, test suite, and other packages as needed
+from kaldo.forceconstants import ForceConstants
+from kaldo.phonons import Phonons
+from kaldo.conductivity import Conductivity
+import kaldo.controllers.kpm as kpm
+import numpy as np
+import pytest
+
+N_MOMENTS = 32
+
+
+@pytest.yield_fixture(scope="session")
+def phonons():
+    print ("Preparing phonons object.")
+    forceconstants = ForceConstants.from_folder(folder='kaldo/tests/si-amorphous',
+                                                format='eskm',
+                                                only_second=True)
+    phonons = Phonons(forceconstants=forceconstants,
+                      is_classic=False,
+                      temperature=300,
+                      storage='memory')
+    return phonons
+
+
+def broadened_delta(phonons, frequency):
+    # Kernel polynomial approximation of delta((2 pi frequency)^2 - eigenvalue), evaluated on the exact eigenvalues
+    dynmat = phonons.forceconstants.second.sparse_dynmat
+    eigenvalues, eigenvectors = np.linalg.eigh(dynmat.toarray())
+    scale, shift = kpm.calculate_spectral_bounds(dynmat)
+    coefficients = kpm.calculate_delta_coefficients((2 * np.pi * frequency) ** 2, N_MOMENTS, scale, shift)
+    x = (eigenvalues - shift) / scale
+    chebyshev = np.cos(np.arange(N_MOMENTS)[:, np.newaxis] * np.arccos(x)[np.newaxis, :])
+    return coefficients.T.dot(chebyshev), eigenvectors
+
+
+def test_dos(phonons):
+    frequency = np.linspace(1, 15, 8)
+    _, dos = kpm.calculate_dos(phonons, frequency, n_moments=N_MOMENTS, n_vectors=None)
+    delta, _ = broadened_delta(phonons, frequency)
+    expected_dos = delta.mean(axis=1) * 8 * np.pi ** 2 * frequency
+    np.testing.assert_allclose(dos, expected_dos, rtol=1e-6)
+
+
+def test_diffusivity(phonons):
+    frequency = np.linspace(1, 15, 8)
+    _, _, diffusivity = kpm.calculate_diffusivity(phonons, frequency, n_moments=N_MOMENTS, n_vectors=None)
+    delta, eigenvectors = broadened_delta(phonons, frequency)
+    sij = eigenvectors.T.dot(phonons.forceconstants.second.sparse_dynmat_derivatives(2).dot(eigenvectors))
+    trace_flux = np.einsum('ki,ij,kj->k', delta, sij ** 2, delta)
+    expected_diffusivity = np.pi * trace_flux / (4 * np.pi * frequency * delta.sum(axis=1)) / 100
+    np.testing.assert_allclose(diffusivity[:, 2], expected_diffusivity, rtol=1e-6)
+
+
+def test_diffusivity_against_qhgk(phonons):
+    # Allen-Feldman diffusivity of the diagonalized sample, averaged on frequency bins, which smooths out the
+    # different broadenings of the two methods
+    qhgk = Conductivity(phonons=phonons, method='qhgk', diffusivity_bandwidth=0.5, diffusivity_shape='lorentz',
+                        storage='memory')
+    qhgk.conductivity
+    mode_frequency = phonons.frequency.flatten()
+    mode_diffusivity = qhgk.diffusivity.flatten()
+    edges = np.array([3, 7, 11, 15])
+    frequency = np.linspace(edges[0], edges[-1], 57)
+    _, dos, diffusivity = kpm.calculate_diffusivity(phonons, frequency, n_moments=128, n_vectors=40, seed=0)
+    diffusivity = diffusivity.mean(axis=1)
+    for low, high in zip(edges[:-1], edges[1:]):
+        is_in_bin = (frequency >= low) & (frequency <= high)
+        kpm_diffusivity = np.trapz((dos * diffusivity)[is_in_bin], frequency[is_in_bin]) \
+                          / np.trapz(dos[is_in_bin], frequency[is_in_bin])
+        expected_diffusivity = mode_diffusivity[(mode_frequency >= low) & (mode_frequency < high)].mean()
+        np.testing.assert_allclose(kpm_diffusivity, expected_diffusivity, rtol=0.1)
+
+
+def test_conductivity_against_qhgk(phonons):
+    # Conductivity of the modes of the diagonalized sample in frequency bins, within 10%
+    qhgk = Conductivity(phonons=phonons, method='qhgk', diffusivity_bandwidth=0.5, diffusivity_shape='lorentz',
+                        storage='memory')
+    mode_conductivity = np.einsum('naa->n', qhgk.conductivity.reshape((-1, 3, 3))) / 3
+    mode_frequency = phonons.frequency.flatten()
+    edges = np.array([3, 7, 11, 15])
+    frequency = np.linspace(edges[0], edges[-1], 57)
+    _, conductivity = kpm.calculate_conductivity(phonons, frequency, n_moments=128, n_vectors=40, seed=0)
+    conductivity = conductivity.mean(axis=1)
+    for low, high in zip(edges[:-1], edges[1:]):
+        is_in_bin = (frequency >= low) & (frequency <= high)
+        kpm_conductivity = np.trapz(conductivity[is_in_bin], frequency[is_in_bin])
+        expected_conductivity = mode_conductivity[(mode_frequency >= low) & (mode_frequency < high)].sum()
+        np.testing.assert_allclose(kpm_conductivity, expected_conductivity, rtol=0.1)
@@ -0,0 +1,59 @@
+"""
+Unit and regression test for the kaldo package.
+"""
+
+# Import package, test suite, and other packages as needed
+from kaldo.forceconstants import ForceConstants
+from kaldo.conductivity import Conductivity
+from kaldo.phonons import Phonons
+import numpy as np
+import pytest
+
+
+@pytest.yield_fixture(scope="session")
+def forceconstants():
+    print ("Preparing forceconstants object.")
+    forceconstants = ForceConstants.from_folder(folder='kaldo/tests/si-crystal',
+                                                supercell=[3, 3, 3],
+                                                format='eskm')
+    return forceconstants
+
+
+def create_phonons(forceconstants, n_workers):
+    return Phonons(forceconstants=forceconstants,
+                   kpts=[2, 2, 2],
+                   is_classic=False,
+                   temperature=300,
+                   storage='memory',
+                   n_workers=n_workers,
+                   n_blas_threads=1)
+
+
+def test_parallel_harmonic(forceconstants):
+    phonons = create_phonons(forceconstants, n_workers=1)
+    parallel_phonons = create_phonons(forceconstants, n_workers=2)
+    np.testing.assert_array_almost_equal(parallel_phonons.frequency, phonons.frequency)
+    np.testing.assert_array_almost_equal(parallel_phonons.velocity, phonons.velocity)
+    np.testing.assert_array_almost_equal(parallel_phonons.heat_capacity, phonons.heat_capacity)
+
+
+def test_parallel_qhgk(forceconstants):
+    phonons = create_phonons(forceconstants, n_workers=1)
+    conductivity = Conductivity(phonons=phonons, method='qhgk', diffusivity_bandwidth=0.1,
+                                storage='memory').conductivity.sum(axis=0)
+    parallel_conductivity = Conductivity(phonons=phonons, method='qhgk', diffusivity_bandwidth=0.1,
+                                         storage='memory', n_workers=2).conductivity.sum(axis=0)
+    np.testing.assert_array_almost_equal(parallel_conductivity, conductivity, decimal=3)
+
+
+def test_threads_qhgk(forceconstants):
+    phonons = create_phonons(forceconstants, n_workers=1)
+    conductivity = Conductivity(phonons=phonons, method='qhgk', diffusivity_bandwidth=0.1,
+                                storage='memory').conductivity.sum(axis=0)
+    threads_conductivity = Conductivity(phonons=phonons, method='qhgk', diffusivity_bandwidth=0.1,
+                                        storage='memory', n_workers=2,
+                                        parallel_backend='threads').conductivity.sum(axis=0)
+    np.testing.assert_allclose(threads_conductivity, conductivity, rtol=1e-10)
+    threads_phonons = Phonons(forceconstants=forceconstants, kpts=[2, 2, 2], is_classic=False, temperature=300,
+                              storage='memory', n_workers=2, parallel_backend='threads', harmonic_cache=None)
+    np.testing.assert_allclose(threads_phonons.frequency, phonons.frequency, rtol=1e-10)
@@ -0,0 +1,126 @@
+"""
+Unit and regression test for the kaldo package.
+"""
+
+# Import package, test suite, and other packages as needed
+from kaldo.forceconstants import ForceConstants
+from kaldo.observables.harmonic_with_q import HarmonicWithQ
+from kaldo.phonons import Phonons
+import kaldo.conductivity as conductivity
+import numpy as np
+import pytest
+
+
+@pytest.yield_fixture(scope="session")
+def phonons():
+    print ("Preparing phonons object.")
+    forceconstants = ForceConstants.from_folder(folder='kaldo/tests/si-amorphous',
+                                                format='eskm',
+                                                only_second=True)
+    phonons = Phonons(forceconstants=forceconstants,
+                      is_classic=False,
+                      temperature=300,
+                      storage='memory')
+    return phonons
+
+
+def test_qhgk_row_blocks(phonons, monkeypatch):
+    qhgk = conductivity.Conductivity(phonons=phonons, method='qhgk', diffusivity_bandwidth=0.1, storage='memory')
+    kappa = qhgk.conductivity.sum(axis=0)
+    # Dense reference, with the full generalized heat capacity
+    eigenvectors = phonons.eigenvectors[0]
+    sij_z = eigenvectors.T.dot(phonons.forceconstants.second.sparse_dynmat_derivatives(2).dot(eigenvectors))
+    diffusivity = conductivity.calculate_diffusivity(phonons.omega[0], sij_z, sij_z,
+                                                     0.1 * np.ones(phonons.n_modes),
+                                                     phonons.physical_mode[0], conductivity.lorentz_delta)
+    volume = np.linalg.det(phonons.atoms.cell)
+    expected_kappa_zz = np.sum(phonons.heat_capacity_2d[0] * diffusivity) / volume * 1e22
+    np.testing.assert_allclose(kappa[2, 2], expected_kappa_zz, rtol=1e-3)
+
+    monkeypatch.setattr(conductivity, 'MAX_QHGK_BLOCK_ELEMENTS', 1000)
+    blocked_qhgk = conductivity.Conductivity(phonons=phonons, method='qhgk', diffusivity_bandwidth=0.1,
+                                             storage='memory')
+    np.testing.assert_allclose(blocked_qhgk.conductivity.sum(axis=0), kappa, rtol=1e-10)
+    np.testing.assert_allclose(blocked_qhgk.diffusivity, qhgk.diffusivity, rtol=1e-10)
+
+
+def test_qhgk_reuses_eigensystem(monkeypatch):
+    forceconstants = ForceConstants.from_folder(folder='kaldo/tests/si-crystal',
+                                                supercell=[3, 3, 3],
+                                                format='eskm')
+    phonons = Phonons(forceconstants=forceconstants, kpts=[3, 3, 3], is_classic=False, temperature=300,
+                      storage='memory', harmonic_cache=None)
+    expected_kappa = conductivity.Conductivity(phonons=phonons, method='qhgk', diffusivity_bandwidth=0.1,
+                                               storage='memory').conductivity.sum(axis=0)
+
+    def fail(*kargs, **kwargs):
+        raise AssertionError('The eigensystem was calculated again')
+
+    monkeypatch.setattr(HarmonicWithQ, 'calculate_eigensystem', fail)
+    kappa = conductivity.Conductivity(phonons=phonons, method='qhgk', diffusivity_bandwidth=0.1,
+                                      storage='memory').conductivity.sum(axis=0)
+    np.testing.assert_allclose(kappa, expected_kappa, rtol=1e-10)
+
+
+def test_qhgk_band_limited(phonons):
+    qhgk = conductivity.Conductivity(phonons=phonons, method='qhgk', diffusivity_bandwidth=0.1,
+                                     diffusivity_threshold=2, storage='memory')
+    band_limited_qhgk = conductivity.Conductivity(phonons=phonons, method='qhgk', diffusivity_bandwidth=0.1,
+                                                  diffusivity_threshold=2, is_diffusivity_band_limited=True,
+                                                  storage='memory')
+    kappa = qhgk.conductivity.sum(axis=0)
+    np.testing.assert_allclose(band_limited_qhgk.conductivity.sum(axis=0), kappa, rtol=1e-8, atol=1e-8)
+    np.testing.assert_allclose(band_limited_qhgk.diffusivity, qhgk.diffusivity, rtol=1e-8, atol=1e-12)
+    with pytest.raises(ValueError):
+        conductivity.Conductivity(phonons=phonons, method='qhgk', is_diffusivity_band_limited=True)
+
+
+def test_band_pairs(phonons, monkeypatch):
+    omega = phonons.omega[0]
+    physical_mode = phonons.physical_mode[0]
+    # Mode dependent bandwidths, with a few broad modes
+    bandwidth = np.random.RandomState(0).rand(phonons.n_modes) * 0.1
+    bandwidth[::100] = 5
+    first, second = conductivity.calculate_band_pairs(omega, bandwidth, physical_mode, 2)
+    is_pair = (np.abs(omega[:, np.newaxis] - omega[np.newaxis, :]) < 2 * 2 * np.pi * bandwidth[np.newaxis, :]) \
+              & physical_mode[:, np.newaxis] & physical_mode[np.newaxis, :]
+    expected_first, expected_second = np.nonzero(is_pair)
+    assert first.shape == expected_first.shape
+    np.testing.assert_array_equal(np.sort(first * phonons.n_modes + second),
+                                  expected_first * phonons.n_modes + expected_second)
+
+    eigenvectors = phonons.eigenvectors[0]
+    sij_z = eigenvectors.T.dot(phonons.forceconstants.second.sparse_dynmat_derivatives(2).dot(eigenvectors))
+    monkeypatch.setattr('kaldo.observables.harmonic_with_q.MAX_SIJ_PAIR_ELEMENTS', 10 * phonons.n_modes)
+    phonon = HarmonicWithQ(np.zeros(3), phonons.forceconstants.second, storage='memory')
+    np.testing.assert_allclose(phonon.calculate_sij_pairs(2, first, second, eigenvectors), sij_z[first, second],
+                               atol=1e-10)
+
+
+def test_qhgk_band_limited_crystal():
+    forceconstants = ForceConstants.from_folder(folder='kaldo/tests/si-crystal',
+                                                supercell=[3, 3, 3],
+                                                format='eskm')
+    phonons = Phonons(forceconstants=forceconstants, kpts=[3, 3, 3], is_classic=False, temperature=300,
+                      storage='memory')
+    kappa = conductivity.Conductivity(phonons=phonons, method='qhgk', diffusivity_threshold=2,
+                                      storage='memory').conductivity.sum(axis=0)
+    band_limited_kappa = conductivity.Conductivity(phonons=phonons, method='qhgk', diffusivity_threshold=2,
+                                                   is_diffusivity_band_limited=True,
+                                                   storage='memory').conductivity.sum(axis=0)
+    np.testing.assert_allclose(band_limited_kappa, kappa, rtol=1e-8, atol=1e-8)
+
+
+def test_qhgk_sweep(phonons):
+    cold_phonons = Phonons(forceconstants=phonons.forceconstants, is_classic=False, temperature=100,
+                           storage='memory')
+    bandwidths = [0.1, 0.3]
+    sweep = conductivity.Conductivity(phonons=phonons, method='qhgk',
+                                      storage='memory').calculate_qhgk_sweep([300, 100], bandwidths)
+    assert sweep.shape == (2, 2, 3, 3)
+    for i, temperature_phonons in enumerate([phonons, cold_phonons]):
+        for j, bandwidth in enumerate(bandwidths):
+            expected_kappa = conductivity.Conductivity(phonons=temperature_phonons, method='qhgk',
+                                                       diffusivity_bandwidth=bandwidth,
+                                                       storage='memory').conductivity.sum(axis=0)
+            np.testing.assert_allclose(sweep[i, j], expected_kappa, rtol=1e-8, atol=1e-10)